@@ -0,0 +1,160 @@
+"""ベンチマーク用のローカルOAuthサーバー
+
+Snowflake（/oauth/authorize, /oauth/token-request）と Cognito（/oauth2/authorize,
+/oauth2/token）の両方の形式に応答する。authorize はすぐに redirect_uri へ
+認可コードを付けてリダイレクトし、token は authorization_code / refresh_token の
+グラントに応答する。応答の遅延とトークンの有効期限は引数で変更できる。
+
+単体で起動する場合:
+    python fake_oauth_server.py --port 8900 --latency-ms 50 --expires-in 3600
+"""
+import argparse
+import base64
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+AUTHORIZE_PATHS = ('/oauth/authorize', '/oauth2/authorize')
+TOKEN_PATHS = ('/oauth/token-request', '/oauth2/token')
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def fake_jwt(claims):
+    """署名なしの JWT 形式の文字列（アプリは USER_POOL_ID 未設定時に検証せずデコードする）"""
+    header = _b64(json.dumps({'alg': 'RS256', 'kid': 'bench'}).encode('utf-8'))
+    payload = _b64(json.dumps(claims).encode('utf-8'))
+    return f"{header}.{payload}.{_b64(b'bench')}"
+
+
+class FakeOAuthState:
+    def __init__(self, latency=0.0, expires_in=3600, fail_rate=0.0):
+        self.latency = latency
+        self.expires_in = expires_in
+        self.fail_rate = fail_rate
+        self.codes = {}           # 認可コード -> ユーザー名
+        self.refresh_tokens = {}  # refresh_token -> ユーザー名
+        self.counts = {'authorize': 0, 'authorization_code': 0, 'refresh_token': 0, 'error': 0}
+        self.lock = threading.Lock()
+
+    def issue(self, username, with_refresh_token):
+        now = int(time.time())
+        claims = {'sub': username, 'username': username, 'client_id': 'bench-client',
+                  'iat': now, 'exp': now + self.expires_in, 'scp': 'session:role-any'}
+        token = {
+            'access_token': fake_jwt(dict(claims, token_use='access', jti=secrets.token_hex(8))),
+            'id_token': fake_jwt(dict(claims, token_use='id', aud='bench-client')),
+            'token_type': 'Bearer',
+            'expires_in': self.expires_in,
+            'username': username,
+        }
+        if with_refresh_token:
+            refresh_token = secrets.token_urlsafe(32)
+            with self.lock:
+                self.refresh_tokens[refresh_token] = username
+            token['refresh_token'] = refresh_token
+        return token
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                with state.lock:
+                    return self._send_json(200, dict(state.counts))
+            if url.path not in AUTHORIZE_PATHS:
+                return self._send_json(404, {'error': 'not_found'})
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            code = secrets.token_urlsafe(16)
+            with state.lock:
+                state.counts['authorize'] += 1
+                state.codes[code] = f"bench_user_{len(state.codes) + 1}"
+            location = params['redirect_uri'] + '?' + urlencode({'code': code, 'state': params.get('state', '')})
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length', 0))
+            form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+            if url.path not in TOKEN_PATHS:
+                return self._send_json(404, {'error': 'not_found'})
+            if state.latency:
+                time.sleep(state.latency)
+
+            grant_type = form.get('grant_type')
+            with state.lock:
+                if state.fail_rate and secrets.randbelow(10000) < state.fail_rate * 10000:
+                    state.counts['error'] += 1
+                    return self._send_json(503, {'error': 'temporarily_unavailable'})
+                if grant_type == 'authorization_code':
+                    username = state.codes.pop(form.get('code'), None)
+                elif grant_type == 'refresh_token':
+                    username = state.refresh_tokens.get(form.get('refresh_token'))
+                else:
+                    username = None
+                if username is None:
+                    state.counts['error'] += 1
+                else:
+                    state.counts[grant_type] += 1
+            if username is None:
+                return self._send_json(400, {'error': 'invalid_grant'})
+            # refresh_token グラントでは refresh_token を返さない（アプリ側で引き継ぐ）
+            return self._send_json(200, state.issue(username, grant_type == 'authorization_code'))
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # 数百クライアントの同時ログインで接続が拒否されないよう、listen のキューを大きくする
+    request_queue_size = 1024
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.0, expires_in=3600, fail_rate=0.0):
+    """バックグラウンドスレッドで起動し、(server, state) を返す"""
+    state = FakeOAuthState(latency=latency, expires_in=expires_in, fail_rate=fail_rate)
+    server = _Server((host, port), make_handler(state))
+    threading.Thread(target=server.serve_forever, name='fake-oauth', daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用のローカルOAuthサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--expires-in', type=int, default=3600)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='503を返す割合（0〜1）')
+    args = parser.parse_args()
+    server, _ = start_server(args.host, args.port, args.latency_ms / 1000, args.expires_in, args.fail_rate)
+    print(f"Fake OAuth server: http://{args.host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
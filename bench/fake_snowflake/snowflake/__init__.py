@@ -0,0 +1 @@
+"""ベンチマーク用の snowflake パッケージ（PYTHONPATH の先頭に置いて本物の代わりに読み込ませる）"""
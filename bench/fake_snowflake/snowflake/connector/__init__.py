@@ -0,0 +1,241 @@
+"""ベンチマーク用の snowflake.connector
+
+本物の代わりに合成した結果セットを返す。遅延と行数は環境変数で変更できる:
+
+- FAKE_SF_CONNECT_MS:  connect()（ログイン・セッション作成）の遅延
+- FAKE_SF_EXECUTE_MS:  execute() の遅延（execute_async では完了までの時間）
+- FAKE_SF_FETCH_MS:    fetchmany() 1回ごとの遅延
+- FAKE_SF_ROWS:        結果の行数（SQL に LIMIT n があればそちらを使う）
+- FAKE_SF_ARROW:       true なら fetch_arrow_batches() で Arrow バッチを返す（pyarrow が必要、既定は false）
+- FAKE_SF_SESSION_TTL: セッションの有効期間（秒、0で無期限）。client_session_keep_alive なしで
+                       これより古い接続で実行すると、セッション期限切れ（390111）になる
+- FAKE_SF_RESUME_MS:   停止中の Warehouse の再開にかかる時間。Warehouse（接続パラメータ）ごとに
+                       プロセスで最初のクエリか ALTER WAREHOUSE ... RESUME がこの時間だけ待つ
+
+SQL に FAIL を含めると ProgrammingError になる。
+SYSTEM$CANCEL_QUERY で取り消した非同期クエリは、状態確認で取り消しのエラーになる。
+"""
+import datetime
+import os
+import re
+import threading
+import time
+import uuid
+
+from .constants import QueryStatus
+from .errors import DatabaseError, Error, NotSupportedError, ProgrammingError
+from .util_text import split_statements
+
+__all__ = ['connect', 'Error', 'DatabaseError', 'ProgrammingError', 'NotSupportedError']
+
+_LIMIT_RE = re.compile(r'\bLIMIT\s+(\d+)', re.IGNORECASE)
+_COLUMNS = [('ID', 0), ('NAME', 2), ('AMOUNT', 1), ('CREATED_AT', 8), ('FLAG', 13)]
+
+# 非同期実行したクエリ: sfqid -> (sql, 完了時刻, 取り消したか)
+_async_queries = {}
+_async_lock = threading.Lock()
+_ARROW_CHUNK_ROWS = 4096  # 本物の結果チャンクと同じく、数千行ごとのバッチにする
+
+# 再開済みの Warehouse（再開中の Warehouse を使うクエリは再開が終わるまで待つ）
+_resumed_warehouses = set()
+_resume_lock = threading.Lock()
+_ALTER_RESUME_RE = re.compile(r'^\s*ALTER\s+WAREHOUSE\s+"?([^"\s]+)"?\s+RESUME\b', re.IGNORECASE)
+_NO_WAREHOUSE_RE = re.compile(r'^\s*SELECT\s+(1|CURRENT_\w+\(\))\s*$', re.IGNORECASE)
+
+
+def _sleep_ms(name):
+    delay = float(os.getenv(name, '0'))
+    if delay:
+        time.sleep(delay / 1000)
+
+
+def _resume(warehouse):
+    if not warehouse or not float(os.getenv('FAKE_SF_RESUME_MS', '0')):
+        return
+    with _resume_lock:
+        if warehouse.upper() not in _resumed_warehouses:
+            _sleep_ms('FAKE_SF_RESUME_MS')
+            _resumed_warehouses.add(warehouse.upper())
+
+
+def _row_count(sql):
+    match = _LIMIT_RE.search(sql)
+    return int(match.group(1)) if match else int(os.getenv('FAKE_SF_ROWS', '100'))
+
+
+def _row(i):
+    return (i, f'name_{i}', i * 1.5, datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=i),
+            i % 2 == 0)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.sfqid = None
+        self.rowcount = None
+        self._total = 0
+        self._position = 0
+        self._fixed_rows = None
+
+    def _prepare(self, sql):
+        self.connection.check_session()
+        if 'FAIL' in sql.upper():
+            raise ProgrammingError(f'SQL compilation error: {sql}', errno=1003)
+        self.sfqid = str(uuid.uuid4())
+        self.description = [(name, type_code, None, None, None, None, True) for name, type_code in _COLUMNS]
+        self._total = _row_count(sql)
+        self._position = 0
+        self._fixed_rows = None
+        self.rowcount = self._total
+
+    def _prepare_scalar(self, sql, value):
+        self._prepare(sql)
+        self.description = [(sql.split()[-1].upper(), 2, None, None, None, None, True)]
+        self._fixed_rows = [(value,)]
+        self._total = self.rowcount = 1
+
+    def _use_warehouse(self, sql):
+        # コンピュートを使わない文（SELECT 1 / CURRENT_*()）では Warehouse を再開しない
+        if not _NO_WAREHOUSE_RE.match(sql):
+            _resume(self.connection.params.get('warehouse'))
+
+    def execute(self, sql, *args, **kwargs):
+        if 'SYSTEM$CANCEL_QUERY' in sql.upper():
+            self._prepare(sql)
+            with _async_lock:
+                query = _async_queries.get(args[0][0])
+                if query is not None:
+                    _async_queries[args[0][0]] = (query[0], query[1], True)
+            return self
+        resume = _ALTER_RESUME_RE.match(sql)
+        if resume:
+            _resume(resume.group(1))
+            self._prepare_scalar(sql, 'Statement executed successfully.')
+            return self
+        if 'CURRENT_WAREHOUSE()' in sql.upper():
+            self._prepare_scalar(sql, (self.connection.params.get('warehouse') or '').upper() or None)
+            return self
+        self._use_warehouse(sql)
+        _sleep_ms('FAKE_SF_EXECUTE_MS')
+        self._prepare(sql)
+        return self
+
+    def execute_async(self, sql, *args, **kwargs):
+        resume = _ALTER_RESUME_RE.match(sql)
+        if resume:
+            # 再開はサーバー側で進む（完了を待たずに返る）
+            threading.Thread(target=_resume, args=(resume.group(1),), daemon=True).start()
+        else:
+            self._use_warehouse(sql)
+        self._prepare(sql)
+        with _async_lock:
+            _async_queries[self.sfqid] = (sql, time.time() + float(os.getenv('FAKE_SF_EXECUTE_MS', '0')) / 1000,
+                                          False)
+        self.description = None
+        return {'queryId': self.sfqid}
+
+    def get_results_from_sfqid(self, sfqid):
+        with _async_lock:
+            query = _async_queries.get(sfqid)
+        if query is None:
+            raise ProgrammingError(f'Unknown query id: {sfqid}')
+        self._prepare(query[0])
+        self.sfqid = sfqid
+
+    def fetchmany(self, size=1):
+        _sleep_ms('FAKE_SF_FETCH_MS')
+        end = min(self._total, self._position + size)
+        if self._fixed_rows is not None:
+            rows = self._fixed_rows[self._position:end]
+        else:
+            rows = [_row(i) for i in range(self._position, end)]
+        self._position = end
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        return self.fetchmany(self._total - self._position)
+
+    def fetch_arrow_batches(self):
+        try:
+            import pyarrow  # noqa: F401  本物と同じく、Arrow の結果を使うときだけ読み込む
+        except ImportError:
+            pyarrow = None
+        if (pyarrow is None or os.getenv('FAKE_SF_ARROW', 'false').lower() != 'true'
+                or self._fixed_rows is not None):
+            # Arrow 形式は扱わない（アプリは fetchmany にフォールバックする）
+            raise NotSupportedError('Arrow result batches are not available in the fake connector')
+        return self._arrow_batches()
+
+    def _arrow_batches(self):
+        import pyarrow as pa
+        while self._position < self._total:
+            _sleep_ms('FAKE_SF_FETCH_MS')
+            start = self._position
+            end = min(self._total, start + _ARROW_CHUNK_ROWS)
+            ids = pa.array(range(start, end), pa.int64())
+            yield pa.table({
+                'ID': ids,
+                'NAME': pa.array([f'name_{i}' for i in range(start, end)], pa.string()),
+                'AMOUNT': pa.array([i * 1.5 for i in range(start, end)], pa.float64()),
+                'CREATED_AT': pa.array([datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=i)
+                                        for i in range(start, end)], pa.timestamp('us')),
+                'FLAG': pa.array([i % 2 == 0 for i in range(start, end)], pa.bool_()),
+            })
+            self._position = end
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, **params):
+        self.params = params
+        self._closed = False
+        self._created_at = time.monotonic()
+
+    def check_session(self):
+        ttl = float(os.getenv('FAKE_SF_SESSION_TTL', '0'))
+        if (ttl and not self.params.get('client_session_keep_alive')
+                and time.monotonic() - self._created_at >= ttl):
+            raise ProgrammingError('Session no longer exists. New login required to access the service.',
+                                   errno=390111, sqlstate='08001')
+
+    def cursor(self):
+        if self._closed:
+            raise DatabaseError('Connection is closed')
+        return FakeCursor(self)
+
+    def get_query_status_throw_if_error(self, sfqid):
+        self.check_session()
+        with _async_lock:
+            query = _async_queries.get(sfqid)
+        if query is None:
+            raise ProgrammingError(f'Unknown query id: {sfqid}')
+        if query[2]:
+            raise ProgrammingError('SQL execution canceled', errno=604, sfqid=sfqid)
+        return QueryStatus.RUNNING if time.time() < query[1] else QueryStatus.SUCCESS
+
+    def execute_stream(self, stream, remove_comments=False, **kwargs):
+        for sql, _ in split_statements(stream, remove_comments=remove_comments):
+            cursor = self.cursor()
+            cursor.execute(sql)
+            yield cursor
+
+    def is_still_running(self, status):
+        return status == QueryStatus.RUNNING
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+def connect(**params):
+    _sleep_ms('FAKE_SF_CONNECT_MS')
+    return FakeConnection(**params)
@@ -0,0 +1,8 @@
+"""snowflake.connector.constants の代わり（非同期クエリの状態）"""
+from enum import Enum
+
+
+class QueryStatus(Enum):
+    RUNNING = 0
+    SUCCESS = 2
+    FAILED_WITH_ERROR = 3
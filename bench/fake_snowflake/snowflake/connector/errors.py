@@ -0,0 +1,22 @@
+"""snowflake.connector.errors の代わり（アプリが使う例外だけ）"""
+
+
+class Error(Exception):
+    def __init__(self, msg=None, errno=None, sqlstate=None, sfqid=None):
+        super().__init__(msg)
+        self.msg = msg
+        self.errno = errno
+        self.sqlstate = sqlstate
+        self.sfqid = sfqid
+
+
+class DatabaseError(Error):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class NotSupportedError(DatabaseError):
+    pass
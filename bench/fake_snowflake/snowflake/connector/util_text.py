@@ -0,0 +1,25 @@
+"""snowflake.connector.util_text の代わり（split_statements だけ）"""
+import re
+
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_PUT_GET_RE = re.compile(r'^\s*(PUT|GET)\b', re.IGNORECASE)
+
+
+def split_statements(buf, remove_comments=False):
+    """';' で文を分割し (文, PUT/GET かどうか) を返す（文字列リテラル内の ';' は区切りにしない）"""
+    text = buf.read()
+    if remove_comments:
+        text = _COMMENT_RE.sub('', text)
+    statement = []
+    in_quote = False
+    for ch in text:
+        statement.append(ch)
+        if ch == "'":
+            in_quote = not in_quote
+        elif ch == ';' and not in_quote:
+            sql = ''.join(statement).strip()
+            statement = []
+            yield sql, bool(_PUT_GET_RE.match(sql))
+    sql = ''.join(statement).strip()
+    if sql:
+        yield sql, bool(_PUT_GET_RE.match(sql))
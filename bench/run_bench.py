@@ -0,0 +1,282 @@
+"""Flask アプリのベンチマーク
+
+ローカルのOAuthサーバー（fake_oauth_server.py）と合成結果を返す snowflake.connector
+（fake_snowflake/）を使ってアプリを起動し、並行クライアントからログイン後に
+/, /dashboard, /execute_sql, /execute_batch を叩いてスループットと p50/p90/p99 を表示する。
+
+    python bench/run_bench.py --app python_web_app --concurrency 16 --requests 500
+    python bench/run_bench.py --app cognito --server gunicorn --sf-execute-ms 20
+    python bench/run_bench.py --server asgi --concurrency 200 --oauth-latency-ms 500   # ASGI 版（uvicorn）
+
+クライアントごとに別のセッションでログインするので、トークンはユーザーごとに保存される。
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from fake_oauth_server import start_server  # noqa: E402
+
+APPS = {
+    'python_web_app': os.path.join(REPO_ROOT, 'python_web_app'),
+    'cognito': os.path.join(REPO_ROOT, 'external_oauth', 'cognito', 'client_app'),
+}
+
+# アプリの終了を待つ時間（gunicorn は graceful_timeout（既定30秒）まで処理中のリクエストを待つ）
+STOP_TIMEOUT = 40
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def serve(app_dir, port):
+    """--serve: アプリをスレッド付きの Werkzeug サーバーで起動する（リローダーなし）"""
+    from werkzeug.serving import run_simple
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    import app as app_module
+    run_simple('127.0.0.1', port, app_module.create_app(), threaded=True)
+
+
+def stop_app(process):
+    """アプリを終了させる（STOP_TIMEOUT 秒で終わらなければ kill、待ちのタイムアウトは例外にしない）"""
+    process.terminate()
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        print(f'アプリが {STOP_TIMEOUT} 秒で終了しないので kill します', file=sys.stderr)
+        process.kill()
+        process.wait()
+
+
+def start_app(name, port, oauth_url, args):
+    env = dict(os.environ)
+    env.update({
+        # 合成結果を返す snowflake.connector を本物より先に読み込ませる
+        'PYTHONPATH': os.pathsep.join(filter(None, [os.path.join(BENCH_DIR, 'fake_snowflake'),
+                                                    env.get('PYTHONPATH')])),
+        'FLASK_SECRET_KEY': 'bench-secret',
+        'SNOWFLAKE_ACCOUNT_IDENTIFIER': 'bench',
+        'SNOWFLAKE_CLIENT_ID': 'bench-client',
+        'SNOWFLAKE_CLIENT_SECRET': 'bench-secret',
+        'SNOWFLAKE_OAUTH_BASE_URL': oauth_url,
+        'COGNITO_CLIENT_ID': 'bench-client',
+        'COGNITO_CLIENT_SECRET': 'bench-secret',
+        'COGNITO_BASE_URL': oauth_url,
+        'OAUTH_REDIRECT_URI': f'http://127.0.0.1:{port}/callback',
+        'REQUEST_LOG': 'false',
+        'FAKE_SF_CONNECT_MS': str(args.sf_connect_ms),
+        'FAKE_SF_EXECUTE_MS': str(args.sf_execute_ms),
+        'FAKE_SF_FETCH_MS': str(args.sf_fetch_ms),
+        'FAKE_SF_ROWS': str(args.rows),
+        'FAKE_SF_RESUME_MS': str(args.sf_resume_ms),
+        'SF_PREWARM_ON_LOGIN': str(args.prewarm or args.prewarm_resume).lower(),
+        'SF_PREWARM_RESUME_WAREHOUSE': str(args.prewarm_resume).lower(),
+    })
+    env.pop('USER_POOL_ID', None)
+    app_dir = APPS[name]
+    if args.token_store:
+        env['TOKEN_STORE_URL'] = args.token_store
+    if args.query_history:
+        # クエリ履歴を一時的な SQLite に記録する（記録の有無で /execute_sql の時間を比べる）
+        env['QUERY_HISTORY_DB'] = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'query_history.db')
+        print(f'query history: {env["QUERY_HISTORY_DB"]}')
+    if args.server == 'gunicorn':
+        env.update({'WEB_BIND': f'127.0.0.1:{port}', 'WEB_WORKERS': str(args.workers),
+                    'WEB_ACCESS_LOG': ''})
+        # ワーカー間でトークンを共有する（メモリだと別ワーカーに振られたリクエストが未ログインになる）
+        if not args.token_store:
+            env['TOKEN_STORE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-'), 'tokens.db')
+        command = [sys.executable, 'app.py', '--production']
+    elif args.server == 'asgi':
+        # ASGI 版（asgi_app.py、requirements-asgi.txt が必要）
+        command = [sys.executable, '-m', 'uvicorn', 'asgi_app:create_app', '--factory',
+                   '--host', '127.0.0.1', '--port', str(port), '--no-access-log']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--serve', app_dir, str(port)]
+    process = subprocess.Popen(command, cwd=app_dir, env=env,
+                               stdout=subprocess.DEVNULL if not args.verbose else None,
+                               stderr=subprocess.DEVNULL if not args.verbose else None)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{name} の起動に失敗しました（--verbose で出力を確認）')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    stop_app(process)
+    raise RuntimeError(f'{name} が起動しませんでした')
+
+
+def login(base_url, warehouse=''):
+    client = requests.Session()
+    response = client.post(f'{base_url}/login', data={'role': '', 'warehouse': warehouse}, timeout=30)
+    if not response.url.endswith('/dashboard'):
+        raise RuntimeError(f'ログインに失敗しました: {response.url}')
+    return client
+
+
+def _summary(latencies, errors, wall):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / wall if wall else None,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p90_ms': _percentile(latencies, 0.90) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def login_all(base_url, concurrency, warehouse=''):
+    """全クライアントが同時にログインし、ログイン（OAuth のリダイレクトとトークン取得）の時間を集計する"""
+    latencies = []
+
+    def timed_login(_):
+        started = time.perf_counter()
+        client = login(base_url, warehouse)
+        latencies.append(time.perf_counter() - started)
+        return client
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        clients = list(executor.map(timed_login, range(concurrency)))
+    return clients, _summary(latencies, 0, time.perf_counter() - started)
+
+
+def run_endpoint(clients, method, url, total, data=None):
+    """total 回のリクエストをクライアント数と同じ並列度で送り、結果を集計する"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker(client):
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            try:
+                response = client.request(method, url, data=data, timeout=60)
+                response.content  # ストリーミングの本文を最後まで読む
+                ok = response.status_code == 200 and not response.url.endswith('/login')
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as executor:
+        list(executor.map(worker, clients))
+    return _summary(latencies, errors[0], time.perf_counter() - started)
+
+
+def bench_app(name, oauth_url, args):
+    port = args.port or _free_port()
+    process = start_app(name, port, oauth_url, args)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        clients, login_result = login_all(base_url, args.concurrency, args.warehouse)
+        sql_form = {'sql_query': args.sql, 'warehouse': args.warehouse}
+        batch_form = {'sql_query': ';\n'.join([args.sql] * args.batch_statements), 'warehouse': args.warehouse,
+                      'batch_mode': 'parallel'}
+        # ログイン後の最初のクエリ（接続・Warehouse の再開を含む。以降のウォームアップを兼ねる）
+        time.sleep(args.think_ms / 1000)
+        first_result = run_endpoint(clients, 'POST', f'{base_url}/execute_sql', args.concurrency, sql_form)
+        results = {'login (OAuth)': login_result, 'first /execute_sql': first_result}
+        for label, method, path, data in [('GET /', 'GET', '/', None),
+                                          ('GET /dashboard', 'GET', '/dashboard', None),
+                                          ('POST /execute_sql', 'POST', '/execute_sql', sql_form),
+                                          ('POST /execute_batch', 'POST', '/execute_batch', batch_form)]:
+            results[label] = run_endpoint(clients, method, base_url + path, args.requests, data)
+        return results
+    finally:
+        # ベンチマーク中の例外を終了待ちのタイムアウトで隠さない
+        stop_app(process)
+
+
+def print_results(name, results):
+    print(f"\n== {name} ==")
+    print(f"{'endpoint':<20}{'req':>7}{'err':>6}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for label, r in results.items():
+        print(f"{label:<20}{r['requests']:>7}{r['errors']:>6}{r['rps']:>10.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p90_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['max_ms']:>10.2f}")
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--serve':
+        return serve(sys.argv[2], int(sys.argv[3]))
+
+    parser = argparse.ArgumentParser(description='Flask アプリのベンチマーク（ローカルOAuth + 合成Snowflake）')
+    parser.add_argument('--app', choices=['python_web_app', 'cognito', 'both'], default='both')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn', 'asgi'], default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn のワーカー数')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--token-store', help='TOKEN_STORE_URL（gunicorn では未指定時に一時的な SQLite を使う）')
+    parser.add_argument('--concurrency', type=int, default=8, help='並行クライアント数（=ログインユーザー数）')
+    parser.add_argument('--requests', type=int, default=200, help='エンドポイントごとのリクエスト数')
+    parser.add_argument('--sql', default='SELECT * FROM bench')
+    parser.add_argument('--rows', type=int, default=100, help='合成結果の行数')
+    parser.add_argument('--batch-statements', type=int, default=4, help='/execute_batch に送る文の数（並列モード）')
+    parser.add_argument('--oauth-latency-ms', type=float, default=20)
+    parser.add_argument('--expires-in', type=int, default=3600, help='発行するトークンの有効期限（秒）')
+    parser.add_argument('--sf-connect-ms', type=float, default=200)
+    parser.add_argument('--sf-execute-ms', type=float, default=10)
+    parser.add_argument('--sf-fetch-ms', type=float, default=1)
+    parser.add_argument('--sf-resume-ms', type=float, default=0, help='停止中の Warehouse の再開にかかる時間')
+    parser.add_argument('--warehouse', default='', help='ログイン時とクエリで指定する Warehouse')
+    parser.add_argument('--prewarm', action='store_true', help='ログイン直後に接続を開いておく（SF_PREWARM_ON_LOGIN）')
+    parser.add_argument('--prewarm-resume', action='store_true',
+                        help='--prewarm に加えて Warehouse も再開させる（SF_PREWARM_RESUME_WAREHOUSE）')
+    parser.add_argument('--query-history', action='store_true', help='クエリ履歴を記録する（QUERY_HISTORY_DB）')
+    parser.add_argument('--think-ms', type=float, default=0, help='ログインから最初のクエリまでの待ち時間')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--verbose', action='store_true', help='アプリの出力を表示する')
+    args = parser.parse_args()
+
+    server, state = start_server(latency=args.oauth_latency_ms / 1000, expires_in=args.expires_in)
+    oauth_url = f'http://127.0.0.1:{server.server_port}'
+    names = list(APPS) if args.app == 'both' else [args.app]
+    all_results = {}
+    try:
+        for name in names:
+            all_results[name] = bench_app(name, oauth_url, args)
+            print_results(name, all_results[name])
+    finally:
+        server.shutdown()
+    print(f"\nOAuth server: {json.dumps(state.counts)}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': all_results, 'oauth': state.counts}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
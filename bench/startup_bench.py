@@ -0,0 +1,164 @@
+"""ワーカーの起動時間（import app と create_app()）のベンチマーク
+
+アプリごとに新しいプロセスで `python -X importtime` を使って `import app; app.create_app()` を実行し、
+起動にかかった時間、時間のかかったモジュール（自身の import 時間の順）、
+起動時に読み込まれた重いライブラリ（初回利用まで遅らせているもの）を表示する。
+最後に、遅らせたライブラリを読み込む時間（最初のログイン・クエリで払うコスト）も測る。
+
+    python bench/startup_bench.py                        # 両方のアプリ
+    python bench/startup_bench.py --app cognito --repeat 10 --top 20
+    python bench/startup_bench.py --baseline HEAD~1      # 指定したコミットの状態と比べる
+
+Snowflake コネクタは既定で fake_snowflake/ を使う（--real-connector でインストール済みのものを使う）。
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+APPS = {
+    'python_web_app': 'python_web_app',
+    'cognito': os.path.join('external_oauth', 'cognito', 'client_app'),
+}
+
+# 初回利用まで読み込みを遅らせるライブラリ
+HEAVY_MODULES = ('snowflake.connector', 'pyarrow', 'pyarrow.compute', 'jose', 'authlib', 'requests')
+
+# 子プロセスで実行するコード（結果は stdout の最後の行に JSON で出す）
+_SNIPPET = '''
+import json, sys, time
+before = set(sys.modules)
+started = time.perf_counter()
+import app
+factory = getattr(app, 'create_app', None)
+if factory is not None:
+    factory()
+startup = time.perf_counter() - started
+loaded = [name for name in %(heavy)r if name in sys.modules]
+new_modules = sorted(set(sys.modules) - before)
+started = time.perf_counter()
+for name in %(heavy)r:
+    try:
+        __import__(name)
+    except ImportError:
+        pass
+deferred = time.perf_counter() - started
+print(json.dumps({'startup': startup, 'deferred': deferred, 'loaded': loaded, 'modules': new_modules}))
+''' % {'heavy': HEAVY_MODULES}
+
+
+def _parse_importtime(stderr, modules):
+    """-X importtime の出力から、起動時に読み込んだモジュールの (自身の時間, 累計) を取り出す"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace('import time:', '|').split('|'))
+        if name in modules:
+            times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def measure(app_dir, args):
+    env = dict(os.environ)
+    env.setdefault('FLASK_SECRET_KEY', 'bench-secret')
+    env['REQUEST_LOG'] = 'false'
+    env.pop('USER_POOL_ID', None)
+    if not args.real_connector:
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(BENCH_DIR, 'fake_snowflake'),
+                                                          env.get('PYTHONPATH')]))
+    runs = []
+    for _ in range(args.repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', _SNIPPET], cwd=app_dir,
+                                   env=env, capture_output=True, text=True, timeout=120)
+        if completed.returncode != 0:
+            raise RuntimeError(f'{app_dir} の起動に失敗しました:\n{completed.stderr[-2000:]}')
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['times'] = _parse_importtime(completed.stderr, set(result.pop('modules')))
+        runs.append(result)
+
+    # 中央値の回のモジュール別の時間を表示する
+    runs.sort(key=lambda r: r['startup'])
+    median_run = runs[len(runs) // 2]
+    top = sorted(median_run['times'].items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    return {
+        'startup_seconds': statistics.median(r['startup'] for r in runs),
+        'startup_min_seconds': runs[0]['startup'],
+        'deferred_seconds': statistics.median(r['deferred'] for r in runs),
+        'loaded_at_startup': median_run['loaded'],
+        'modules': len(median_run['times']),
+        'top': [{'module': name, 'self_ms': self_us / 1000, 'cumulative_ms': cumulative_us / 1000}
+                for name, (self_us, cumulative_us) in top],
+    }
+
+
+def export_tree(ref):
+    """コミット ref のツリーを一時ディレクトリに展開する"""
+    directory = tempfile.mkdtemp(prefix='startup-baseline-')
+    archive = os.path.join(directory, 'tree.tar')
+    subprocess.run(['git', 'archive', '--format=tar', '-o', archive, ref], cwd=REPO_ROOT, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(directory)
+    os.remove(archive)
+    return directory
+
+
+def print_result(name, label, result):
+    loaded = ', '.join(result['loaded_at_startup']) or '-'
+    print(f"{name} [{label}]: startup {result['startup_seconds'] * 1000:.1f}ms "
+          f"(min {result['startup_min_seconds'] * 1000:.1f}ms, {result['modules']} modules), "
+          f"deferred to first use {result['deferred_seconds'] * 1000:.1f}ms")
+    print(f"  heavy modules loaded at startup: {loaded}")
+    for item in result['top']:
+        print(f"  {item['self_ms']:8.1f}ms {item['cumulative_ms']:8.1f}ms  {item['module']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ワーカーの起動時間（import app と create_app()）を測る')
+    parser.add_argument('--app', choices=['both', *APPS], default='both')
+    parser.add_argument('--repeat', type=int, default=5, help='測定回数（中央値を表示する）')
+    parser.add_argument('--top', type=int, default=10, help='表示するモジュール数（自身の import 時間の順）')
+    parser.add_argument('--baseline', metavar='REF', help='比較するコミット（git archive で展開して測る）')
+    parser.add_argument('--real-connector', action='store_true',
+                        help='fake_snowflake ではなくインストール済みの snowflake-connector-python を使う')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    trees = [('current', REPO_ROOT)]
+    baseline_dir = None
+    if args.baseline:
+        baseline_dir = export_tree(args.baseline)
+        trees.insert(0, (args.baseline, baseline_dir))
+
+    results = {}
+    try:
+        for name in (list(APPS) if args.app == 'both' else [args.app]):
+            results[name] = {}
+            for label, root in trees:
+                result = measure(os.path.join(root, APPS[name]), args)
+                results[name][label] = result
+                print_result(name, label, result)
+            if baseline_dir:
+                before = results[name][args.baseline]['startup_seconds']
+                after = results[name]['current']['startup_seconds']
+                print(f"  => {(before - after) * 1000:+.1f}ms faster per worker ({after / before:.0%} of baseline)")
+            print()
+    finally:
+        if baseline_dir:
+            shutil.rmtree(baseline_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""python_web_app と external_oauth/cognito/client_app で共有するモジュール"""
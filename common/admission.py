@@ -0,0 +1,175 @@
+"""クエリの同時実行数の制御（利用者ごと・Warehouse ごと）
+
+同期実行のクエリは結果を送り終えるまでワーカーのスレッドを占有するので、
+1人の利用者が重いクエリを並べてもワーカーを使い切らないよう、実行前に枠を取る。
+枠が空いていなければ queue_timeout 秒まで待ち、待っているリクエスト数にも上限を設ける
+（待ちでスレッドを塞がないよう、上限を超えたら待たずに断る）。
+ASGI 版は acquire_async で待つので、待っている間もイベントループのスレッドを塞がない。
+非同期実行のクエリも Warehouse で実行中の間は枠を使う（try_acquire で待たずに取り、完了・取り消しで返す）。
+"""
+import asyncio
+import threading
+
+
+class AdmissionRejected(Exception):
+    """同時実行数の上限に達していて、待機時間内に枠が空かなかった"""
+
+
+class Ticket:
+    """取得した実行枠（release は何度呼んでもよい、with 文でも使える）"""
+    __slots__ = ('_controller', 'user', 'warehouse', '_released')
+
+    def __init__(self, controller, user, warehouse):
+        self._controller = controller
+        self.user = user
+        self.warehouse = warehouse
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdmissionController:
+    """利用者・Warehouse ごとの同時実行数の上限と待ち行列（0 は無制限）"""
+
+    def __init__(self, max_per_user=2, max_per_warehouse=8, max_queued=16, max_queued_per_user=2,
+                 queue_timeout=10):
+        self.max_per_user = max_per_user
+        self.max_per_warehouse = max_per_warehouse
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._running_users = {}       # 利用者 -> 実行中の数
+        self._running_warehouses = {}  # Warehouse -> 実行中の数
+        self._queued_users = {}        # 利用者 -> 待っている数
+        self._queued = 0
+        self._async_waiters = []       # acquire_async で待っている (イベントループ, Future)
+        self._counters = dict.fromkeys(('admitted_total', 'queued_total', 'rejected_total'), 0)
+
+    def _can_run_locked(self, user, warehouse):
+        return ((not self.max_per_user or self._running_users.get(user, 0) < self.max_per_user)
+                and (not self.max_per_warehouse
+                     or self._running_warehouses.get(warehouse, 0) < self.max_per_warehouse))
+
+    def _admit_locked(self, user, warehouse):
+        self._running_users[user] = self._running_users.get(user, 0) + 1
+        self._running_warehouses[warehouse] = self._running_warehouses.get(warehouse, 0) + 1
+        self._counters['admitted_total'] += 1
+        return Ticket(self, user, warehouse)
+
+    def _enqueue_locked(self, user):
+        if ((self.max_queued and self._queued >= self.max_queued)
+                or (self.max_queued_per_user
+                    and self._queued_users.get(user, 0) >= self.max_queued_per_user)):
+            self._counters['rejected_total'] += 1
+            raise AdmissionRejected('実行中のクエリが多すぎます。しばらくしてから再実行してください')
+        self._counters['queued_total'] += 1
+        self._queued += 1
+        self._queued_users[user] = self._queued_users.get(user, 0) + 1
+
+    def _dequeue_locked(self, user):
+        self._queued -= 1
+        self._queued_users[user] -= 1
+        if not self._queued_users[user]:
+            del self._queued_users[user]
+
+    def _timed_out_locked(self):
+        self._counters['rejected_total'] += 1
+        return AdmissionRejected(
+            f'{self.queue_timeout}秒待っても実行枠が空きませんでした（実行中のクエリの終了を待ってください）')
+
+    def acquire(self, user, warehouse=None):
+        """実行枠を取得して Ticket を返す（取れなければ AdmissionRejected）"""
+        warehouse = (warehouse or '').upper()
+        with self._cond:
+            if not self._can_run_locked(user, warehouse):
+                self._enqueue_locked(user)
+                try:
+                    admitted = self._cond.wait_for(lambda: self._can_run_locked(user, warehouse),
+                                                   self.queue_timeout)
+                finally:
+                    self._dequeue_locked(user)
+                if not admitted:
+                    raise self._timed_out_locked()
+            return self._admit_locked(user, warehouse)
+
+    def try_acquire(self, user, warehouse=None):
+        """実行枠が空いていれば Ticket を返す（待たずに AdmissionRejected、非同期クエリの投入用）"""
+        warehouse = (warehouse or '').upper()
+        with self._cond:
+            if not self._can_run_locked(user, warehouse):
+                self._counters['rejected_total'] += 1
+                raise AdmissionRejected('実行中のクエリが多すぎます。完了を待つか取り消してから再実行してください')
+            return self._admit_locked(user, warehouse)
+
+    async def acquire_async(self, user, warehouse=None):
+        """acquire の asyncio 版（枠が空くのをイベントループ上で待つ）"""
+        warehouse = (warehouse or '').upper()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        with self._cond:
+            if self._can_run_locked(user, warehouse):
+                return self._admit_locked(user, warehouse)
+            self._enqueue_locked(user)
+        waiter = None
+        try:
+            while True:
+                with self._cond:
+                    if self._can_run_locked(user, warehouse):
+                        return self._admit_locked(user, warehouse)
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise self._timed_out_locked()
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._dequeue_locked(user)
+                if waiter is not None and (loop, waiter) in self._async_waiters:
+                    self._async_waiters.remove((loop, waiter))
+
+    def _release(self, ticket):
+        with self._cond:
+            for running, key in ((self._running_users, ticket.user),
+                                 (self._running_warehouses, ticket.warehouse)):
+                running[key] -= 1
+                if not running[key]:
+                    del running[key]
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:  # イベントループが終了している
+                pass
+
+    def stats(self):
+        """監視用の実行中・待機中の数と累計値"""
+        with self._cond:
+            return {
+                'running': sum(self._running_users.values()),
+                'queued': self._queued,
+                'users': len(self._running_users),
+                'warehouses': dict(self._running_warehouses),
+                **self._counters,
+            }
@@ -0,0 +1,299 @@
+"""ASGI 版のアプリ（asgi_app.py）の共通部品
+
+ASGI 版は Flask アプリ（app.create_app()）と同じプロセスで動かし、次のものを共有する。
+
+- セッション Cookie: Flask と同じ署名・形式で読み書きするので、ログイン状態やフラッシュメッセージは
+  どちらで処理したリクエストでも引き継がれる。
+- テンプレート: Flask アプリの templates/ を Jinja の非同期モードで描画し、url_for は Flask の URL 規則で組み立てる。
+- その他の画面: ASGI 側にないパス（バッチ実行・エクスポート・/metrics 等）は WSGI として Flask アプリに渡す。
+
+Snowflake コネクタやトークンの保存先など、ブロックする処理は BlockingExecutor のスレッドで実行し、
+イベントループは止めない。starlette / a2wsgi は ASGI 版でだけ使う（requirements-asgi.txt）。
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+class BlockingExecutor:
+    """ブロックする処理を実行するスレッドプール（スレッド数が同時実行数の上限になる）
+
+    空きを待つ処理はスレッドではなくイベントループ上で待つ。
+    呼び出し元の contextvars（リクエストの段階の記録先）を引き継いで実行する。
+    """
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._running = 0
+        self._completed = 0
+
+    def _call(self, context, func, args):
+        with self._lock:
+            self._running += 1
+        try:
+            return context.run(func, *args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def submit(self, func, *args):
+        """func(*args) をスレッドで実行し、concurrent.futures.Future を返す"""
+        with self._lock:
+            self._submitted += 1
+        return self._executor.submit(self._call, contextvars.copy_context(), func, args)
+
+    async def run(self, func, *args):
+        """func(*args) をスレッドで実行して結果を待つ"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threads': self.max_workers,
+                'running': self._running,
+                'queued': self._submitted - self._completed - self._running,
+                'tasks_total': self._completed,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncResultStream:
+    """ResultStream をバッチごとに実行用スレッドで読み進める（テンプレートからは同じ属性で使える）"""
+
+    def __init__(self, stream, executor):
+        self._stream = stream
+        self._executor = executor
+        self._chunks = None
+        self._pending = None
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    async def html_chunks(self):
+        self._chunks = self._stream.html_chunks()
+        while True:
+            self._pending = self._executor.submit(next, self._chunks, None)
+            chunk = await asyncio.wrap_future(self._pending)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        """カーソルを閉じて接続をプールに返す（取得中のバッチがあれば、その取得が終わってから）"""
+        def close():
+            if self._chunks is not None:
+                self._chunks.close()
+            self._stream.close()
+
+        def submit_close(future=None):
+            try:
+                self._executor.submit(close)
+            except RuntimeError:  # 終了処理中（スレッドプールが停止済み）
+                close()
+
+        if self._pending is not None and not self._pending.done():
+            self._pending.add_done_callback(submit_close)
+        else:
+            submit_close()
+
+
+class Page:
+    """1リクエスト分のセッション・フラッシュメッセージと、レスポンスの作成"""
+
+    def __init__(self, bridge, request, session):
+        self.bridge = bridge
+        self.request = request
+        self.session = session
+        self._flashes = None
+
+    async def form(self):
+        return await self.request.form()
+
+    def flash(self, message, category='message'):
+        """Flask の flash と同じ形式でセッションに保存する"""
+        self.session['_flashes'] = self.session.get('_flashes', []) + [(category, message)]
+
+    def get_flashed_messages(self, with_categories=False, category_filter=()):
+        if self._flashes is None:
+            self._flashes = self.session.pop('_flashes', [])
+        flashes = self._flashes
+        if category_filter:
+            flashes = [flash for flash in flashes if flash[0] in category_filter]
+        return flashes if with_categories else [message for _, message in flashes]
+
+    def redirect(self, endpoint_or_url, **values):
+        """エンドポイント名（または URL）へリダイレクトする"""
+        from starlette.responses import RedirectResponse
+        url = endpoint_or_url if '/' in endpoint_or_url else self.bridge.url_for(endpoint_or_url, **values)
+        return RedirectResponse(url, status_code=302)
+
+    def _template(self, template_name, context):
+        context.setdefault('get_flashed_messages', self.get_flashed_messages)
+        for processor in self.bridge.context_processors:
+            for name, value in processor(self).items():
+                context.setdefault(name, value)
+        return self.bridge.jinja_env.get_template(template_name)
+
+    async def render(self, template_name, status=200, **context):
+        from starlette.responses import HTMLResponse
+        template = self._template(template_name, context)
+        with metrics.phase('render'):
+            body = await template.render_async(context)
+        return HTMLResponse(body, status_code=status)
+
+    def stream(self, template_name, on_close=(), headers=None, buffer_size=50, **context):
+        """テンプレートを少しずつ描画しながら送る（on_close は送信終了時・切断時に呼ぶ）"""
+        from starlette.responses import StreamingResponse
+        # フラッシュメッセージの取り出し（セッションの変更）を Cookie を送る前に済ませる
+        self.get_flashed_messages()
+        template = self._template(template_name, context)
+
+        async def generate():
+            # 描画時間は送信完了までの時間から、その間の fetch の時間を除いたもの
+            started = time.perf_counter()
+            fetched = metrics.phase_total('fetch')
+            buffer = []
+            try:
+                async for piece in template.generate_async(context):
+                    buffer.append(piece)
+                    if len(buffer) >= buffer_size:
+                        yield ''.join(buffer)
+                        buffer = []
+                if buffer:
+                    yield ''.join(buffer)
+            finally:
+                metrics.record_phase('render', time.perf_counter() - started
+                                     - (metrics.phase_total('fetch') - fetched))
+                for func in on_close:
+                    func()
+
+        return StreamingResponse(generate(), media_type='text/html; charset=utf-8', headers=headers)
+
+
+class FlaskBridge:
+    """Flask アプリとセッション Cookie・テンプレート・URL を共有する ASGI アプリを組み立てる"""
+
+    def __init__(self, flask_app, log_requests=True):
+        from jinja2 import Environment
+
+        self.flask_app = flask_app
+        self.log_requests = log_requests
+        self.routes = []
+        self.context_processors = []
+        self._serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self._url_adapter = flask_app.url_map.bind('localhost')
+
+        self.jinja_env = Environment(loader=flask_app.jinja_loader,
+                                     autoescape=flask_app.select_jinja_autoescape, enable_async=True)
+        self.jinja_env.globals['url_for'] = self.url_for
+        self.jinja_env.policies['json.dumps_function'] = flask_app.json.dumps
+
+    def context_processor(self, func):
+        """テンプレートに渡す値を func(page) で加える（Flask の context_processor に対応）"""
+        self.context_processors.append(func)
+        return func
+
+    def url_for(self, endpoint, **values):
+        return self._url_adapter.build(endpoint, values)
+
+    def _load_session(self, request):
+        from itsdangerous import BadSignature
+        cookie = request.cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+        try:
+            max_age = self.flask_app.permanent_session_lifetime.total_seconds()
+            return dict(self._serializer.loads(cookie, max_age=max_age))
+        except BadSignature:
+            return {}
+
+    def _save_session(self, page, original, response):
+        """セッションが変わっていれば Flask と同じ属性で Cookie を設定する"""
+        config = self.flask_app.config
+        name = config['SESSION_COOKIE_NAME']
+        path = config['SESSION_COOKIE_PATH'] or config['APPLICATION_ROOT']
+        domain = config['SESSION_COOKIE_DOMAIN'] or None
+        response.headers.append('Vary', 'Cookie')
+        if page.session == original:
+            return
+        if not page.session:
+            response.delete_cookie(name, path=path, domain=domain)
+            return
+        response.set_cookie(name, self._serializer.dumps(page.session), path=path, domain=domain,
+                            secure=config['SESSION_COOKIE_SECURE'],
+                            httponly=config['SESSION_COOKIE_HTTPONLY'],
+                            samesite=config['SESSION_COOKIE_SAMESITE'])
+
+    def _observe(self, endpoint, request, status, started, phases, notes, error=None):
+        metrics.observe_request(endpoint, request.method, request.url.path, status,
+                                time.perf_counter() - started, phases, error, self.log_requests, notes,
+                                metrics.request_observers(self.flask_app))
+
+    def route(self, path, methods=('GET',)):
+        """handler(page) を登録する（エンドポイント名は関数名、Flask 側と同じ名前にする）"""
+        def decorator(handler):
+            endpoint = handler.__name__
+
+            async def asgi_endpoint(request):
+                from starlette.background import BackgroundTask
+                from starlette.responses import StreamingResponse
+
+                phases, notes = metrics.begin_request()
+                started = time.perf_counter()
+                session = self._load_session(request)
+                page = Page(self, request, dict(session))
+                try:
+                    response = await handler(page)
+                except Exception as e:
+                    self._observe(endpoint, request, 500, started, phases, notes, e)
+                    raise
+                self._save_session(page, session, response)
+                if isinstance(response, StreamingResponse):
+                    # ストリーミングは送信が終わった後に記録する
+                    response.background = BackgroundTask(self._observe, endpoint, request,
+                                                         response.status_code, started, phases, notes)
+                else:
+                    self._observe(endpoint, request, response.status_code, started, phases, notes)
+                return response
+
+            from starlette.routing import Route
+            self.routes.append(Route(path, asgi_endpoint, methods=list(methods), name=endpoint))
+            return handler
+        return decorator
+
+    def asgi_app(self, wsgi_threads=32, on_startup=(), on_shutdown=()):
+        """登録したルートと、それ以外を Flask アプリに渡す ASGI アプリを作る"""
+        from contextlib import asynccontextmanager
+
+        from a2wsgi import WSGIMiddleware
+        from starlette.applications import Starlette
+        from starlette.routing import Mount
+
+        @asynccontextmanager
+        async def lifespan(app):
+            for func in on_startup:
+                func()
+            try:
+                yield
+            finally:
+                for func in on_shutdown:
+                    try:
+                        result = func()
+                        if asyncio.iscoroutine(result):
+                            await result
+                    except Exception as e:
+                        print(f"Shutdown error: {str(e)}")
+
+        routes = self.routes + [Mount('/', app=WSGIMiddleware(self.flask_app, workers=wsgi_threads))]
+        return Starlette(routes=routes, lifespan=lifespan)
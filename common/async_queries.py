@@ -0,0 +1,289 @@
+"""非同期クエリ実行（execute_async + クエリIDでのポーリング）
+
+長時間クエリの間 Flask のワーカーを塞がないよう、投入したらすぐに
+クエリIDを返し、状態確認と結果取得は別リクエストで行う。
+保存先（token_backends）を渡すと、ジョブを他のワーカーからも参照できるように保存する
+（ポーリングが投入したのと別のワーカーに届いてもよい）。件数の上限はプロセスごとに数える。
+admission（AdmissionController）を渡すと、実行中のクエリは同期実行と同じ利用者・Warehouse の枠を使う。
+枠は完了・取り消し・タイムアウトで返す（別のワーカーで完了を確認したものは保存先から読み直して返す）。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from .admission import AdmissionRejected
+from .sf_pool import is_session_expired
+
+# Snowflake のクエリIDは UUID 形式（result_scan に埋め込まれるので形式を必ず検証する）
+_QUERY_ID_RE = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+def is_valid_query_id(query_id):
+    return bool(_QUERY_ID_RE.match(query_id or ''))
+
+
+class AsyncQueryLimitExceeded(Exception):
+    """未完了の非同期クエリが上限に達していて、新しいクエリを投入できない"""
+
+
+class AsyncQueryJob:
+    """投入済みの非同期クエリ"""
+    __slots__ = ('query_id', 'sql', 'role', 'warehouse', 'owner', 'submitted_at',
+                 'status', 'error', 'finished_at')
+
+    def __init__(self, query_id, sql, role=None, warehouse=None, owner=None):
+        self.query_id = query_id
+        self.sql = sql
+        self.role = role
+        self.warehouse = warehouse
+        self.owner = owner
+        self.submitted_at = time.time()
+        self.status = 'QUEUED'
+        self.error = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def to_record(self):
+        """保存先に置く内容（クエリIDを知っていても owner が一致しなければ get で返さない）"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_record(cls, record):
+        job = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(job, name, record.get(name))
+        return job
+
+    def to_dict(self):
+        return {
+            'query_id': self.query_id,
+            'status': self.status,
+            'done': self.done,
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'elapsed': (self.finished_at or time.time()) - self.submitted_at,
+        }
+
+
+class AsyncQueryRegistry:
+    """投入した非同期クエリの一覧
+
+    保持期間を過ぎたものと、件数上限（全体・利用者ごと）を超えた分の完了済みのものから捨てる。
+    未完了のクエリは捨てず、上限に達していれば新しいクエリを断る（他の利用者のジョブは押し出さない）。
+    """
+
+    def __init__(self, max_jobs=1000, max_jobs_per_owner=20, ttl=86400, backend=None, admission=None):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_owner = max_jobs_per_owner
+        self.ttl = ttl  # Snowflake が結果を保持する24時間に合わせる
+        self.backend = backend  # 複数ワーカーで共有する保存先（None ならこのプロセスだけ）
+        self.admission = admission  # 実行中のクエリに枠を取る AdmissionController（None なら取らない）
+        self._jobs = OrderedDict()
+        self._tickets = {}  # クエリID -> (このプロセスで取った実行枠, 返す期限)
+        self._lock = threading.Lock()
+
+    def _save(self, job):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(job.query_id, job.to_record(), job.submitted_at + self.ttl)
+        except Exception as e:
+            print(f"Async query save error: {str(e)}")
+
+    def _load(self, query_id):
+        if self.backend is None:
+            return None
+        try:
+            record = self.backend.get(query_id)
+        except Exception as e:
+            print(f"Async query load error: {str(e)}")
+            return None
+        return AsyncQueryJob.from_record(record) if record else None
+
+    def _release_locked(self, query_id):
+        entry = self._tickets.pop(query_id, None)
+        if entry:
+            entry[0].release()
+
+    def _settle(self, job):
+        """完了・取り消したジョブの実行枠を返す"""
+        with self._lock:
+            self._release_locked(job.query_id)
+
+    def _reconcile(self, owner):
+        """枠を持ったままのジョブのうち、期限切れ・別のワーカーで完了（取り消し）を確認したものの枠を返す"""
+        now = time.time()
+        with self._lock:
+            held = [(query_id, self._jobs.get(query_id), deadline)
+                    for query_id, (ticket, deadline) in self._tickets.items()]
+        for query_id, job, deadline in held:
+            if job is not None and job.owner != owner and now < deadline:
+                continue
+            if job is not None and not job.done and now < deadline:
+                record = self._load(query_id)
+                if record is None or not (record.done or record.status == 'ABORTING'):
+                    continue
+                job.status, job.error, job.finished_at = record.status, record.error, record.finished_at
+            with self._lock:
+                self._release_locked(query_id)
+
+    def _owned_locked(self, owner):
+        return [job for job in self._jobs.values() if job.owner == owner]
+
+    def _prune_locked(self, now, owner=None):
+        # 投入順に並んでいるので、保持期間を過ぎたものは先頭から捨てる
+        while self._jobs and now - next(iter(self._jobs.values())).submitted_at >= self.ttl:
+            query_id, _ = self._jobs.popitem(last=False)
+            self._release_locked(query_id)
+        # 新しいクエリの分を空けるため、上限を超える分の完了済みのジョブを古い順に捨てる
+        for jobs, limit in ((self._owned_locked(owner), self.max_jobs_per_owner),
+                            (list(self._jobs.values()), self.max_jobs)):
+            excess = len(jobs) - limit + 1
+            for job in jobs:
+                if excess <= 0:
+                    break
+                if job.done:
+                    del self._jobs[job.query_id]
+                    excess -= 1
+
+    def _check_capacity(self, pool, access_token, owner):
+        """新しいクエリを受け付けられるか確認する（上限なら AsyncQueryLimitExceeded）"""
+        with self._lock:
+            self._prune_locked(time.time(), owner)
+            pending = [job for job in self._owned_locked(owner) if not job.done]
+            full = len(self._owned_locked(owner)) >= self.max_jobs_per_owner
+        if full:
+            # 状態を確認しないまま離れたクエリも枠を使うので、問い合わせて完了したものを空ける
+            for job in pending:
+                try:
+                    self.refresh_status(pool, access_token, job)
+                except Exception as e:
+                    print(f"Async query status error: {str(e)}")
+        with self._lock:
+            self._prune_locked(time.time(), owner)
+            if len(self._owned_locked(owner)) >= self.max_jobs_per_owner:
+                raise AsyncQueryLimitExceeded(
+                    f'実行中の非同期クエリが上限（{self.max_jobs_per_owner}件）に達しています。完了を待つか取り消してください')
+            if len(self._jobs) >= self.max_jobs:
+                raise AsyncQueryLimitExceeded('実行中の非同期クエリが多すぎます。しばらくしてから再実行してください')
+
+    def _admit(self, pool, access_token, owner, user, warehouse):
+        """実行枠を待たずに取る（取れなければ AdmissionRejected）"""
+        if self.admission is None:
+            return None
+        try:
+            return self.admission.try_acquire(user, warehouse)
+        except AdmissionRejected:
+            pass
+        # 状態を確認しないまま離れたクエリも枠を使うので、完了したものの枠を返してから取り直す
+        self._reconcile(owner)
+        with self._lock:
+            pending = [self._jobs[query_id] for query_id in self._tickets
+                       if query_id in self._jobs and self._jobs[query_id].owner == owner]
+        for job in pending:
+            try:
+                self.refresh_status(pool, access_token, job)
+            except Exception as e:
+                print(f"Async query status error: {str(e)}")
+        return self.admission.try_acquire(user, warehouse)
+
+    def submit(self, pool, access_token, sql, role=None, warehouse=None, owner=None, timeout=0, user=None):
+        """クエリを非同期で投入し、完了を待たずにジョブを返す
+
+        timeout（秒）を指定すると、この文だけ STATEMENT_TIMEOUT_IN_SECONDS を変える
+        （同期実行向けのセッションのタイムアウトより長い時間を許す）。
+        user は実行枠を数える利用者（省略時は owner）。枠が空いていなければ AdmissionRejected。
+        """
+        self._check_capacity(pool, access_token, owner)
+        ticket = self._admit(pool, access_token, owner, user or owner, warehouse)
+        statement_params = {'STATEMENT_TIMEOUT_IN_SECONDS': timeout} if timeout else None
+
+        def execute_async(conn):
+            cursor = conn.cursor()
+            try:
+                cursor.execute_async(sql, _statement_params=statement_params)
+                return cursor.sfqid
+            finally:
+                cursor.close()
+
+        try:
+            query_id = pool.run(access_token, execute_async, role=role, warehouse=warehouse)
+        except BaseException:
+            if ticket is not None:
+                ticket.release()
+            raise
+
+        job = AsyncQueryJob(query_id, sql, role=role, warehouse=warehouse, owner=owner)
+        with self._lock:
+            self._jobs[query_id] = job
+            if ticket is not None:
+                # STATEMENT_TIMEOUT を過ぎれば Snowflake が止めるので、ポーリングされなくても枠を返す
+                self._tickets[query_id] = (ticket, job.submitted_at + (timeout or self.ttl))
+        self._save(job)
+        return job
+
+    def get(self, query_id, owner=None):
+        """ジョブを取得（別ユーザーのジョブ・未知のIDは None）"""
+        if not is_valid_query_id(query_id):
+            return None
+        with self._lock:
+            job = self._jobs.get(query_id)
+        if job is None:
+            # 他のワーカーで投入したジョブ（このプロセスの件数上限には数えない）
+            job = self._load(query_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def cancel(self, pool, access_token, job):
+        """実行中のクエリを SYSTEM$CANCEL_QUERY で取り消す（完了済みなら何もしない）
+
+        取り消しの結果（FAILED_WITH_ERROR）は次の refresh_status で反映される。
+        """
+        if job.done:
+            return job
+
+        def cancel_query(conn):
+            cursor = conn.cursor()
+            try:
+                cursor.execute('SELECT SYSTEM$CANCEL_QUERY(%s)', (job.query_id,))
+            finally:
+                cursor.close()
+
+        pool.run(access_token, cancel_query, role=job.role, warehouse=job.warehouse)
+        job.status = 'ABORTING'
+        self._save(job)
+        self._settle(job)
+        return job
+
+    def refresh_status(self, pool, access_token, job):
+        """Snowflake に状態を問い合わせてジョブを更新する（完了済みなら問い合わせない）"""
+        if job.done:
+            return job
+        from snowflake.connector.errors import ProgrammingError
+
+        def update(conn):
+            try:
+                status = conn.get_query_status_throw_if_error(job.query_id)
+            except ProgrammingError as e:
+                if is_session_expired(e):
+                    raise  # クエリの失敗ではないので、接続し直して問い合わせ直す
+                job.status = 'FAILED_WITH_ERROR'
+                job.error = e.msg or str(e)
+                job.finished_at = time.time()
+                return
+            job.status = status.name
+            if not conn.is_still_running(status):
+                if status.name != 'SUCCESS' and not job.error:
+                    job.error = f'クエリは {status.name} で終了しました'
+                job.finished_at = time.time()
+
+        pool.run(access_token, update, role=job.role, warehouse=job.warehouse)
+        if job.done:
+            self._save(job)
+            self._settle(job)
+        return job
@@ -0,0 +1,147 @@
+"""列指向（Arrow）での結果の保持と、列単位の型に応じた整形
+
+Snowflake の結果は Arrow バッチ（fetch_arrow_batches）で受け取れるので、
+Decimal・datetime・str の行タプルを作らずに pyarrow.Table のまま保持・描画する。
+表示用の文字列化とHTMLエスケープは pyarrow.compute で列ごとにまとめて行う。
+Arrow 形式で受け取れない結果（SHOW 等）や pyarrow がない環境では行タプルを使う。
+pyarrow は読み込みに時間がかかるので、初めて結果を取得するときに読み込む（load_pyarrow）。
+"""
+import sys
+
+_pyarrow = None  # 読み込み済みの pyarrow（pyarrow がなければ False）
+
+# markupsafe.escape と同じ置換（& を最初に置換する）
+_HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&#34;'), ("'", '&#39;'))
+
+
+def load_pyarrow():
+    """pyarrow を読み込んで返す（pyarrow がなければ None）"""
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.compute  # noqa: F401
+            _pyarrow = pyarrow
+        except ImportError:  # pyarrow は snowflake-connector-python[pandas] で入る
+            _pyarrow = False
+    return _pyarrow or None
+
+
+def fetch_arrow_batches(cursor):
+    """Arrow バッチ（pyarrow.Table）のイテレータ。Arrow で取れない結果なら None"""
+    if load_pyarrow() is None:
+        return None
+    # カーソルがあればコネクタは読み込み済み
+    from snowflake.connector.errors import NotSupportedError, ProgrammingError
+    try:
+        return cursor.fetch_arrow_batches()
+    except (NotSupportedError, ProgrammingError):
+        return None
+
+
+def is_table(value):
+    # pyarrow を読み込んでいなければ Table はない（判定のために読み込まない）
+    pa = sys.modules.get('pyarrow')
+    return pa is not None and isinstance(value, pa.Table)
+
+
+def normalize_table(table):
+    """チャンクごとに幅が変わる整数列を int64 に揃える（連結・IPC/Parquet はスキーマ固定のため）"""
+    pa = load_pyarrow()
+    fields = [pa.field(f.name, pa.int64(), f.nullable) if pa.types.is_integer(f.type) else f
+              for f in table.schema]
+    schema = pa.schema(fields)
+    return table if schema.equals(table.schema) else table.cast(schema)
+
+
+def concat_tables(tables):
+    """バッチを1つの Table にまとめる（スキーマは最初のバッチに揃える）"""
+    pa = load_pyarrow()
+    tables = [normalize_table(table) for table in tables]
+    schema = tables[0].schema
+    return pa.concat_tables([table if table.schema.equals(schema) else table.cast(schema)
+                             for table in tables])
+
+
+def read_table(tables, max_rows=0):
+    """Arrow バッチを max_rows 行まで読んで (Table, 打ち切ったか) を返す（行がなければ ([], False)）"""
+    collected = []
+    count = 0
+    for table in tables:
+        if max_rows and count >= max_rows:
+            if table.num_rows:
+                return concat_tables(collected), True
+            continue
+        if max_rows and count + table.num_rows > max_rows:
+            collected.append(table.slice(0, max_rows - count))
+            return concat_tables(collected), True
+        collected.append(table)
+        count += table.num_rows
+    return (concat_tables(collected) if collected else []), False
+
+
+def table_rows(table):
+    """Table を行タプルのリストにする（行単位の処理が必要な場合だけ使う）"""
+    return list(zip(*[column.to_pylist() for column in table.columns]))
+
+
+def _float_strings(pa, column):
+    """浮動小数点数を str(float) と同じ表記にする（整数値は '1.0'、Arrow の cast では '1'）"""
+    pc = pa.compute
+    strings = pc.cast(column, pa.string())
+    integral = pc.match_substring_regex(strings, r'^-?[0-9]+$')
+    strings = pc.if_else(integral, pc.binary_join_element_wise(strings, '.0', ''), strings)
+    # 指数表記に切り替わる桁が Python と違うので、その範囲の値だけ str() で作り直す
+    magnitude = pc.abs(column)
+    exponential = pc.or_(pc.match_substring(strings, 'e'),
+                         pc.or_(pc.greater_equal(magnitude, 1e16),
+                                pc.and_(pc.greater(magnitude, 0), pc.less(magnitude, 1e-4))))
+    exponential = pc.fill_null(exponential, False)
+    if pc.any(exponential).as_py():
+        rewritten = [str(value) for value in pc.filter(column, exponential).to_pylist()]
+        strings = pc.replace_with_mask(strings, exponential, pa.array(rewritten, pa.string()))
+    return strings
+
+
+def _timestamp_strings(pa, column):
+    """タイムゾーンなしの日時を str(datetime) と同じ表記にする
+
+    Python の datetime はマイクロ秒までなので切り捨て、端数がなければ小数部を付けない
+    （Arrow の cast では単位に合わせて '.000000000' まで付く）。
+    """
+    pc = pa.compute
+    micros = pc.cast(pc.floor_temporal(column, unit='microsecond'), pa.timestamp('us'))
+    seconds = pc.floor_temporal(micros, unit='second')
+    fraction = pc.subtract(pc.cast(micros, pa.int64()), pc.cast(seconds, pa.int64()))
+    padded = pc.utf8_lpad(pc.cast(fraction, pa.string()), width=6, padding='0')
+    suffix = pc.if_else(pc.equal(fraction, 0), '', pc.binary_join_element_wise('.', padded, ''))
+    return pc.binary_join_element_wise(pc.strftime(pc.cast(seconds, pa.timestamp('s')),
+                                                   format='%Y-%m-%d %H:%M:%S'), suffix, '')
+
+
+def html_column(column):
+    """列を表示用のエスケープ済み文字列のリストにする（NULL は 'NULL'）
+
+    型ごとにまとめて変換し、行タプルの場合（str(値)）と同じ表記にする。
+    対応していない型（バイナリ・入れ子型・タイムゾーン付きの日時・時刻等）は None を返す。
+    """
+    pa = load_pyarrow()
+    pc = pa.compute
+    column_type = column.type
+    # 数値・日付・日時の文字列表現には HTML の特殊文字が含まれないのでエスケープしない
+    if pa.types.is_string(column_type) or pa.types.is_large_string(column_type):
+        for old, new in _HTML_ESCAPES:
+            column = pc.replace_substring(column, old, new)
+    elif pa.types.is_boolean(column_type):
+        column = pc.if_else(column, 'True', 'False')
+    elif pa.types.is_floating(column_type):
+        column = _float_strings(pa, column)
+    elif pa.types.is_timestamp(column_type) and column_type.tz is None:
+        column = _timestamp_strings(pa, column)
+    elif pa.types.is_integer(column_type) or pa.types.is_decimal(column_type) or pa.types.is_date(column_type):
+        column = pc.cast(column, pa.string())
+    elif pa.types.is_null(column_type):
+        return ['NULL'] * len(column)
+    else:
+        return None
+    return pc.fill_null(column, 'NULL').to_pylist()
@@ -0,0 +1,390 @@
+"""メトリクス（Prometheus テキスト形式）とリクエストの処理時間の記録
+
+/execute_sql 等の処理を段階（phase）ごとに計測し、リクエスト終了時に
+ヒストグラムへ記録して1行のJSONログを出す。段階の例:
+
+- token:   セッションのトークン取得（期限切れ間近ならリフレッシュを含む）
+- refresh: トークンエンドポイントでのリフレッシュ（バックグラウンド更新も含む）
+- jwt:     JWT の署名検証（Cognito アプリ、検証済みトークンはキャッシュから返る）
+- connect: プールからの接続取得（新規接続の場合はログインを含む）
+- execute: クエリの実行（cursor.execute / get_results_from_sfqid）
+- fetch:   結果の取得（fetchmany）
+- render:  テンプレートの描画と送信（fetch の時間を除く）
+
+Warehouse は接続パラメータで指定しているので USE WAREHOUSE の段階はない。
+prometheus_client には依存せず、必要な分だけをここで実装する。
+ASGI 版（asgi.py）のリクエストでは段階を Flask の g ではなく contextvars に記録する。
+リクエストに annotate() で付けた値は、init_app() の observers に渡した関数にリクエスト終了時に渡す
+（クエリ履歴の記録に使う）。
+ヒストグラム・カウンターはプロセスで1つ（REGISTRY）、接続プール等の collector と observer は
+アプリごと（app.extensions['metrics']）に持つので、create_app() を複数回呼んでも重複しない。
+"""
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}  # labels -> [バケットごとの件数, 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        labelnames = self.labelnames + ('le',)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_format_labels(labelnames, key + (_format_value(bound),))} '
+                                 f'{cumulative}')
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """メトリクスの一覧。collector は描画のたびに呼ばれ、その時点の値を返す"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix, func, labelname=None):
+        """func() が返す {名前: 数値}（labelname 指定時は {ラベル値: {名前: 数値}}）を出力する
+
+        名前が _total で終わるものは counter、それ以外は gauge として出力する。
+        """
+        self._collectors.append((prefix, func, labelname))
+
+    def _render_collector(self, prefix, func, labelname):
+        try:
+            values = func()
+        except Exception as e:
+            print(f"Metrics collector error ({prefix}): {str(e)}")
+            return []
+        rows = [(label, stats) for label, stats in values.items()] if labelname else [(None, values)]
+        samples = {}
+        for label, stats in rows:
+            for name, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                labels = _format_labels((labelname,), (label,)) if labelname else ''
+                samples.setdefault(f'{prefix}_{name}', []).append(f'{labels} {_format_value(value)}')
+        lines = []
+        for name, metric_samples in samples.items():
+            metric_type = 'counter' if name.endswith('_total') else 'gauge'
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(f'{name}{sample}' for sample in metric_samples)
+        return lines
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, func, labelname in self._collectors:
+            lines.extend(self._render_collector(prefix, func, labelname))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram(
+    'app_request_duration_seconds', 'リクエストの処理時間（ストリーミング送信を含む）',
+    ('endpoint', 'method', 'status'))
+PHASE_SECONDS = REGISTRY.histogram(
+    'app_phase_duration_seconds', 'リクエスト内の段階ごとの処理時間', ('endpoint', 'phase'))
+TOKEN_REFRESH_TOTAL = REGISTRY.counter(
+    'app_token_refresh_total', 'トークンエンドポイントでのリフレッシュ回数', ('result',))
+
+# ASGI 版のリクエストの段階ごとの処理時間と annotate() の値（実行用スレッドにはコンテキストごと引き継ぐ）
+_request_phases = contextvars.ContextVar('request_phases', default=None)
+_request_notes = contextvars.ContextVar('request_notes', default=None)
+
+def _current_phases():
+    if has_request_context() and 'phases' in g:
+        return g.phases
+    return _request_phases.get()
+
+
+def _current_notes():
+    if has_request_context() and 'notes' in g:
+        return g.notes
+    return _request_notes.get()
+
+
+def annotate(name, value):
+    """現在のリクエストに値を付ける（リクエスト終了時に observer へ渡す、リクエスト外では何もしない）"""
+    notes = _current_notes()
+    if notes is not None:
+        notes[name] = value
+
+
+def annotate_append(name, value):
+    """現在のリクエストの値のリストに value を追加する（1リクエストで複数のクエリを記録する場合）"""
+    notes = _current_notes()
+    if notes is not None:
+        notes.setdefault(name, []).append(value)
+
+
+def record_phase(name, seconds):
+    """段階の処理時間を記録する（リクエスト外ではその場でヒストグラムに記録）"""
+    phases = _current_phases()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+    else:
+        PHASE_SECONDS.observe(seconds, endpoint='background', phase=name)
+
+
+def phase_total(name):
+    """現在のリクエストで記録済みの段階の合計時間"""
+    phases = _current_phases()
+    return phases.get(name, 0.0) if phases is not None else 0.0
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def track_refresh(refresh_func):
+    """リフレッシュ関数を包み、処理時間と成否を記録する"""
+    def wrapper(refresh_token):
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            token_data = refresh_func(refresh_token)
+            result = 'success' if token_data else 'failure'
+            return token_data
+        finally:
+            record_phase('refresh', time.perf_counter() - started)
+            TOKEN_REFRESH_TOTAL.inc(result=result)
+    return wrapper
+
+
+def track_refresh_async(refresh_func):
+    """track_refresh のコルーチン版（ASGI 版のリフレッシュ用）"""
+    async def wrapper(refresh_token):
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            token_data = await refresh_func(refresh_token)
+            result = 'success' if token_data else 'failure'
+            return token_data
+        finally:
+            record_phase('refresh', time.perf_counter() - started)
+            TOKEN_REFRESH_TOTAL.inc(result=result)
+    return wrapper
+
+
+def begin_request():
+    """ASGI 版のリクエストの計測を始め、段階と annotate() の値を記録する dict を返す"""
+    phases = {}
+    notes = {}
+    _request_phases.set(phases)
+    _request_notes.set(notes)
+    return phases, notes
+
+
+def observe_request(endpoint, method, path, status, duration, phases, error=None, log=True, notes=None,
+                    observers=()):
+    """リクエストの処理時間と段階をヒストグラムに記録し、1行のJSONログを出す
+
+    observers の各関数を observer(endpoint, status, duration, phases, notes) で呼ぶ。
+    """
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint, method=method, status=status)
+    for name, seconds in phases.items():
+        PHASE_SECONDS.observe(seconds, endpoint=endpoint, phase=name)
+    for observer in observers:
+        try:
+            observer(endpoint, status, duration, phases, notes or {})
+        except Exception as e:
+            print(f"Request observer error: {str(e)}")
+    if log and endpoint != 'metrics':
+        print(json.dumps({
+            'ts': round(time.time(), 3),
+            'method': method,
+            'path': path,
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 1),
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in phases.items()},
+            'error': str(error) if error else None,
+        }, ensure_ascii=False), flush=True)
+
+
+def init_app(app, pool=None, refresher=None, oauth_http=None, query_cache=None, admission=None,
+             prewarmer=None, query_history=None, log_requests=True):
+    """リクエストの計測・JSONログ・/metrics エンドポイントを登録する
+
+    collector と observer はこのアプリの app.extensions['metrics'] に持つ（別のアプリのものは出力しない）。
+    """
+    registry = Registry()
+    observers = []
+    app.extensions['metrics'] = {'registry': registry, 'observers': observers}
+    if pool is not None:
+        registry.add_collector('app_sf_pool', pool.stats)
+    if admission is not None:
+        registry.add_collector('app_admission', admission.stats)
+    if refresher is not None:
+        registry.add_collector('app_token_refresher', lambda: _refresher_stats(refresher.state()))
+    if oauth_http is not None:
+        registry.add_collector('app_oauth_http', lambda: _oauth_http_stats(oauth_http.stats()),
+                               labelname='endpoint')
+    if query_cache is not None:
+        registry.add_collector('app_query_cache', lambda: _query_cache_stats(query_cache.stats()))
+    if prewarmer is not None:
+        registry.add_collector('app_sf_prewarm', prewarmer.stats)
+    if query_history is not None:
+        registry.add_collector('app_query_history', query_history.stats)
+        observers.append(query_history.observe)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.phases = {}
+        g.notes = {}
+
+    @app.after_request
+    def record_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_timer(error=None):
+        # ストリーミングレスポンスでは送信が終わった後に呼ばれる
+        if 'request_started' not in g:
+            return
+        observe_request(request.endpoint or 'unknown', request.method, request.path,
+                        g.get('response_status', 500), time.perf_counter() - g.request_started,
+                        g.phases, error, log_requests, g.notes, observers)
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus テキスト形式のメトリクス"""
+        return Response(REGISTRY.render() + registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def request_observers(app):
+    """init_app() で登録したアプリの observer（ASGI 版のリクエストの記録に使う）"""
+    return app.extensions.get('metrics', {}).get('observers', ())
+
+
+def init_asgi(app, oauth_http=None, executors=()):
+    """ASGI 版の非同期HTTPクライアントと実行用スレッドプールの状態を app の /metrics に加える"""
+    registry = app.extensions['metrics']['registry']
+    if oauth_http is not None:
+        registry.add_collector('app_oauth_http_async', lambda: _oauth_http_stats(oauth_http.stats()),
+                               labelname='endpoint')
+    if executors:
+        registry.add_collector('app_executor', lambda: {executor.name: executor.stats() for executor in executors},
+                               labelname='executor')
+
+
+def _refresher_stats(state):
+    return {
+        'running': state['running'],
+        'leader': state.get('leader', False),
+        'tracked_tokens': state.get('tracked_tokens', 0),
+        'consecutive_failures': state['consecutive_failures'],
+        'refreshes_total': state['refresh_count'],
+        'failures_total': state['failure_count'],
+        'next_refresh_timestamp_seconds': state['next_refresh_at'],
+    }
+
+
+def _oauth_http_stats(stats):
+    return {endpoint: {
+        'requests_total': values['count'],
+        'errors_total': values['errors'],
+        'retries_total': values['retries'],
+        'p50_seconds': values['p50_seconds'],
+        'p95_seconds': values['p95_seconds'],
+        'max_seconds': values['max_seconds'],
+    } for endpoint, values in stats.items()}
+
+
+def _query_cache_stats(stats):
+    return {
+        'entries': stats['entries'],
+        'cells': stats['cells'],
+        'hits_total': stats['hits'],
+        'misses_total': stats['misses'],
+    }
@@ -0,0 +1,216 @@
+"""トークンエンドポイント向けの共有HTTPクライアント
+
+requests.Session を使い回して Keep-Alive で接続を再利用し、接続・読み取りの
+タイムアウトと回数制限付きのリトライ（指数バックオフ）を設定する。
+POST（トークンの発行・リフレッシュ）は送信前の接続エラーだけを再送し、5xx/429 は再送しない
+（authorization_code やローテーションする refresh_token はサーバー側で使用済みかもしれないため）。
+5xx/429 を再送するのは GET（JWKS 等）だけで、Retry-After は読み取りタイムアウトまでに抑える。
+エンドポイント（URLのパス）ごとに応答時間を記録する。
+requests はワーカーの起動を遅くしないよう、初めてリクエストを送るときに読み込む。
+ASGI 版では同じリトライ条件の AsyncOAuthHTTPClient（httpx.AsyncClient）を使う。
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class _EndpointStats:
+    __slots__ = ('count', 'errors', 'retries', 'total', 'max', 'recent')
+
+    def __init__(self, window):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)  # 直近の応答時間（パーセンタイル計算用）
+
+    def to_dict(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(len(recent) * p))] if recent else None
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_seconds': self.total / self.count if self.count else None,
+            'p50_seconds': percentile(0.5),
+            'p95_seconds': percentile(0.95),
+            'max_seconds': self.max,
+        }
+
+
+class _StatsRecorder:
+    """エンドポイントごとの件数・エラー数・リトライ数・応答時間の集計"""
+
+    def __init__(self, stats_window):
+        self.stats_window = stats_window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _record(self, endpoint, elapsed, failed, retries=0):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = _EndpointStats(self.stats_window)
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.recent.append(elapsed)
+            stats.errors += failed
+            stats.retries += retries
+
+    def stats(self):
+        """エンドポイントごとの件数・エラー数・リトライ数・応答時間"""
+        with self._lock:
+            return {endpoint: stats.to_dict() for endpoint, stats in self._stats.items()}
+
+
+class OAuthHTTPClient(_StatsRecorder):
+    """接続プール・タイムアウト・リトライ付きの HTTP クライアント（スレッド間で共有する）"""
+
+    def __init__(self, connect_timeout=5, read_timeout=15, retries=3, backoff_factor=0.5,
+                 pool_maxsize=10, stats_window=200):
+        super().__init__(stats_window)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.max_retry_after = read_timeout  # Retry-After で待つ最長の秒数
+
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """共有の requests.Session（初めて使うときに作る）"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        max_retry_after = self.max_retry_after
+
+        class _Retry(Retry):
+            def get_retry_after(self, response):
+                retry_after = super().get_retry_after(response)
+                return None if retry_after is None else min(retry_after, max_retry_after)
+
+        # 接続エラーはメソッドによらず再送する（リクエストはサーバーに届いていない）
+        # 5xx/429 と送信後の読み取りエラーは GET だけ再送し、POST は再送しない
+        # （サーバー側で authorization_code・refresh_token が使用済みかもしれないため）
+        retry = _Retry(total=self.retries, connect=self.retries, read=0, status=self.retries,
+                       backoff_factor=self.backoff_factor, status_forcelist=RETRY_STATUSES,
+                       allowed_methods=frozenset(['GET']),
+                       respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=self.pool_maxsize)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def max_duration(self):
+        """1回のリクエストにかかりうる最長の秒数（全リトライのタイムアウトとバックオフの合計）"""
+        attempts = self.retries + 1
+        backoff = sum(max(self.backoff_factor * (2 ** i), self.max_retry_after) for i in range(self.retries))
+        return attempts * sum(self.timeout) + backoff
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """リクエストを送る（endpoint を省略した場合は URL のパスで集計する）"""
+        endpoint = endpoint or urlparse(url).path
+        kwargs.setdefault('timeout', self.timeout)
+        response = None
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            return response
+        finally:
+            retries = getattr(getattr(response, 'raw', None), 'retries', None)
+            self._record(endpoint, time.perf_counter() - started,
+                         response is None or response.status_code >= 400,
+                         len(retries.history) if retries is not None else 0)
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    def close(self):
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+
+class AsyncOAuthHTTPClient(_StatsRecorder):
+    """OAuthHTTPClient の asyncio 版（1つのイベントループで共有する）
+
+    リトライの条件は OAuthHTTPClient と同じで、接続エラーは指数バックオフで再送し、
+    5xx/429 は GET だけ再送する（Retry-After は読み取りタイムアウトまで）。送信後の読み取りエラーは再送しない。
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=15, retries=3, backoff_factor=0.5,
+                 max_connections=100, stats_window=200):
+        import httpx
+        super().__init__(stats_window)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = read_timeout  # Retry-After で待つ最長の秒数
+        self._connect_errors = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=max_connections))
+
+    def _backoff(self, attempt, response):
+        # Retry-After（秒）があればそれに従う（読み取りタイムアウトより長くは待たない）
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_retry_after)
+        return self.backoff_factor * (2 ** (attempt - 1)) if attempt > 1 else 0
+
+    async def request(self, method, url, endpoint=None, **kwargs):
+        """リクエストを送る（endpoint を省略した場合は URL のパスで集計する）"""
+        endpoint = endpoint or urlparse(url).path
+        response = None
+        attempt = 0
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                except self._connect_errors:
+                    if attempt >= self.retries:
+                        raise
+                else:
+                    if (response.status_code not in RETRY_STATUSES or method.upper() != 'GET'
+                            or attempt >= self.retries):
+                        # POST はサーバーに届いているので、コードやトークンを使い直さない
+                        return response
+                attempt += 1
+                await asyncio.sleep(self._backoff(attempt, response))
+                response = None
+        finally:
+            self._record(endpoint, time.perf_counter() - started,
+                         response is None or response.status_code >= 400, attempt)
+
+    async def get(self, url, endpoint=None, **kwargs):
+        return await self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    async def post(self, url, endpoint=None, **kwargs):
+        return await self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,97 @@
+"""ログイン直後の Snowflake セッションの事前準備（プリウォーム）
+
+コールバックでトークンを保存した後、バックグラウンドのスレッドでそのログインの接続をプールに開いておく。
+ロールと Warehouse は接続パラメータで指定するので、最初のクエリは USE 文もログインもなしに
+温まったセッションで始まる。resume_warehouse=True なら停止中の Warehouse の再開も投入し、
+利用者がクエリを入力している間に再開を済ませる（Warehouse の OPERATE 権限が必要、失敗しても接続は使う）。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import phase
+from .sf_pool import token_fingerprint
+
+
+def quote_identifier(name):
+    """識別子を二重引用符で囲む（CURRENT_WAREHOUSE() が返す正規化済みの名前をそのまま指定する）"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SessionPrewarmer:
+    """ログインごとに接続を1本プールに開く（同じログイン・ロール・Warehouse の準備は同時に1回だけ）"""
+
+    def __init__(self, pool, max_workers=4, resume_warehouse=False):
+        self.pool = pool
+        self.resume_warehouse = resume_warehouse
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='sf-prewarm')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._counters = dict.fromkeys(
+            ('submitted_total', 'skipped_total', 'warmed_total', 'errors_total',
+             'resumes_total', 'resume_errors_total'), 0)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def submit(self, access_token, owner, role=None, warehouse=None):
+        """owner（ログインごとのキー）の接続の準備をバックグラウンドで始める"""
+        if not access_token or not owner:
+            return
+        # 以降のリクエストと同じプールのキーになるよう、先にログインに結び付ける
+        self.pool.bind_token(access_token, owner)
+        key = (token_fingerprint(owner), (role or '').upper(), (warehouse or '').upper())
+        with self._lock:
+            if key in self._pending:
+                self._counters['skipped_total'] += 1
+                return
+            self._pending.add(key)
+            self._counters['submitted_total'] += 1
+        try:
+            self._executor.submit(self._warm, key, access_token, role, warehouse)
+        except RuntimeError:  # 終了処理中
+            with self._lock:
+                self._pending.discard(key)
+
+    def _warm(self, key, access_token, role, warehouse):
+        try:
+            with phase('prewarm'):
+                self.pool.run(access_token, self._prepare, role=role, warehouse=warehouse)
+            self._count('warmed_total')
+        except Exception as e:
+            self._count('errors_total')
+            print(f"Session prewarm error: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _prepare(self, conn):
+        """接続（ログイン・セッション作成）は pool.run が行う。必要なら Warehouse の再開を投入する
+
+        再開は非同期実行で投入して完了を待たない（接続はすぐプールに返り、最初のクエリで使える）。
+        """
+        if not self.resume_warehouse:
+            return
+        from snowflake.connector.errors import ProgrammingError
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT CURRENT_WAREHOUSE()')
+            row = cursor.fetchone()
+            if not row or not row[0]:
+                return
+            try:
+                cursor.execute_async(f'ALTER WAREHOUSE {quote_identifier(row[0])} RESUME IF SUSPENDED')
+                self._count('resumes_total')
+            except ProgrammingError as e:
+                # 権限がない等。接続はそのまま使い、Warehouse は最初のクエリで自動再開させる
+                self._count('resume_errors_total')
+                print(f"Warehouse resume skipped: {str(e)}")
+        finally:
+            cursor.close()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), **self._counters}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
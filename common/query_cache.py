@@ -0,0 +1,301 @@
+"""クエリ結果キャッシュ
+
+同じ参照系クエリの再実行で Warehouse を動かさないよう、結果を
+(正規化したSQL, ロール, Warehouse, トークンの利用者, トークンのスコープ) をキーに保持する。
+利用者が分からない（JWT の検証に失敗した等）リクエストはキャッシュを使わない。
+メモリ上のLRU（件数・セル数・TTLで制限）と、任意でディスク上の2段目を持つ。
+ディスクには pickle ではなく JSON（行タプル）か Arrow IPC（pyarrow.Table）で保存し、
+読み込みでコードが実行されないようにする（ディレクトリは 0700 で、このプロセスのユーザーの所有に限る）。
+"""
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .columnar import is_table, load_pyarrow
+from .sf_pool import is_read_only
+from .sql_results import CachedResultStream, open_result_stream
+
+# 文字列リテラル・引用符付き識別子・コメント・空白を順に読み分ける
+_TOKEN_RE = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.|'')*')
+  | (?P<ident>"(?:[^"]|"")*")
+  | (?P<comment>--[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL)
+
+# 実行のたびに結果が変わる関数を含むクエリはキャッシュしない
+_VOLATILE_RE = re.compile(
+    r'\b(CURRENT_TIMESTAMP|CURRENT_TIME|LOCALTIMESTAMP|LOCALTIME|SYSDATE|GETDATE|SYSTIMESTAMP|'
+    r'RANDOM|RANDSTR|UNIFORM|NORMAL|ZIPF|UUID_STRING|SEQ[1248]|LAST_QUERY_ID)\b',
+    re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """コメント・余分な空白・末尾のセミコロンを除き、リテラル以外を大文字に揃える
+
+    引用符なしの識別子とキーワードは大文字小文字を区別しないので、
+    文字列リテラルと引用符付き識別子以外は大文字にしてよい。
+    """
+    parts = []
+    position = 0
+    for match in _TOKEN_RE.finditer(sql):
+        if match.start() > position:
+            parts.append(sql[position:match.start()].upper())
+        if match.lastgroup in ('string', 'ident'):
+            parts.append(match.group())
+        elif not parts or parts[-1] != ' ':
+            parts.append(' ')
+        position = match.end()
+    parts.append(sql[position:].upper())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def strip_literals(normalized):
+    """正規化済みの SQL の文字列リテラルを '' に置き換える"""
+    return _TOKEN_RE.sub(lambda m: "''" if m.lastgroup == 'string' else m.group(), normalized)
+
+
+def is_cacheable(sql):
+    """参照系で、結果が実行ごとに変わらないクエリだけをキャッシュ対象にする"""
+    normalized = normalize_sql(sql)
+    if not is_read_only(normalized) or ';' in strip_literals(normalized):
+        return False
+    return not _VOLATILE_RE.search(strip_literals(normalized))
+
+
+# JSON にない型は {"$type": 型名, "value": 文字列} で保存する
+_ENCODERS = {
+    datetime.datetime: ('datetime', datetime.datetime.isoformat),
+    datetime.date: ('date', datetime.date.isoformat),
+    datetime.time: ('time', datetime.time.isoformat),
+    decimal.Decimal: ('decimal', str),
+    bytes: ('bytes', lambda value: base64.b64encode(value).decode('ascii')),
+    bytearray: ('bytes', lambda value: base64.b64encode(value).decode('ascii')),
+}
+_DECODERS = {
+    'datetime': datetime.datetime.fromisoformat,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'decimal': decimal.Decimal,
+    'bytes': base64.b64decode,
+}
+
+
+def _encode_value(value):
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        return {'$type': encoder[0], 'value': encoder[1](value)}
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError(f'キャッシュできない型です: {type(value).__name__}')
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return _DECODERS[value['$type']](value['value'])
+    return value
+
+
+def _check_private_dir(path):
+    """他のユーザーが読み書きできるディレクトリには保存しない（結果には他の利用者のデータも含まれる）"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise ValueError(f'キャッシュのディレクトリが別のユーザーの所有です: {path}')
+    if st.st_mode & 0o077:
+        raise ValueError(f'キャッシュのディレクトリは他のユーザーがアクセスできないようにしてください（chmod 700）: {path}')
+
+
+class CachedResult:
+    __slots__ = ('columns', 'rows', 'created_at')
+
+    def __init__(self, columns, rows, created_at=None):
+        self.columns = columns
+        self.rows = rows
+        self.created_at = created_at or time.time()
+
+    @property
+    def cells(self):
+        return len(self.rows) * max(len(self.columns), 1)
+
+
+class QueryResultCache:
+    """LRU + TTL の結果キャッシュ（disk_dir を指定するとディスクにも保存する）"""
+
+    def __init__(self, max_entries=256, max_cells=1_000_000, max_rows_per_entry=10000,
+                 ttl=300, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_cells = max_cells
+        self.max_rows_per_entry = max_rows_per_entry
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        if disk_dir:
+            _check_private_dir(disk_dir)
+
+        self._entries = OrderedDict()
+        self._cells = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(sql, role, warehouse, subject, scope=None):
+        """scope はトークンで実際に使えるロールを決めるスコープ（文字列またはリスト、順序は問わない）"""
+        if isinstance(scope, str):
+            scope = scope.split()
+        raw = '\x00'.join([normalize_sql(sql), (role or '').upper(), (warehouse or '').upper(),
+                           subject or '', ' '.join(sorted(scope or ()))])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key, suffix):
+        return os.path.join(self.disk_dir, f'{key}.{suffix}')
+
+    def _evict_locked(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._cells > self.max_cells):
+            _, entry = self._entries.popitem(last=False)
+            self._cells -= entry.cells
+
+    def _put_memory(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._cells -= old.cells
+            self._entries[key] = entry
+            self._cells += entry.cells
+            self._evict_locked()
+
+    def _get_disk(self, key):
+        if not self.disk_dir:
+            return None
+        for suffix, read in (('arrow', self._read_arrow), ('json', self._read_json)):
+            path = self._disk_path(key, suffix)
+            try:
+                if time.time() - os.path.getmtime(path) >= self.ttl:
+                    os.remove(path)
+                    continue
+                return read(path)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"Query cache read error: {str(e)}")
+        return None
+
+    @staticmethod
+    def _read_json(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        rows = [tuple(_decode_value(value) for value in row) for row in data['rows']]
+        return CachedResult(data['columns'], rows, data['created_at'])
+
+    @staticmethod
+    def _read_arrow(path):
+        if load_pyarrow() is None:
+            return None
+        import pyarrow.ipc
+        with open(path, 'rb') as f:
+            table = pyarrow.ipc.open_file(f).read_all()
+        metadata = json.loads(table.schema.metadata[b'query_cache'])
+        return CachedResult(metadata['columns'], table.replace_schema_metadata(None), metadata['created_at'])
+
+    def _put_disk(self, key, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            if is_table(entry.rows):
+                import pyarrow.ipc
+                suffix = 'arrow'
+                metadata = {'query_cache': json.dumps({'columns': entry.columns, 'created_at': entry.created_at})}
+                table = entry.rows.replace_schema_metadata(metadata)
+                with os.fdopen(fd, 'wb') as f, pyarrow.ipc.new_file(f, table.schema) as writer:
+                    writer.write_table(table)
+            else:
+                suffix = 'json'
+                rows = [[_encode_value(value) for value in row] for row in entry.rows]
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({'columns': entry.columns, 'rows': rows, 'created_at': entry.created_at}, f,
+                              separators=(',', ':'))
+            os.replace(tmp_path, self._disk_path(key, suffix))
+            # 同じキーを別の形式で保存していたら消す（読み込みは arrow を優先する）
+            other = self._disk_path(key, 'json' if suffix == 'arrow' else 'arrow')
+            if os.path.exists(other):
+                os.remove(other)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Query cache write error: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, key):
+        """有効なキャッシュを返す（なければ None）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry.created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self._entries[key]
+                self._cells -= entry.cells
+
+        entry = self._get_disk(key)
+        if entry is not None and now - entry.created_at < self.ttl:
+            self._put_memory(key, entry)
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, columns, rows):
+        if len(rows) > self.max_rows_per_entry:
+            return
+        # Arrow で受け取れた結果は pyarrow.Table のまま保持する（行タプルより小さい）
+        entry = CachedResult(list(columns), rows if is_table(rows) else list(rows))
+        if entry.cells > self.max_cells:
+            return
+        self._put_memory(key, entry)
+        if self.disk_dir:
+            self._put_disk(key, entry)
+
+    def get_stream(self, key, max_rows=10000):
+        """キャッシュ済みの結果を ResultStream として返す（なければ None）"""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return CachedResultStream(entry.columns, entry.rows, max_rows=max_rows)
+
+    def record(self, stream, key):
+        """ResultStream を最後まで読み切れたら、その結果をキャッシュに入れる"""
+        stream.cache_status = 'MISS'
+        stream.collect(self.max_rows_per_entry,
+                       lambda columns, rows: self.put(key, columns, rows))
+        return stream
+
+    def open_stream(self, pool, access_token, sql, subject, role=None, warehouse=None,
+                    batch_size=1000, max_rows=10000, scope=None):
+        """キャッシュがあればそれを、なければクエリを実行して結果を記録する ResultStream を返す"""
+        if not subject or not is_cacheable(sql):
+            # 利用者が分からなければ、他の利用者の結果と混ざらないようキャッシュを使わない
+            return open_result_stream(pool, access_token, sql, role=role, warehouse=warehouse,
+                                      batch_size=batch_size, max_rows=max_rows)
+        key = self.make_key(sql, role, warehouse, subject, scope)
+        stream = self.get_stream(key, max_rows)
+        if stream is None:
+            stream = self.record(open_result_stream(pool, access_token, sql, role=role,
+                                                    warehouse=warehouse, batch_size=batch_size,
+                                                    max_rows=max_rows), key)
+        return stream
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'cells': self._cells,
+                    'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,330 @@
+"""クエリ履歴（SQLite）と遅いクエリ・頻出クエリのレポート
+
+実行したクエリごとに、Snowflake のクエリID・正規化したSQLのハッシュ・ロール・Warehouse・
+行数・送信したバイト数・段階ごとの処理時間を1行ずつ追記する。記録するのは
+/execute_sql（ASGI 版を含む）・/execute_batch（文ごと）・/export_sql・非同期実行
+（投入の失敗と、状態の問い合わせで完了を確認したとき）のクエリ。
+送信したバイト数（response_bytes）はそのクエリの結果を返したレスポンスの本文（結果表の HTML・
+ダウンロードしたファイル）の大きさで、結果をそのまま返さないバッチ・非同期実行では NULL。
+値はリクエスト終了時（結果を送り終えた後）に確定させてキューに入れ、書き込み用のスレッドが
+まとめて1トランザクションで INSERT するので、リクエストの処理中にディスクへは書かない。
+キューがあふれた場合は記録を捨てて件数だけ数える。
+
+SQL 本文は文字列リテラルを '' に置き換えてから保存し（パスワード等を残さない）、
+ハッシュはリテラルを含めた正規化後の SQL で計算する（結果キャッシュのキーと同じ単位で集計できる）。
+利用者もハッシュで保存する。
+
+    python -m common.query_history --db query_history.db --days 7
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from .metrics import annotate_append
+from .query_cache import normalize_sql, strip_literals
+from .sf_pool import token_fingerprint
+
+# 列として保存する段階（それ以外の段階も phases_ms の JSON には残す）
+PHASE_COLUMNS = ('queue', 'token', 'connect', 'execute', 'fetch', 'render')
+
+_COLUMNS = ('ts', 'user_hash', 'endpoint', 'query_id', 'sql_hash', 'sql_text', 'role', 'warehouse',
+            'status', 'http_status', 'cache', 'rows', 'response_bytes', 'truncated', 'duration_ms') + \
+           tuple(f'{name}_ms' for name in PHASE_COLUMNS) + ('phases_ms', 'error')
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS query_history (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    user_hash TEXT,
+    endpoint TEXT,
+    query_id TEXT,
+    sql_hash TEXT NOT NULL,
+    sql_text TEXT,
+    role TEXT,
+    warehouse TEXT,
+    status TEXT,
+    http_status INTEGER,
+    cache TEXT,
+    rows INTEGER,
+    response_bytes INTEGER,
+    truncated INTEGER,
+    duration_ms REAL,
+    queue_ms REAL,
+    token_ms REAL,
+    connect_ms REAL,
+    execute_ms REAL,
+    fetch_ms REAL,
+    render_ms REAL,
+    phases_ms TEXT,
+    error TEXT
+)'''
+
+_STOP = object()
+
+
+class QueryHistory:
+    """クエリ履歴の保存先（記録はキューに入れるだけで、書き込みは専用スレッドがまとめて行う）"""
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0, max_queue=10000,
+                 retention_days=30, max_sql_length=2000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval   # 件数が batch_size に満たなくても書き込むまでの最大待ち時間
+        self.retention_days = retention_days   # これより古い行は書き込みのついでに削除（0 なら削除しない）
+        self.max_sql_length = max_sql_length
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(('recorded_total', 'written_total', 'dropped_total',
+                                        'batches_total', 'errors_total'), 0)
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(_SCHEMA)
+            if 'response_bytes' not in [row[1] for row in conn.execute('PRAGMA table_info(query_history)')]:
+                # 結果表の HTML のバイト数を bytes 列に記録していた以前のファイル（古い行の値は移さない）
+                conn.execute('ALTER TABLE query_history ADD COLUMN response_bytes INTEGER')
+            conn.execute('CREATE INDEX IF NOT EXISTS query_history_ts ON query_history (ts)')
+            conn.execute('CREATE INDEX IF NOT EXISTS query_history_user_ts ON query_history (user_hash, ts)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    # --- 記録 ---
+
+    def track(self, sql, user, role=None, warehouse=None, stream=None, error=None, duration=None, phases=None):
+        """現在のリクエストで実行したクエリを記録する（1リクエストで複数回呼んでよい）
+
+        行数・クエリID等は stream（ResultStream・バッチの StatementResult・ExportResult・AsyncQueryJob）から
+        リクエスト終了時に読むので、結果を送り終える前に呼んでよい。実行に失敗した場合は stream の代わりに
+        error を渡す。duration・phases を省略するとリクエスト全体の処理時間・段階を記録する。
+        """
+        annotate_append('query_history', {'sql': sql, 'user': user, 'role': role, 'warehouse': warehouse,
+                                          'stream': stream, 'error': error, 'duration': duration,
+                                          'phases': phases})
+
+    def observe(self, endpoint, status, duration, phases, notes):
+        """リクエスト終了時に呼ばれ、track() した内容をキューに入れる（metrics.init_app の observers に登録）"""
+        started = time.time() - duration  # リクエストを受け付けた時刻
+        for entry in notes.get('query_history', ()):
+            stream = entry['stream']
+            error = entry['error']
+            if stream is not None and getattr(stream, 'error', None):
+                error = stream.error
+            self.record({
+                'ts': started,
+                'user': entry['user'],
+                'endpoint': endpoint,
+                'query_id': getattr(error, 'sfqid', None) if stream is None else stream.query_id,
+                'sql': entry['sql'],
+                'role': entry['role'],
+                'warehouse': entry['warehouse'],
+                'status': 'error' if error else 'success',
+                'http_status': status,
+                'cache': getattr(stream, 'cache_status', None),
+                'rows': getattr(stream, 'row_count', None) if stream is not None else 0,
+                'response_bytes': getattr(stream, 'response_bytes', None),
+                'truncated': bool(getattr(stream, 'truncated', False)),
+                'duration': duration if entry['duration'] is None else entry['duration'],
+                'phases': dict(phases if entry['phases'] is None else entry['phases']),
+                'error': str(error) if error else None,
+            })
+
+    def record(self, entry):
+        """1件をキューに入れる（待たない。キューがあふれたら捨てる）"""
+        self.start()
+        try:
+            self._queue.put_nowait(entry)
+            self._count('recorded_total')
+        except queue.Full:
+            self._count('dropped_total')
+
+    def start(self):
+        """書き込み用スレッドを起動（起動済みなら何もしない、fork 前には起動しない）"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='query-history', daemon=True)
+                self._thread.start()
+
+    def _row(self, entry):
+        """キューの1件を INSERT する値にする（正規化・ハッシュは書き込み用スレッドで行う）
+
+        ハッシュは空白・コメント・末尾のセミコロンの違いを無視した SQL で計算する。
+        """
+        normalized = normalize_sql(entry['sql'])
+        phases = entry['phases']
+        user = entry['user']
+        return (
+            entry['ts'],
+            token_fingerprint(user) if user else None,
+            entry['endpoint'],
+            entry['query_id'],
+            hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:16],
+            strip_literals(normalized)[:self.max_sql_length],
+            (entry['role'] or '').upper() or None,
+            (entry['warehouse'] or '').upper() or None,
+            entry['status'],
+            entry['http_status'],
+            entry['cache'],
+            entry['rows'],
+            entry['response_bytes'],
+            int(entry['truncated']),
+            round(entry['duration'] * 1000, 3),
+        ) + tuple(round(phases[name] * 1000, 3) if name in phases else None for name in PHASE_COLUMNS) + (
+            json.dumps({name: round(seconds * 1000, 3) for name, seconds in phases.items()}),
+            entry['error'][:1000] if entry['error'] else None,
+        )
+
+    def _run(self):
+        conn = self._connect()
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL では電源断時に直近のコミットを失うだけで壊れない
+        insert = (f'INSERT INTO query_history ({", ".join(_COLUMNS)}) '
+                  f'VALUES ({", ".join("?" * len(_COLUMNS))})')
+        pruned_at = 0.0
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                rows = [self._row(entry) for entry in batch]
+                with conn:
+                    conn.executemany(insert, rows)
+                    if self.retention_days and time.time() - pruned_at > 3600:
+                        pruned_at = time.time()
+                        conn.execute('DELETE FROM query_history WHERE ts < ?',
+                                     (pruned_at - self.retention_days * 86400,))
+                self._count('written_total', len(rows))
+                self._count('batches_total')
+            except Exception as e:
+                self._count('errors_total')
+                print(f"Query history write error: {str(e)}")
+        conn.close()
+
+    def close(self, timeout=5):
+        """キューに残っている記録を書き込んでスレッドを止める"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queue.qsize(), **self._counters}
+
+    # --- 参照 ---
+
+    def _query(self, sql, params):
+        with contextlib.closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    def recent(self, user, limit=50):
+        """利用者の最近のクエリ（新しい順、started_at は実行時刻のローカル時刻の文字列）"""
+        rows = self._query('SELECT * FROM query_history WHERE user_hash = ? ORDER BY id DESC LIMIT ?',
+                           (token_fingerprint(user), limit))
+        for row in rows:
+            row['started_at'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['ts']))
+        return rows
+
+    def ranking(self, order='slowest', days=7, user=None, limit=20):
+        """SQL（正規化後のハッシュ）ごとの集計を、遅い順（slowest）または実行回数の多い順（frequent）で返す
+
+        平均・最大の処理時間は結果キャッシュから返したものを除いて計算する。
+        """
+        if order not in ('slowest', 'frequent'):
+            raise ValueError(f'Unknown order: {order}')
+        where = 'ts >= ?'
+        params = [time.time() - days * 86400]
+        if user is not None:
+            where += ' AND user_hash = ?'
+            params.append(token_fingerprint(user))
+        executed = "CASE WHEN cache = 'HIT' THEN NULL ELSE {} END"
+        phase_averages = ', '.join(f'AVG({executed.format(f"{name}_ms")}) AS avg_{name}_ms'
+                                   for name in PHASE_COLUMNS)
+        sql = f'''SELECT sql_hash, MAX(sql_text) AS sql_text, COUNT(*) AS count,
+                         SUM(status IS 'error') AS errors, SUM(cache IS 'HIT') AS cache_hits,
+                         COUNT(DISTINCT user_hash) AS users, GROUP_CONCAT(DISTINCT warehouse) AS warehouses,
+                         AVG({executed.format('duration_ms')}) AS avg_ms,
+                         MAX({executed.format('duration_ms')}) AS max_ms,
+                         SUM(duration_ms) AS total_ms, AVG(rows) AS avg_rows, AVG(response_bytes) AS avg_response_bytes,
+                         {phase_averages}, MAX(ts) AS last_ts
+                  FROM query_history WHERE {where} GROUP BY sql_hash
+                  ORDER BY {'avg_ms' if order == 'slowest' else 'count'} DESC, total_ms DESC LIMIT ?'''
+        params.append(limit)
+        return self._query(sql, params)
+
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:,.0f}'
+
+
+def print_ranking(title, rows):
+    """ranking() の結果を表形式で出力する"""
+    print(f'== {title} ==')
+    if not rows:
+        print('(なし)\n')
+        return
+    print(f'{"count":>6} {"hits":>5} {"errors":>6} {"avg_ms":>9} {"max_ms":>9} {"total_ms":>11} '
+          f'{"queue":>7} {"connect":>7} {"execute":>8} {"fetch":>7} {"render":>7} {"rows":>8}  sql_hash          sql')
+    for row in rows:
+        sql = ' '.join((row['sql_text'] or '').split())
+        print(f'{row["count"]:>6} {row["cache_hits"]:>5} {row["errors"]:>6} {_format_ms(row["avg_ms"]):>9} '
+              f'{_format_ms(row["max_ms"]):>9} {_format_ms(row["total_ms"]):>11} '
+              f'{_format_ms(row["avg_queue_ms"]):>7} {_format_ms(row["avg_connect_ms"]):>7} '
+              f'{_format_ms(row["avg_execute_ms"]):>8} {_format_ms(row["avg_fetch_ms"]):>7} '
+              f'{_format_ms(row["avg_render_ms"]):>7} {row["avg_rows"] or 0:>8,.0f}  {row["sql_hash"]}  '
+              f'{sql[:100]}')
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='クエリ履歴から遅いクエリ・頻出クエリを集計する')
+    parser.add_argument('--db', required=True, help='QUERY_HISTORY_DB に指定したファイル')
+    parser.add_argument('--days', type=float, default=7, help='集計する期間（日）')
+    parser.add_argument('--limit', type=int, default=20, help='表示する件数')
+    parser.add_argument('--by', choices=('slowest', 'frequent', 'all'), default='all', help='並び順')
+    parser.add_argument('--json', action='store_true', help='JSON で出力する')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error(f'{args.db} がありません')
+
+    history = QueryHistory(args.db)
+    orders = ('slowest', 'frequent') if args.by == 'all' else (args.by,)
+    report = {order: history.ranking(order, days=args.days, limit=args.limit) for order in orders}
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    titles = {'slowest': '遅いクエリ（平均処理時間、キャッシュヒットを除く）', 'frequent': '実行回数の多いクエリ'}
+    for order, rows in report.items():
+        print_ranking(f'{titles[order]} 直近 {args.days:g} 日', rows)
+
+
+if __name__ == '__main__':
+    main()
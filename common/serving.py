@@ -0,0 +1,100 @@
+"""アプリケーションの起動（開発サーバー / gunicorn）
+
+`python app.py` は従来どおり Werkzeug の開発サーバー（debug, リローダー付き）で起動する。
+`python app.py --production` または `APP_SERVER=gunicorn` で gunicorn の
+マルチワーカー構成（gthread）で起動する。設定は WEB_* 環境変数で変更できる。
+
+トークンの保存先がプロセス内のメモリ（TOKEN_STORE_URL=memory://）の場合、ワーカー間で
+ログインを共有できないので1ワーカーで起動する（WEB_WORKERS で2以上を指定していれば起動しない）。
+同時実行数の制御（admission）と非同期クエリの件数上限はワーカーごとに数える。
+"""
+import multiprocessing
+import os
+import sys
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def _env_bool(name, default):
+    return os.getenv(name, 'true' if default else 'false').lower() == 'true'
+
+
+def _workers():
+    """ワーカー数（トークンの保存先がメモリなら1）"""
+    memory_store = os.getenv('TOKEN_STORE_URL', 'memory://').startswith('memory:')
+    if os.getenv('WEB_WORKERS'):
+        workers = _env_int('WEB_WORKERS', 1)
+        if workers > 1 and memory_store:
+            sys.exit('TOKEN_STORE_URL=memory:// ではワーカー間でログインを共有できません。'
+                     'sqlite:///path/tokens.db か redis://host:6379/0 を指定するか、WEB_WORKERS=1 にしてください')
+        return workers
+    if memory_store:
+        print("WARNING: TOKEN_STORE_URL=memory:// のため1ワーカーで起動します（複数ワーカーには sqlite / redis を指定）")
+        return 1
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def production_options(default_port=5000):
+    """gunicorn の設定（環境変数で上書き可能）"""
+    return {
+        'bind': os.getenv('WEB_BIND', f'0.0.0.0:{default_port}'),
+        'workers': _workers(),
+        'threads': _env_int('WEB_THREADS', 4),
+        'worker_class': os.getenv('WEB_WORKER_CLASS', 'gthread'),
+        # fork 前にアプリを読み込んでメモリを共有する（接続・スレッドはワーカーごとに作られる）
+        'preload_app': _env_bool('WEB_PRELOAD', True),
+        'keepalive': _env_int('WEB_KEEPALIVE', 5),
+        # ストリーミング中のエクスポートを途中で切らないよう長めにする
+        'timeout': _env_int('WEB_TIMEOUT', 120),
+        'graceful_timeout': _env_int('WEB_GRACEFUL_TIMEOUT', 30),
+        'max_requests': _env_int('WEB_MAX_REQUESTS', 0),
+        'max_requests_jitter': _env_int('WEB_MAX_REQUESTS_JITTER', 0),
+        # 空文字でアクセスログを出さない
+        'accesslog': os.getenv('WEB_ACCESS_LOG', '-') or None,
+    }
+
+
+def is_production(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    return '--production' in argv or os.getenv('APP_SERVER', '').lower() == 'gunicorn'
+
+
+def run_production(app, on_shutdown=None, default_port=5000):
+    """gunicorn でアプリを起動する（on_shutdown はワーカー終了時に呼ばれる）"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit('本番モードには gunicorn が必要です: pip install gunicorn')
+
+    options = production_options(default_port)
+    if not options['preload_app'] and not os.getenv('FLASK_SECRET_KEY'):
+        # ワーカーごとに別の secret_key になり、セッション（PKCE の state 等）が共有されない
+        print("WARNING: FLASK_SECRET_KEY が未設定です。WEB_PRELOAD=false ではログインが失敗します")
+
+    def worker_exit(server, worker):
+        for func in on_shutdown or []:
+            try:
+                func()
+            except Exception as e:
+                print(f"Shutdown error: {str(e)}")
+
+    class _Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+            self.cfg.set('worker_exit', worker_exit)
+
+        def load(self):
+            return app
+
+    _Application().run()
+
+
+def run(app, on_shutdown=None, default_port=5000):
+    """起動方法を選んでアプリを起動する"""
+    if is_production():
+        run_production(app, on_shutdown, default_port)
+    else:
+        app.run(host='0.0.0.0', port=default_port, debug=True)
@@ -0,0 +1,401 @@
+"""Snowflakeコネクションプール
+
+(ログイン, ロール, Warehouse) ごとに接続を使い回し、
+リクエスト毎のTLS + ログイン + セッション作成のコストを避ける。
+
+Snowflake のセッションは作成後はアクセストークンの期限と関係なく続くので、
+トークンを更新しても同じログインの接続はそのまま使う（bind_token / rotate_token）。
+セッション自体が期限切れになった場合だけ、現在のトークンで接続し直して1回だけ再実行する。
+アクセストークンが拒否された場合（390303/390318）は、トークンプロバイダ（TokenStore.provider）で
+更新したトークンで接続し直す。
+snowflake.connector は読み込みに時間がかかるので、初めて接続するときに読み込む。
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# セッションの状態（ロール・Warehouse・セッションパラメータ等）を変更する文
+_SESSION_STATE_RE = re.compile(r'^\s*(USE|ALTER\s+SESSION|SET|UNSET)\b', re.IGNORECASE)
+# データもセッションも変更しない参照系の文
+_READ_ONLY_RE = re.compile(r'^[\s(]*(SELECT|WITH|SHOW|DESCRIBE|DESC|EXPLAIN)\b', re.IGNORECASE)
+
+# セッション・トークンの期限切れ（文の実行前に返るので、接続し直せば再実行してよい）
+# 390111: セッションが存在しない 390112: セッション期限切れ 390114/390115: マスタートークン期限切れ・無効
+# 390303: 無効な OAuth アクセストークン 390318: OAuth アクセストークン期限切れ
+SESSION_EXPIRED_ERRNOS = frozenset([390111, 390112, 390114, 390115, 390303, 390318])
+# OAuth アクセストークン自体が拒否された（同じトークンで接続し直しても失敗するので、更新してから接続する）
+TOKEN_REJECTED_ERRNOS = frozenset([390303, 390318])
+
+
+def token_fingerprint(access_token):
+    """プールのキーに使うトークン識別子（トークン本体はキーに保持しない）"""
+    return hashlib.sha256((access_token or '').encode('utf-8')).hexdigest()[:16]
+
+
+def changes_session_state(sql):
+    """実行後に接続を再利用すべきでない文かどうか"""
+    return bool(_SESSION_STATE_RE.match(sql or ''))
+
+
+def is_read_only(sql):
+    """参照系の文かどうか（実行順を入れ替えても結果が変わらない）"""
+    return bool(_READ_ONLY_RE.match(sql or ''))
+
+
+def is_session_expired(error):
+    """接続し直せば成功するエラー（セッション・トークンの期限切れ）かどうか"""
+    return getattr(error, 'errno', None) in SESSION_EXPIRED_ERRNOS
+
+
+def resolve_token(access_token, refresh=False):
+    """アクセストークンを返す（access_token はトークンの文字列か、TokenStore.provider のトークンプロバイダ）
+
+    refresh=True ならトークンが拒否された後に使うトークンを返す（更新できない・文字列で渡された場合は None）。
+    """
+    if callable(access_token):
+        return access_token(refresh)
+    return None if refresh else access_token
+
+
+def reconnect_token(access_token, error):
+    """error で失敗した後、接続し直して再実行するときのトークン（再実行しない場合は None）"""
+    if not is_session_expired(error):
+        return None
+    return resolve_token(access_token, refresh=getattr(error, 'errno', None) in TOKEN_REJECTED_ERRNOS)
+
+
+class PoolExhausted(Exception):
+    """接続数が上限に達し、待機時間内に接続を確保できなかった"""
+
+
+class _Entry:
+    __slots__ = ('conn', 'key', 'created_at', 'last_used', 'discard')
+
+    def __init__(self, conn, key):
+        self.conn = conn
+        self.key = key
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.discard = False
+
+
+class SnowflakeConnectionPool:
+    """ログイン・ロール・Warehouse単位のスレッドセーフな接続プール"""
+
+    # ログインごとに覚えておくトークン（現在のものと、更新前の処理中リクエストが使うもの）
+    TOKENS_PER_GROUP = 2
+
+    def __init__(self, account, max_size=10, max_idle_per_key=2, idle_timeout=600,
+                 acquire_timeout=30, health_check_interval=60, connect_params=None,
+                 max_groups=10000):
+        self.account = account
+        self.max_size = max_size
+        self.max_idle_per_key = max_idle_per_key
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_params = connect_params or {}
+        self.max_groups = max_groups
+
+        # トークン識別子 -> 接続のグループ（ログイン単位、トークンを更新しても変わらない）
+        self._groups = {}
+        # グループ -> そのグループのトークン識別子（新しい順、挿入順が古いグループから捨てる）
+        self._group_tokens = {}
+
+        self._cond = threading.Condition()
+        self._idle = {}          # key -> deque[_Entry]（右端が直近に返却された接続）
+        self._in_use = {}        # id(conn) -> _Entry
+        self._size = 0           # 開いている接続の総数（使用中 + アイドル）
+        # 監視用の累計値（stats() で返す）
+        self._counters = dict.fromkeys(
+            ('connects_total', 'connect_errors_total', 'reuses_total', 'health_check_failures_total',
+             'evictions_total', 'waits_total', 'exhausted_total', 'reconnects_total'), 0)
+
+    def make_key(self, access_token, role=None, warehouse=None):
+        fingerprint = token_fingerprint(access_token)
+        with self._cond:
+            group = self._groups.get(fingerprint, fingerprint)
+        return (group, (role or '').upper(), (warehouse or '').upper())
+
+    def _link_locked(self, fingerprint, group):
+        if self._groups.get(fingerprint) == group:
+            return
+        self._groups[fingerprint] = group
+        fingerprints = self._group_tokens.pop(group, [])
+        fingerprints.insert(0, fingerprint)
+        for stale in fingerprints[self.TOKENS_PER_GROUP:]:
+            self._groups.pop(stale, None)
+        self._group_tokens[group] = fingerprints[:self.TOKENS_PER_GROUP]
+        while len(self._group_tokens) > self.max_groups:
+            oldest = next(iter(self._group_tokens))
+            for stale in self._group_tokens.pop(oldest):
+                self._groups.pop(stale, None)
+
+    def bind_token(self, access_token, owner):
+        """access_token を owner（ログインごとのキー）の接続に結び付ける
+
+        別のワーカープロセスで更新されたトークンでも、同じログインなら開いている接続を使う。
+        """
+        if not access_token or not owner:
+            return
+        with self._cond:
+            self._link_locked(token_fingerprint(access_token), 'login:' + token_fingerprint(owner))
+
+    def rotate_token(self, old_access_token, new_access_token):
+        """トークン更新時に、新しいトークンを古いトークンと同じ接続に結び付ける（接続は閉じない）"""
+        if not old_access_token or not new_access_token:
+            return
+        old_fingerprint = token_fingerprint(old_access_token)
+        with self._cond:
+            self._link_locked(token_fingerprint(new_access_token),
+                              self._groups.get(old_fingerprint, old_fingerprint))
+
+    def _connect(self, access_token, role, warehouse):
+        import snowflake.connector
+        conn_params = {
+            'account': self.account,
+            'token': access_token,
+            'authenticator': 'oauth',
+            **self.connect_params,
+        }
+        # 接続パラメータで指定すれば USE ROLE / USE WAREHOUSE の往復が不要
+        if role:
+            conn_params['role'] = role
+        if warehouse:
+            conn_params['warehouse'] = warehouse
+        return snowflake.connector.connect(**conn_params)
+
+    def _is_healthy(self, entry):
+        if entry.conn.is_closed():
+            return False
+        if time.monotonic() - entry.last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = entry.conn.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _pop_expired_locked(self, now):
+        """アイドルタイムアウトを過ぎた接続をプールから外す（closeはロック外で行う）"""
+        expired = []
+        for key in list(self._idle):
+            idle = self._idle[key]
+            while idle and now - idle[0].last_used >= self.idle_timeout:
+                expired.append(idle.popleft())
+            if not idle:
+                del self._idle[key]
+        self._size -= len(expired)
+        self._counters['evictions_total'] += len(expired)
+        return expired
+
+    def _pop_lru_idle_locked(self):
+        """別キーのアイドル接続のうち最も古いものを外して枠を空ける"""
+        oldest = None
+        for idle in self._idle.values():
+            if idle and (oldest is None or idle[0].last_used < oldest[0].last_used):
+                oldest = idle
+        if oldest is None:
+            return None
+        entry = oldest.popleft()
+        if not oldest:
+            del self._idle[entry.key]
+        self._size -= 1
+        self._counters['evictions_total'] += 1
+        return entry
+
+    @staticmethod
+    def _close(entries):
+        for entry in entries:
+            try:
+                entry.conn.close()
+            except Exception:
+                pass
+
+    def acquire(self, access_token, role=None, warehouse=None, fresh=False):
+        """接続を取得（アイドル接続があれば再利用、なければ新規接続。fresh=True なら常に新規接続）"""
+        access_token = resolve_token(access_token)
+        key = self.make_key(access_token, role, warehouse)
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            to_close = []
+            candidate = None
+            reserved = False
+            with self._cond:
+                to_close.extend(self._pop_expired_locked(time.monotonic()))
+                idle = None if fresh else self._idle.get(key)
+                if idle:
+                    candidate = idle.pop()
+                    if not idle:
+                        del self._idle[key]
+                    self._in_use[id(candidate.conn)] = candidate
+                else:
+                    if self._size >= self.max_size:
+                        evicted = self._pop_lru_idle_locked()
+                        if evicted:
+                            to_close.append(evicted)
+                    if self._size < self.max_size:
+                        self._size += 1
+                        reserved = True
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._counters['exhausted_total'] += 1
+                            self._close(to_close)
+                            raise PoolExhausted(
+                                f'Snowflake接続数が上限({self.max_size})に達しています')
+                        self._counters['waits_total'] += 1
+                        self._cond.wait(remaining)
+            self._close(to_close)
+
+            if candidate is not None:
+                if self._is_healthy(candidate):
+                    candidate.last_used = time.monotonic()
+                    with self._cond:
+                        self._counters['reuses_total'] += 1
+                    return candidate.conn
+                with self._cond:
+                    self._counters['health_check_failures_total'] += 1
+                self._forget(candidate)
+                self._close([candidate])
+                continue
+
+            if reserved:
+                try:
+                    conn = self._connect(access_token, role, warehouse)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._counters['connect_errors_total'] += 1
+                        self._cond.notify()
+                    raise
+                entry = _Entry(conn, key)
+                with self._cond:
+                    self._in_use[id(conn)] = entry
+                    self._counters['connects_total'] += 1
+                return conn
+
+    def _forget(self, entry):
+        with self._cond:
+            if self._in_use.pop(id(entry.conn), None) is not None:
+                self._size -= 1
+                self._cond.notify()
+
+    def discard(self, conn):
+        """返却時にこの接続を閉じるよう印を付ける"""
+        with self._cond:
+            entry = self._in_use.get(id(conn))
+            if entry is not None:
+                entry.discard = True
+
+    def release(self, conn):
+        """接続をプールに返却"""
+        to_close = []
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+            if entry is None:
+                to_close.append(_Entry(conn, None))
+            else:
+                idle = self._idle.setdefault(entry.key, deque())
+                if entry.discard or conn.is_closed() or len(idle) >= self.max_idle_per_key:
+                    self._size -= 1
+                    to_close.append(entry)
+                    if not idle:
+                        del self._idle[entry.key]
+                else:
+                    entry.last_used = time.monotonic()
+                    idle.append(entry)
+            self._cond.notify()
+        self._close(to_close)
+
+    @contextmanager
+    def connection(self, access_token, role=None, warehouse=None, fresh=False):
+        """with文で接続を借りる。SQLエラー以外の例外が起きた接続は破棄する"""
+        conn = self.acquire(access_token, role, warehouse, fresh=fresh)
+        from snowflake.connector.errors import ProgrammingError
+        try:
+            yield conn
+        except ProgrammingError as e:
+            if is_session_expired(e):
+                self.discard(conn)
+            raise
+        except BaseException:
+            self.discard(conn)
+            raise
+        finally:
+            self.release(conn)
+
+    def run(self, access_token, func, role=None, warehouse=None):
+        """借りた接続で func(conn) を実行して結果を返す
+
+        セッションの期限切れで失敗した場合は現在のトークンで、トークンが拒否された場合は
+        トークンプロバイダで更新したトークンで新しく接続して1回だけ再実行する。
+        """
+        try:
+            with self.connection(access_token, role, warehouse) as conn:
+                return func(conn)
+        except Exception as e:
+            token = reconnect_token(access_token, e)
+            if not token:
+                raise
+        self.count_reconnect()
+        with self.connection(token, role, warehouse, fresh=True) as conn:
+            return func(conn)
+
+    def count_reconnect(self):
+        with self._cond:
+            self._counters['reconnects_total'] += 1
+
+    def evict_token(self, access_token):
+        """ログアウト時にそのログインの接続を破棄（更新前のトークンで開いた接続も含む）"""
+        if not access_token:
+            return
+        fingerprint = token_fingerprint(access_token)
+        to_close = []
+        with self._cond:
+            group = self._groups.get(fingerprint, fingerprint)
+            for stale in self._group_tokens.pop(group, ()):
+                self._groups.pop(stale, None)
+            for key in [k for k in self._idle if k[0] == group]:
+                to_close.extend(self._idle.pop(key))
+            self._size -= len(to_close)
+            self._counters['evictions_total'] += len(to_close)
+            for entry in self._in_use.values():
+                if entry.key[0] == group:
+                    entry.discard = True
+            self._cond.notify_all()
+        self._close(to_close)
+
+    def close_all(self):
+        """アイドル接続をすべて閉じる（使用中の接続は返却時に閉じる）"""
+        to_close = []
+        with self._cond:
+            for idle in self._idle.values():
+                to_close.extend(idle)
+            self._idle.clear()
+            self._size -= len(to_close)
+            for entry in self._in_use.values():
+                entry.discard = True
+            self._cond.notify_all()
+        self._close(to_close)
+
+    def stats(self):
+        """監視用の接続数と累計値"""
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'open': self._size,
+                'in_use': len(self._in_use),
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'keys': len(self._idle),
+                'logins': len(self._group_tokens),
+                **self._counters,
+            }
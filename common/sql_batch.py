@@ -0,0 +1,222 @@
+"""複数文のSQLスクリプトのバッチ実行
+
+スクリプトを文ごとに分割し、次のどちらかで実行して文ごとの結果と処理時間を返す。
+
+- parallel:   独立した文として、プールの接続で並列に実行する。
+              スレッドプールは全リクエストで共有し、同時実行数は Warehouse ごとに制限する。
+- sequential: コネクタの複数文実行（execute_stream、execute_string のストリーム版）で
+              1つの接続で順に実行する。前の文に依存するスクリプト向け。エラーが出たら以降は実行しない。
+
+参照系（SELECT / WITH / SHOW / DESCRIBE 等）以外の文を含むスクリプトは、
+parallel を指定しても sequential で実行する（INSERT の後の SELECT 等、順序に依存しうるため）。
+"""
+import contextlib
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .columnar import fetch_arrow_batches, read_table
+from .metrics import phase
+from .sql_results import batch_to_html
+from .sf_pool import changes_session_state, is_read_only
+
+MODES = ('parallel', 'sequential')
+
+
+class BatchError(Exception):
+    """スクリプトをバッチとして実行できない（文が多すぎる、PUT/GET を含む等）"""
+
+
+class StatementResult:
+    """1文の実行結果（行は max_rows 行まで、pyarrow.Table か行タプルのリストで保持する）"""
+    __slots__ = ('index', 'sql', 'status', 'columns', 'rows', 'row_count', 'truncated',
+                 'query_id', 'error', 'queued_seconds', 'elapsed_seconds')
+
+    def __init__(self, index, sql):
+        self.index = index
+        self.sql = sql
+        self.status = 'pending'  # pending / success / error / skipped
+        self.columns = []
+        self.rows = []
+        self.row_count = 0
+        self.truncated = False
+        self.query_id = None
+        self.error = None
+        self.queued_seconds = 0.0   # Warehouse の同時実行枠・スレッドの空きを待った時間
+        self.elapsed_seconds = 0.0  # 接続取得・実行・結果取得の時間
+
+    def read(self, cursor, max_rows):
+        self.query_id = cursor.sfqid
+        self.columns = [desc[0] for desc in cursor.description] if cursor.description else []
+        if cursor.description:
+            tables = fetch_arrow_batches(cursor)
+            if tables is not None:
+                # 列指向のまま保持する（行タプルを作らない）
+                self.rows, self.truncated = read_table(tables, max_rows)
+            else:
+                self.rows = cursor.fetchmany(max_rows) if max_rows else cursor.fetchall()
+                self.truncated = bool(max_rows) and cursor.fetchone() is not None
+        self.row_count = len(self.rows)
+        self.status = 'success'
+
+    def rows_html(self):
+        return batch_to_html(self.rows)
+
+
+class BatchResult:
+    def __init__(self, mode, statements):
+        self.mode = mode
+        self.statements = statements
+        self.elapsed_seconds = 0.0
+
+    @property
+    def succeeded(self):
+        return sum(1 for s in self.statements if s.status == 'success')
+
+    @property
+    def failed(self):
+        return sum(1 for s in self.statements if s.status == 'error')
+
+    @property
+    def statement_seconds(self):
+        """文ごとの処理時間の合計（順に実行した場合の目安）"""
+        return sum(s.elapsed_seconds for s in self.statements)
+
+
+def split_script(script):
+    """スクリプトを文のリストに分割する（コメント・空の文は除く）"""
+    from snowflake.connector.util_text import split_statements
+    statements = []
+    for statement, is_put_or_get in split_statements(io.StringIO(script), remove_comments=True):
+        if not statement.rstrip(';').strip():
+            continue
+        if is_put_or_get:
+            # サーバー上のファイルを読み書きさせない
+            raise BatchError('PUT / GET 文はバッチ実行できません')
+        statements.append(statement)
+    return statements
+
+
+class BatchExecutor:
+    """スクリプトを文ごとに実行する（スレッドプールは全リクエストで共有する）"""
+
+    def __init__(self, max_workers=8, max_per_warehouse=4, max_statements=50, max_rows=100):
+        self.max_workers = max_workers
+        self.max_per_warehouse = max_per_warehouse
+        self.max_statements = max_statements
+        self.max_rows = max_rows
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='sql-batch')
+        self._slots = {}  # Warehouse -> [同時実行数の枠, 使っているバッチの数]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _warehouse_slots(self, warehouse):
+        """Warehouse の同時実行数の枠（使っているバッチがなくなったら捨て、Warehouse 名の数だけ増やさない）"""
+        key = (warehouse or '').upper()
+        with self._lock:
+            entry = self._slots.get(key)
+            if entry is None:
+                entry = self._slots[key] = [threading.BoundedSemaphore(self.max_per_warehouse), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._slots[key]
+
+    def run(self, pool, access_token, script, mode='parallel', role=None, warehouse=None):
+        """スクリプトを実行し、BatchResult を返す（文ごとのエラーは結果に入れる）"""
+        if mode not in MODES:
+            raise BatchError(f'不明な実行モードです: {mode}')
+        statements = split_script(script)
+        if not statements:
+            raise BatchError('実行する文がありません')
+        if len(statements) > self.max_statements:
+            raise BatchError(f'文が多すぎます（{len(statements)} 文、上限 {self.max_statements} 文）')
+        if mode == 'parallel' and not all(is_read_only(sql) for sql in statements):
+            mode = 'sequential'
+
+        result = BatchResult(mode, [StatementResult(i + 1, sql) for i, sql in enumerate(statements)])
+        started = time.perf_counter()
+        with phase('batch'):
+            if mode == 'parallel':
+                self._run_parallel(pool, access_token, result.statements, role, warehouse)
+            else:
+                self._run_sequential(pool, access_token, result.statements, role, warehouse)
+        result.elapsed_seconds = time.perf_counter() - started
+        return result
+
+    def _run_parallel(self, pool, access_token, statements, role, warehouse):
+        with self._warehouse_slots(warehouse) as slots:
+            self._run_with_slots(pool, access_token, statements, role, warehouse, slots)
+
+    def _run_with_slots(self, pool, access_token, statements, role, warehouse, slots):
+        def execute(conn, statement):
+            cursor = conn.cursor()
+            try:
+                cursor.execute(statement.sql)
+                statement.read(cursor, self.max_rows)
+            finally:
+                cursor.close()
+
+        def run_statement(statement, submitted):
+            started = time.perf_counter()
+            statement.queued_seconds = started - submitted
+            try:
+                pool.run(access_token, lambda conn: execute(conn, statement), role=role, warehouse=warehouse)
+            except Exception as e:
+                statement.status = 'error'
+                statement.error = str(e)
+            finally:
+                statement.elapsed_seconds = time.perf_counter() - started
+                slots.release()
+
+        futures = []
+        for statement in statements:
+            # 枠が空くまでリクエストのスレッドで待つ（共有スレッドを待ちで塞がない）
+            submitted = time.perf_counter()
+            slots.acquire()
+            try:
+                futures.append(self._executor.submit(run_statement, statement, submitted))
+            except BaseException:
+                slots.release()
+                raise
+        for future in futures:
+            future.result()
+
+    def _run_sequential(self, pool, access_token, statements, role, warehouse):
+        from snowflake.connector.errors import ProgrammingError
+        # 分割済みの文をつなげて渡し、コネクタ側の分割と文の数・順序を揃える
+        script = '\n'.join(s.sql if s.sql.rstrip().endswith(';') else s.sql + ';' for s in statements)
+        with pool.connection(access_token, role=role, warehouse=warehouse) as conn:
+            started = time.perf_counter()
+            try:
+                for statement, cursor in zip(statements, conn.execute_stream(io.StringIO(script))):
+                    try:
+                        statement.read(cursor, self.max_rows)
+                    finally:
+                        cursor.close()
+                        statement.elapsed_seconds = time.perf_counter() - started
+                        started = time.perf_counter()
+            except Exception as e:
+                # 実行または結果の取得に失敗した文（以降の文は実行しない）
+                failed = next((s for s in statements if s.status == 'pending'), None)
+                if failed is not None:
+                    failed.status = 'error'
+                    failed.error = str(e)
+                    failed.elapsed_seconds = time.perf_counter() - started
+                if not isinstance(e, ProgrammingError):
+                    pool.discard(conn)
+            finally:
+                # 同じ接続でセッション状態が変わっている可能性があるので再利用しない
+                if any(changes_session_state(s.sql) for s in statements):
+                    pool.discard(conn)
+        for statement in statements:
+            if statement.status == 'pending':
+                statement.status = 'skipped'
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
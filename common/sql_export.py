@@ -0,0 +1,202 @@
+"""クエリ結果のエクスポート（CSV / NDJSON / Arrow IPC / Parquet）
+
+結果は Snowflake の Arrow バッチ（fetch_arrow_batches）から直接書き出し、
+Python の行タプルを作らずに一定メモリでストリーミングダウンロードする。
+Arrow 形式で受け取れない結果（SHOW 等）は fetchmany にフォールバックする。
+"""
+import csv
+import io
+import json
+
+from flask import Response, stream_with_context
+
+from .columnar import fetch_arrow_batches, load_pyarrow, normalize_table
+from .sql_results import execute_on_pool
+
+# format -> (Content-Type, 拡張子)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+class ExportError(Exception):
+    """エクスポートできない形式・環境"""
+
+
+class _ChunkSink(io.RawIOBase):
+    """pyarrow の書き込み先。書かれたバイト列を溜めて drain() で取り出す"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ExportResult:
+    """エクスポートしたクエリの記録（クエリ履歴に渡す、送信したバイト数は送り終えた時点の値）"""
+
+    cache_status = None
+    truncated = False  # エクスポートは行数の上限なし
+
+    def __init__(self, cursor):
+        self.query_id = getattr(cursor, 'sfqid', None)
+        self.row_count = cursor.rowcount  # 結果の行数（Snowflake が実行時に返す）
+        self.response_bytes = 0
+        self.error = None
+
+
+def _row_batches(cursor, batch_size):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _rows_to_table(columns, rows):
+    pa = load_pyarrow()
+    return pa.Table.from_arrays([pa.array(values) for values in zip(*rows)], names=columns)
+
+
+def _iter_csv(cursor, columns, batch_size):
+    batches = fetch_arrow_batches(cursor)
+    if batches is not None:
+        import pyarrow.csv as pa_csv
+        first = True
+        for table in batches:
+            sink = _ChunkSink()
+            pa_csv.write_csv(table, sink, write_options=pa_csv.WriteOptions(include_header=first))
+            first = False
+            yield sink.drain()
+        if first:
+            yield (','.join(columns) + '\n').encode('utf-8')
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in _row_batches(cursor, batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _iter_ndjson(cursor, columns, batch_size):
+    batches = fetch_arrow_batches(cursor)
+    if batches is not None:
+        records = (table.to_pylist() for table in batches)
+    else:
+        records = ([dict(zip(columns, row)) for row in rows]
+                   for rows in _row_batches(cursor, batch_size))
+    for batch in records:
+        yield ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n'
+                      for record in batch).encode('utf-8')
+
+
+def _iter_arrow_tables(cursor, columns, batch_size):
+    batches = fetch_arrow_batches(cursor)
+    if batches is not None:
+        for table in batches:
+            yield normalize_table(table)
+    else:
+        for rows in _row_batches(cursor, batch_size):
+            yield normalize_table(_rows_to_table(columns, rows))
+
+
+def _iter_arrow_file(open_writer, cursor, columns, batch_size):
+    """スキーマ固定のライター（IPC / Parquet）にバッチを書き、書けた分から返す"""
+    sink = _ChunkSink()
+    writer = schema = None
+    for table in _iter_arrow_tables(cursor, columns, batch_size):
+        if writer is None:
+            schema = table.schema
+            writer = open_writer(sink, schema)
+        elif not table.schema.equals(schema):
+            table = table.cast(schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        pa = load_pyarrow()
+        writer = open_writer(sink, pa.schema([(name, pa.null()) for name in columns]))
+    writer.close()
+    yield sink.drain()
+
+
+def _iter_arrow_ipc(cursor, columns, batch_size):
+    import pyarrow.ipc
+    return _iter_arrow_file(pyarrow.ipc.new_stream, cursor, columns, batch_size)
+
+
+def _iter_parquet(cursor, columns, batch_size):
+    import pyarrow.parquet
+    return _iter_arrow_file(pyarrow.parquet.ParquetWriter, cursor, columns, batch_size)
+
+
+_WRITERS = {
+    'csv': _iter_csv,
+    'ndjson': _iter_ndjson,
+    'arrow': _iter_arrow_ipc,
+    'parquet': _iter_parquet,
+}
+
+
+def export_response(pool, access_token, sql, fmt, role=None, warehouse=None,
+                    batch_size=10000, filename='query_result'):
+    """クエリを実行し、結果をダウンロード用のストリーミングレスポンスで返す
+
+    レスポンスの export_result（ExportResult）に行数・送信したバイト数を記録する。
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f'未対応のエクスポート形式です: {fmt}')
+    if fmt in ('arrow', 'parquet') and load_pyarrow() is None:
+        raise ExportError(f'{fmt}形式のエクスポートには pyarrow が必要です')
+
+    cursor, release = execute_on_pool(pool, access_token, sql, role, warehouse)
+    columns = [desc[0] for desc in cursor.description] if cursor.description else []
+
+    result = ExportResult(cursor)
+
+    def generate():
+        failed = True
+        try:
+            for chunk in _WRITERS[fmt](cursor, columns, batch_size):
+                if chunk:
+                    result.response_bytes += len(chunk)
+                    yield chunk
+            failed = False
+        except Exception as e:
+            result.error = e
+            raise
+        finally:
+            release(failed)
+
+    content_type, extension = EXPORT_FORMATS[fmt]
+    response = Response(stream_with_context(generate()), content_type=content_type)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{extension}"'
+    response.export_result = result
+    # 送信前にクライアントが切断した場合も接続を返す
+    response.call_on_close(lambda: release(True))
+    return response
@@ -0,0 +1,287 @@
+"""クエリ結果のストリーミング
+
+fetchall で全行をメモリに載せる代わりにバッチ単位で取得し、
+テンプレートの描画と並行して行をブラウザへ送る。行数は上限で打ち切る。
+Arrow 形式で受け取れる結果は pyarrow.Table のまま扱い（columnar.py）、それ以外は fetchmany の行タプルを使う。
+表の行は Jinja のセルごとのループではなく、バッチ単位でエスケープ済みの HTML にまとめて出力する。
+"""
+import datetime
+import decimal
+import time
+
+from flask import Response, current_app, stream_with_context
+from markupsafe import Markup, escape
+
+from .columnar import concat_tables, fetch_arrow_batches, html_column, is_table, table_rows
+from .metrics import phase, phase_total, record_phase
+from .sf_pool import changes_session_state, is_session_expired, reconnect_token, resolve_token
+
+
+# str() の結果に HTML の特殊文字を含まない型（エスケープを省く）
+_PLAIN_TYPES = frozenset([int, float, bool, decimal.Decimal,
+                          datetime.date, datetime.datetime, datetime.time, datetime.timedelta])
+
+
+def _cell_html(cell):
+    if cell is None:
+        return 'NULL'
+    if type(cell) in _PLAIN_TYPES:
+        return str(cell)
+    return escape(cell)
+
+
+def rows_to_html(rows):
+    """行のリストを <tr> の HTML にする（セルはエスケープ済み、NULL は 'NULL'）"""
+    return Markup(''.join(['<tr><td>' + '</td><td>'.join(map(_cell_html, row)) + '</td></tr>\n'
+                           for row in rows]))
+
+
+def table_to_html(table):
+    """pyarrow.Table を <tr> の HTML にする（文字列化・エスケープは列ごとにまとめて行う）"""
+    columns = []
+    for column in table.columns:
+        cells = html_column(column)
+        if cells is None:
+            cells = [_cell_html(value) for value in column.to_pylist()]
+        columns.append(cells)
+    return Markup(''.join(['<tr><td>' + '</td><td>'.join(row) + '</td></tr>\n'
+                           for row in zip(*columns)]))
+
+
+def batch_to_html(batch):
+    """行タプルのリストまたは pyarrow.Table を <tr> の HTML にする"""
+    return table_to_html(batch) if is_table(batch) else rows_to_html(batch)
+
+
+def _join_batches(batches):
+    if batches and is_table(batches[0]):
+        return concat_tables(batches)
+    return [row for rows in batches for row in rows]
+
+
+class ResultStream:
+    """カーソルからバッチ単位で行を読み出すイテレータ（1回だけ走査できる）"""
+
+    def __init__(self, cursor, batch_size=1000, max_rows=10000, on_close=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.columns = [desc[0] for desc in cursor.description] if cursor.description else []
+        self.row_count = 0
+        self.truncated = False
+        self.error = None
+        self.cache_status = None  # 結果キャッシュを使った場合 'HIT' / 'MISS'
+        self.query_id = getattr(cursor, 'sfqid', None)
+        self.response_bytes = 0  # html_chunks() で出力した HTML のバイト数（UTF-8、クエリ履歴に記録）
+        self._on_close = on_close
+        self._closed = False
+        self._collected = None
+        self._collect_limit = 0
+        self._on_complete = None
+
+    def collect(self, limit, on_complete):
+        """読み出した行を limit 行まで保持し、最後まで読み切れたら on_complete(columns, rows) を呼ぶ
+
+        rows は Arrow で受け取れた結果なら pyarrow.Table、それ以外は行タプルのリスト。
+        """
+        self._collected = []
+        self._collect_limit = limit
+        self._on_complete = on_complete
+
+    def _fetch_batches(self):
+        tables = fetch_arrow_batches(self.cursor)
+        if tables is not None:
+            yield from self._slice_tables(iter(tables))
+            return
+        while not self.max_rows or self.row_count < self.max_rows:
+            size = self.batch_size
+            if self.max_rows:
+                size = min(size, self.max_rows - self.row_count)
+            started = time.perf_counter()
+            rows = self.cursor.fetchmany(size)
+            record_phase('fetch', time.perf_counter() - started)
+            if not rows:
+                return
+            yield rows
+        # 上限に達した時点で残りの行があるかだけ確認する
+        self.truncated = self.cursor.fetchone() is not None
+
+    def _slice_tables(self, tables):
+        """Arrow バッチを batch_size 行ずつに切って返す（行タプルは作らない）"""
+        while True:
+            started = time.perf_counter()
+            table = next(tables, None)
+            record_phase('fetch', time.perf_counter() - started)
+            if table is None:
+                return
+            offset = 0
+            while offset < table.num_rows:
+                if self.max_rows and self.row_count >= self.max_rows:
+                    self.truncated = True
+                    return
+                size = self.batch_size
+                if self.max_rows:
+                    size = min(size, self.max_rows - self.row_count)
+                batch = table.slice(offset, size)
+                offset += batch.num_rows
+                yield batch
+
+    def batches(self):
+        """行をバッチ単位で返す（Arrow で受け取れた結果は pyarrow.Table、それ以外は行タプルのリスト）"""
+        collected_rows = 0
+        try:
+            for batch in self._fetch_batches():
+                if self._collected is not None:
+                    collected_rows += len(batch)
+                    if collected_rows <= self._collect_limit:
+                        self._collected.append(batch)
+                    else:
+                        self._collected = None
+                self.row_count += len(batch)
+                yield batch
+            if self._collected is not None and not self.truncated and self._on_complete:
+                self._on_complete(self.columns, _join_batches(self._collected))
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self._collected = None
+            self.close()
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from table_rows(batch) if is_table(batch) else batch
+
+    def html_chunks(self):
+        """表の行をバッチ単位の HTML 断片として返す（テンプレートでセルごとにループしない）"""
+        for batch in self.batches():
+            html = batch_to_html(batch)
+            self.response_bytes += len(html.encode('utf-8'))
+            yield html
+
+    def close(self):
+        """カーソルを閉じて接続をプールに返す（何度呼んでもよい）"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close:
+            self._on_close(self.error is not None)
+        else:
+            self.cursor.close()
+
+
+class CachedResultStream(ResultStream):
+    """結果キャッシュから返す ResultStream（Snowflake に接続しない、rows は行タプルのリストか pyarrow.Table）"""
+
+    def __init__(self, columns, rows, max_rows=10000):
+        self.rows = rows
+        self.batch_size = len(rows) or 1
+        self.max_rows = max_rows
+        self.columns = columns
+        self.row_count = 0
+        self.truncated = bool(max_rows) and len(rows) > max_rows
+        self.error = None
+        self.cache_status = 'HIT'
+        self.query_id = None
+        self.response_bytes = 0
+        self._closed = True
+
+    def batches(self):
+        rows = self.rows[:self.max_rows] if self.max_rows else self.rows
+        self.row_count = len(rows)
+        if rows:
+            yield rows
+
+    def close(self):
+        pass
+
+
+def execute_on_pool(pool, access_token, sql, role=None, warehouse=None, query_id=None):
+    """プールの接続でクエリを実行し、(cursor, release) を返す
+
+    query_id を指定した場合は実行せず、非同期実行済みクエリの結果を取得する。
+    接続は release(failed) を呼ぶまで借りたままになる（release は何度呼んでもよい）。
+    セッションの期限切れで失敗した場合は新しい接続で1回だけ再実行する
+    （トークンが拒否された場合は、トークンプロバイダで更新したトークンで接続する）。
+    """
+    token = resolve_token(access_token)
+    fresh = False
+    while True:
+        conn = None
+        try:
+            # OAuth トークンが拒否された場合は接続（ログイン）の時点で失敗する
+            with phase('connect'):
+                conn = pool.acquire(token, role, warehouse, fresh=fresh)
+            cursor = conn.cursor()
+            with phase('execute'):
+                if query_id:
+                    cursor.get_results_from_sfqid(query_id)
+                else:
+                    cursor.execute(sql)
+            break
+        except BaseException as e:
+            # セッション・トークンの期限切れなら、新しく接続して1回だけ再実行する
+            from snowflake.connector.errors import ProgrammingError
+            if conn is not None:
+                if is_session_expired(e) or not isinstance(e, ProgrammingError):
+                    pool.discard(conn)
+                pool.release(conn)
+            token = None if fresh else reconnect_token(access_token, e)
+            if not token:
+                raise
+            pool.count_reconnect()
+            fresh = True
+
+    released = []
+
+    def release(failed=False):
+        # レスポンス終了時にも呼ばれるので、2回目以降は何もしない
+        if released:
+            return
+        released.append(True)
+        try:
+            cursor.close()
+        finally:
+            # USE / ALTER SESSION 等でセッション状態が変わった接続や、読み出しに失敗した接続は再利用しない
+            if failed or (not query_id and changes_session_state(sql)):
+                pool.discard(conn)
+            pool.release(conn)
+
+    return cursor, release
+
+
+def open_result_stream(pool, access_token, sql, role=None, warehouse=None,
+                       batch_size=1000, max_rows=10000, query_id=None):
+    """プールの接続でクエリを実行し、結果を ResultStream で返す
+
+    接続は結果を読み終えるか close() されるまで借りたままになる。
+    """
+    cursor, release = execute_on_pool(pool, access_token, sql, role, warehouse, query_id=query_id)
+    return ResultStream(cursor, batch_size=batch_size, max_rows=max_rows, on_close=release)
+
+
+def stream_template(template_name, buffer_size=50, **context):
+    """テンプレートを少しずつ描画しながらレスポンスとして送る
+
+    buffer_size 個の断片ごとにまとめて送るので、小さな書き込みが大量に発生しない。
+    context 内の ResultStream はレスポンス終了時（クライアント切断時も含む）に閉じる。
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(buffer_size)
+
+    def generate():
+        # 描画時間は送信完了までの時間から、その間の fetch の時間を除いたもの
+        started = time.perf_counter()
+        fetched = phase_total('fetch')
+        try:
+            yield from stream
+        finally:
+            record_phase('render', time.perf_counter() - started - (phase_total('fetch') - fetched))
+
+    response = Response(stream_with_context(generate()), mimetype='text/html')
+    for value in context.values():
+        if isinstance(value, ResultStream):
+            response.call_on_close(value.close)
+    return response
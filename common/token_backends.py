@@ -0,0 +1,271 @@
+"""トークンの保存先（メモリ / SQLite / Redis）
+
+キーはログインごとに発行するランダムな値（Flask セッションに保存）で、
+トークン本体はサーバー側にだけ置く。どの保存先も期限（expires_at）を過ぎた
+エントリは返さない。TOKEN_STORE_URL で選ぶ:
+
+- memory://                  プロセス内の dict（開発用・単一プロセス向け、Redis の代わり）
+- sqlite:///path/tokens.db   複数ワーカーで共有するファイル
+- redis://host:6379/0        複数ホストで共有（redis パッケージが必要）
+
+最終利用時刻（touch）も保存し、バックグラウンド更新は最近使われたキーだけを対象にする（keys(active_since)）。
+acquire_lease() は同じ保存先を使うプロセスのうち1つだけが True を得るリース（バックグラウンド更新を1プロセスで行う）。
+lock(key) はキーごとのプロセス間ロックで、IdP の応答を待つ間も他のユーザーのリフレッシュは止めない。
+Redis のロックは lock_wait_timeout 秒で待つのをやめて LockTimeout を送出する（TokenStore は保存済みのトークンを読み直す）。
+"""
+import contextlib
+import hashlib
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from .token_store import LockTimeout, file_lock
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし（開発サーバーのみ想定）
+    fcntl = None
+
+
+class MemoryTokenBackend:
+    """プロセス内の LRU（件数上限と期限で捨てる）"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (token_data, expires_at)
+        self._used = {}                # key -> 最終利用時刻
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(64)]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            token_data, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._used.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return token_data
+
+    def set(self, key, token_data, expires_at):
+        with self._lock:
+            self._entries[key] = (token_data, expires_at)
+            self._entries.move_to_end(key)
+            self._used.setdefault(key, time.time())
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._used.pop(evicted, None)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._used.pop(key, None)
+
+    def touch(self, key, used_at):
+        with self._lock:
+            if key in self._entries:
+                self._used[key] = used_at
+
+    def keys(self, active_since=None):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+                self._used.pop(key, None)
+            return [key for key in self._entries
+                    if active_since is None or self._used.get(key, 0) >= active_since]
+
+    def lock(self, key):
+        # 同じ TokenStore の同時更新はシングルフライトで1回にまとめているので、ここではスレッドの更新と
+        # ASGI 版（AsyncTokenStore）の更新が重ならないようにする（解放は取得と別のスレッドでもよい）
+        return self._key_locks[hash(key) % len(self._key_locks)]
+
+    def acquire_lease(self, name, ttl):
+        # プロセス内だけの保存先なので、常にこのプロセスが担当する
+        return True
+
+
+class SQLiteTokenBackend:
+    """SQLite ファイル（同じホストの複数ワーカーで共有）"""
+
+    LOCK_STRIPES = 64  # キーのハッシュで分けるロックファイルの数
+
+    def __init__(self, path, table='tokens'):
+        if not table.isidentifier():
+            raise ValueError(f'不正なテーブル名です: {table}')
+        self.path = path
+        self.table = table
+        self.lock_path = path + '.lock'
+        self._local = threading.local()
+        self._lease_file = None
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                         '(key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, last_used_at REAL)')
+            if 'last_used_at' not in [row[1] for row in conn.execute(f'PRAGMA table_info({self.table})')]:
+                # 最終利用時刻の列がない以前のファイル
+                conn.execute(f'ALTER TABLE {self.table} ADD COLUMN last_used_at REAL')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_expires_at ON {self.table} (expires_at)')
+
+    def _connect(self):
+        # sqlite3 の接続はスレッドをまたいで使えないのでスレッドごとに開く
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            f'SELECT data FROM {self.table} WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, token_data, expires_at):
+        # 最終利用時刻は新しいキーの保存（ログイン）時だけ設定し、リフレッシュでは引き継ぐ
+        with self._connect() as conn:
+            conn.execute(f'INSERT INTO {self.table} (key, data, expires_at, last_used_at) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+                         (key, json.dumps(token_data), expires_at, time.time()))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def touch(self, key, used_at):
+        with self._connect() as conn:
+            conn.execute(f'UPDATE {self.table} SET last_used_at = ? WHERE key = ?', (used_at, key))
+
+    def keys(self, active_since=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(f'DELETE FROM {self.table} WHERE expires_at <= ?', (now,))
+            if active_since is None:
+                return [row[0] for row in conn.execute(f'SELECT key FROM {self.table}')]
+            return [row[0] for row in conn.execute(f'SELECT key FROM {self.table} WHERE last_used_at >= ?',
+                                                   (active_since,))]
+
+    def lock(self, key):
+        # 他のワーカーと同じ refresh_token で同時に更新しないようにする
+        # （ロックファイルはキーのハッシュで分け、他のユーザーの IdP の応答を待たない）
+        stripe = int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) % self.LOCK_STRIPES
+        return file_lock(f'{self.lock_path}.{stripe:02x}')
+
+    def acquire_lease(self, name, ttl):
+        """ロックファイルを待たずにロックし、取れたらプロセスの終了まで持ち続ける（ttl は使わない）"""
+        if fcntl is None:
+            return True
+        if self._lease_file is not None:
+            return True
+        f = open(f'{self.path}.{name}.lock', 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lease_file = f
+        return True
+
+
+class RedisTokenBackend:
+    """Redis（複数ホストで共有、期限は Redis の TTL で管理）"""
+
+    def __init__(self, url, prefix='oauth-token:', lock_timeout=60, lock_wait_timeout=None):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('TOKEN_STORE_URL に redis:// を使うには redis パッケージが必要です')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        # ロックを待つ最長時間（持っているプロセスが止まっても、期限切れまで全員を待たせない）
+        self.lock_wait_timeout = lock_timeout if lock_wait_timeout is None else lock_wait_timeout
+        self.active_key = prefix + 'active'  # 最終利用時刻をスコアにしたソート済みセット
+        self._nonce = secrets.token_hex(4)
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return json.loads(data) if data else None
+
+    def set(self, key, token_data, expires_at):
+        ttl = max(1, int(expires_at - time.time()))
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, json.dumps(token_data), ex=ttl)
+        pipe.zadd(self.active_key, {key: time.time()}, nx=True)
+        pipe.execute()
+
+    def delete(self, key):
+        pipe = self.client.pipeline()
+        pipe.delete(self.prefix + key)
+        pipe.zrem(self.active_key, key)
+        pipe.execute()
+
+    def touch(self, key, used_at):
+        self.client.zadd(self.active_key, {key: used_at})
+
+    def keys(self, active_since=None):
+        if active_since is not None:
+            # 期間内に使われていないキー（期限切れで消えたものを含む）は次に使われるまで対象外
+            self.client.zremrangebyscore(self.active_key, '-inf', f'({active_since}')
+            return [name.decode('utf-8') for name in self.client.zrangebyscore(self.active_key, active_since, '+inf')]
+        # ロック・リース・最終利用時刻のキーを除く（ログインごとのキーには ':' を含まない）
+        names = (name.decode('utf-8')[len(self.prefix):] for name in self.client.scan_iter(match=self.prefix + '*'))
+        return [name for name in names if ':' not in name and name != 'active']
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        # lock_timeout はリフレッシュの最長時間（OAuthHTTPClient.max_duration）より長くする
+        # （途中で期限が切れると、他のプロセスが同じ refresh_token で更新してしまう）
+        from redis.exceptions import LockError
+        # ASGI 版（AsyncTokenStore）は取得と解放を別のスレッドで行うので、ロックのトークンをスレッドごとに持たない
+        lock = self.client.lock(f'{self.prefix}lock:{key}', timeout=self.lock_timeout,
+                                blocking_timeout=self.lock_wait_timeout, thread_local=False)
+        if not lock.acquire():
+            raise LockTimeout(f'{self.lock_wait_timeout}秒待ってもトークンのロックを取れませんでした')
+        try:
+            yield
+        finally:
+            try:
+                lock.release()
+            except LockError:  # 期限切れで他のプロセスに渡った
+                pass
+
+    def acquire_lease(self, name, ttl):
+        """ttl 秒のリースを取るか延長する（担当のプロセスが止まれば ttl 後に他のプロセスが引き継ぐ）"""
+        lease = f'{self.prefix}lease:{name}'
+        owner = f'{socket.gethostname()}:{os.getpid()}:{self._nonce}'
+        if self.client.set(lease, owner, nx=True, ex=ttl):
+            return True
+        if self.client.get(lease) == owner.encode('utf-8'):
+            self.client.expire(lease, ttl)
+            return True
+        return False
+
+
+def open_backend(url, namespace='tokens', lock_timeout=60, lock_wait_timeout=None):
+    """TOKEN_STORE_URL から保存先を作る（未指定ならメモリ）
+
+    namespace を変えると同じ保存先に別の種類のデータ（非同期クエリの一覧等）を置ける
+    （SQLite はテーブル、Redis はキーの接頭辞を分ける）。lock_timeout は Redis のロックの期限（秒）、
+    lock_wait_timeout はロックを待つ最長時間（秒、省略時は lock_timeout）。
+    """
+    parsed = urlparse(url or 'memory://')
+    if parsed.scheme == 'memory':
+        return MemoryTokenBackend()
+    if parsed.scheme == 'sqlite':
+        path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else parsed.path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        return SQLiteTokenBackend(path, table=namespace)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisTokenBackend(url, prefix='oauth-token:' if namespace == 'tokens' else f'oauth-{namespace}:',
+                                 lock_timeout=lock_timeout, lock_wait_timeout=lock_wait_timeout)
+    raise ValueError(f'未対応の TOKEN_STORE_URL です: {url}')
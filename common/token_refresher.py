@@ -0,0 +1,183 @@
+"""バックグラウンドでのトークン事前更新
+
+リクエスト処理中にトークンエンドポイントを待たないよう、
+期限より前（ジッター付き）に別スレッドでリフレッシュする。
+対象は active_window 秒以内に使われたトークンだけにし（使われていないログインは
+次のリクエスト時に更新する）、失敗時はユーザーごとに指数バックオフで再試行する。
+複数ワーカーでは保存先のリースを取れた1プロセスだけが更新する。
+"""
+import random
+import threading
+import time
+
+
+class TokenRefresher:
+    """TokenStore のトークンを期限前に更新するデーモンスレッド"""
+
+    def __init__(self, store, refresh_ratio=0.5, jitter_ratio=0.1,
+                 min_backoff=5, max_backoff=300, idle_interval=60, active_window=3600):
+        self.store = store
+        self.refresh_ratio = refresh_ratio   # 有効期間のこの割合が経過したら更新
+        self.jitter_ratio = jitter_ratio     # 有効期間のこの割合まで更新を前倒し（ランダム）
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.idle_interval = idle_interval   # 保存先を確認し直す最大間隔（他ワーカーでのログインを拾う）
+        self.active_window = active_window   # この秒数以内に使われたトークンだけ更新する
+        self.lease_ttl = idle_interval * 3   # 担当プロセスが止まったら他のプロセスが引き継ぐまでの時間
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self._state_lock = threading.Lock()
+        self._schedule = {}   # key -> (access_token, 更新予定時刻)（ジッターをループごとに振り直さない）
+        self._failures = {}   # key -> (連続失敗回数, 最終失敗時刻)
+        self._next_refresh_at = None
+        self._last_success_at = None
+        self._last_failure_at = None
+        self._refresh_count = 0
+        self._failure_count = 0
+        self._tracked_tokens = 0
+        self._leader = False
+
+        # ログイン・ログアウトでトークンが変わったら次回更新時刻を計算し直す
+        store.add_listener(lambda old, new: self._wakeup.set())
+
+    def start(self):
+        """スレッドを起動（起動済みなら何もしない）"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def state(self):
+        """監視用の状態（時刻はUNIX秒）"""
+        with self._state_lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'leader': self._leader,
+                'tracked_tokens': self._tracked_tokens,
+                'next_refresh_at': self._next_refresh_at,
+                'last_success_at': self._last_success_at,
+                'last_failure_at': self._last_failure_at,
+                'consecutive_failures': max((count for count, _ in self._failures.values()), default=0),
+                'refresh_count': self._refresh_count,
+                'failure_count': self._failure_count,
+            }
+
+    def _refresh_at(self, token_data):
+        """次に更新すべき時刻（リクエスト側の期限チェックより必ず前）"""
+        expires_in = token_data.get('expires_in', 3600)
+        obtained_at = token_data.get('obtained_at', 0)
+        refresh_at = min(obtained_at + expires_in * self.refresh_ratio,
+                         obtained_at + expires_in - self.store.buffer_seconds)
+        # 複数プロセス・複数ユーザーの更新が同時に集中しないようにずらす
+        return refresh_at - random.uniform(0, expires_in * self.jitter_ratio)
+
+    def _backoff(self, failures):
+        delay = min(self.max_backoff, self.min_backoff * (2 ** (failures - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _next_at(self, key, token_data, now):
+        scheduled = self._schedule.get(key)
+        if scheduled is not None and scheduled[0] == token_data.get('access_token'):
+            return scheduled[1]
+        next_at = self._refresh_at(token_data)
+        failures, last_failure_at = self._failures.get(key, (0, None))
+        if failures:
+            next_at = max(next_at, (last_failure_at or now) + self._backoff(failures))
+        self._schedule[key] = (token_data.get('access_token'), next_at)
+        return next_at
+
+    def _lead(self):
+        """このプロセスが更新を担当するか（リースを取るか延長する）"""
+        try:
+            leader = self.store.acquire_lease('token-refresher', self.lease_ttl)
+        except Exception as e:
+            print(f"Token refresher lease error: {str(e)}")
+            leader = False
+        with self._state_lock:
+            self._leader = leader
+            if not leader:
+                self._schedule.clear()
+                self._failures.clear()
+                self._tracked_tokens = 0
+                self._next_refresh_at = None
+        return leader
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._lead():
+                self._wakeup.wait(self.idle_interval)
+                self._wakeup.clear()
+                continue
+
+            now = time.time()
+            due = []
+            next_at = None
+            keys = self.store.keys(active_since=now - self.active_window)
+            for key in keys:
+                token_data = self.store.load(key)
+                if not token_data or not token_data.get('refresh_token'):
+                    continue
+                at = self._next_at(key, token_data, now)
+                if at <= now:
+                    due.append((key, token_data))
+                elif next_at is None or at < next_at:
+                    next_at = at
+
+            # ログアウト・期限切れで消えたキーの予定は捨てる
+            live = set(keys)
+            with self._state_lock:
+                for key in [key for key in self._schedule if key not in live]:
+                    self._schedule.pop(key, None)
+                    self._failures.pop(key, None)
+                self._tracked_tokens = len(live)
+                self._next_refresh_at = next_at
+
+            for key, token_data in due:
+                if self._stopped.is_set():
+                    return
+                self._refresh_once(key, token_data)
+            if due:
+                continue
+
+            wait = self.idle_interval if next_at is None else min(next_at - now, self.idle_interval)
+            if wait > 0:
+                self._wakeup.wait(wait)
+                self._wakeup.clear()
+
+    def _refresh_once(self, key, token_data):
+        # 読み込んだトークンの残り時間を buffer にして更新を依頼する
+        # （リクエスト側で先に更新済みなら、新しいトークンには余裕があるので再更新されない）
+        expires_in = token_data.get('expires_in', 3600)
+        buffer_seconds = expires_in - (time.time() - token_data.get('obtained_at', 0)) + 1
+        try:
+            new_token_data = self.store.refresh_if_expiring(key, buffer_seconds)
+            error = None if new_token_data else 'token refresh failed'
+        except Exception as e:
+            new_token_data = None
+            error = str(e)
+
+        now = time.time()
+        with self._state_lock:
+            self._schedule.pop(key, None)
+            if new_token_data:
+                self._last_success_at = now
+                self._failures.pop(key, None)
+                self._refresh_count += 1
+                failures = 0
+            else:
+                failures = self._failures.get(key, (0, None))[0] + 1
+                self._failures[key] = (failures, now)
+                self._last_failure_at = now
+                self._failure_count += 1
+        if error:
+            print(f"Background token refresh failed ({failures}): {error}")
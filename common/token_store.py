@@ -0,0 +1,356 @@
+"""ユーザーごとのトークン管理
+
+トークンはログインごとのキー（Flask セッションに保存するランダムな値）で
+保存先（token_backends のメモリ / SQLite / Redis）に置き、期限は expires_in
+（refresh_token があればその有効期限）に合わせる。期限切れ間近のリフレッシュは
+同じキーへの同時リクエスト間で1回にまとめ、複数ワーカー間は保存先のロックで1回にする。
+get_valid_token() のたびに最終利用時刻を記録し（touch_interval ごとに1回書き込み）、
+バックグラウンド更新は最近使われたキーだけを対象にする。
+"""
+import asyncio
+import contextlib
+import secrets
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし（開発サーバーのみ想定）
+    fcntl = None
+
+
+def is_token_expired(token_data, buffer_seconds=300):
+    """トークンが期限切れかチェック（デフォルト5分前にTrue）"""
+    if not token_data or 'expires_in' not in token_data or 'obtained_at' not in token_data:
+        return True
+
+    expires_in = token_data.get('expires_in', 3600)  # デフォルト1時間
+    obtained_at = token_data.get('obtained_at', 0)
+    current_time = int(time.time())
+
+    # 期限切れの buffer_seconds 前にTrueを返す
+    return (current_time - obtained_at) >= (expires_in - buffer_seconds)
+
+
+class LockTimeout(Exception):
+    """他のプロセスが持っている保存先のロックが待機時間内に解放されなかった"""
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """path をロックファイルとしてプロセス間の排他ロックを取る"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class _Flight:
+    """実行中のリフレッシュ（後続の呼び出し元はこの結果を待つ）"""
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class TokenStore:
+    """キーごとにトークンを保存し、リフレッシュをキー単位のシングルフライトで行う"""
+
+    def __init__(self, backend, refresh_func, buffer_seconds=300, refresh_wait_timeout=30,
+                 refresh_token_ttl=86400, touch_interval=60):
+        self.backend = backend
+        self.refresh_func = refresh_func  # refresh_token -> 新しいトークン dict または None
+        self.buffer_seconds = buffer_seconds
+        self.refresh_wait_timeout = refresh_wait_timeout
+        # レスポンスに refresh_token_expires_in がない場合の refresh_token の有効期間
+        self.refresh_token_ttl = refresh_token_ttl
+        self.touch_interval = touch_interval  # 最終利用時刻を保存先に書き込む最小間隔（秒）
+
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> _Flight
+        self._touched = {}   # key -> このプロセスで最後に最終利用時刻を書き込んだ時刻
+        self._listeners = []
+
+    @staticmethod
+    def new_key():
+        """ログインごとのキーを発行（推測できないランダムな値）"""
+        return secrets.token_urlsafe(32)
+
+    def add_listener(self, func):
+        """トークンの更新・破棄時に func(old_token, new_token) を呼ぶ"""
+        self._listeners.append(func)
+
+    def _notify(self, old_token, new_token):
+        for func in self._listeners:
+            try:
+                func(old_token, new_token)
+            except Exception as e:
+                print(f"Token listener error: {str(e)}")
+
+    def _store(self, key, token_data, previous=None):
+        # 現在時刻を追加（トークン取得時刻として記録）
+        token_data['obtained_at'] = int(time.time())
+        if token_data.get('refresh_token'):
+            if 'refresh_token_expires_in' in token_data:
+                token_data['refresh_expires_at'] = (token_data['obtained_at']
+                                                    + token_data['refresh_token_expires_in'])
+            elif previous and previous.get('refresh_token') == token_data['refresh_token']:
+                # 同じ refresh_token を引き継いだ場合は期限も引き継ぐ
+                token_data.setdefault('refresh_expires_at', previous.get('refresh_expires_at'))
+            if not token_data.get('refresh_expires_at'):
+                token_data['refresh_expires_at'] = token_data['obtained_at'] + self.refresh_token_ttl
+            expires_at = token_data['refresh_expires_at']
+        else:
+            expires_at = token_data['obtained_at'] + token_data.get('expires_in', 3600)
+        self.backend.set(key, token_data, expires_at)
+
+    def keys(self, active_since=None):
+        """保存中のキー一覧（active_since を指定するとそれ以降に使われたキーだけ、バックグラウンド更新用）"""
+        return self.backend.keys(active_since)
+
+    def acquire_lease(self, name, ttl):
+        """同じ保存先を使うプロセスのうち1つだけが True を得る（バックグラウンド更新の担当決め）"""
+        return self.backend.acquire_lease(name, ttl)
+
+    def touch(self, key):
+        """キーの最終利用時刻を記録（保存先への書き込みは touch_interval ごとに1回）"""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(key, 0) < self.touch_interval:
+                return
+            self._touched[key] = now
+            if len(self._touched) > 10000:
+                # 古い記録は捨てる（次の利用時に保存先へ書き直すだけ）
+                self._touched = {k: t for k, t in self._touched.items() if now - t < self.touch_interval}
+        try:
+            self.backend.touch(key, now)
+        except Exception as e:
+            print(f"Token touch error: {str(e)}")
+
+    def load(self, key):
+        """キーのトークンを取得（期限の確認・更新はしない）"""
+        if not key:
+            return None
+        return self.backend.get(key)
+
+    def save(self, key, token_data):
+        """トークンを保存（期限情報付き）"""
+        old_token = self.backend.get(key)
+        self._store(key, token_data)
+        if old_token:
+            self._notify(old_token, token_data)
+
+    def clear(self, key):
+        """キーのトークンを破棄（ログアウト・リフレッシュ失敗時、他のユーザーには影響しない）"""
+        if not key:
+            return
+        old_token = self.backend.get(key)
+        self.backend.delete(key)
+        with self._lock:
+            self._touched.pop(key, None)
+        if old_token:
+            self._notify(old_token, None)
+
+    def get_valid_token(self, key):
+        """有効なトークンを取得（必要に応じて自動更新）"""
+        token_data = self._get(key, self.buffer_seconds, clear_on_failure=True)
+        if token_data:
+            self.touch(key)
+        return token_data
+
+    def refresh_if_expiring(self, key, buffer_seconds):
+        """期限まで buffer_seconds を切っていれば更新する（バックグラウンド更新用）
+
+        失敗してもトークンは破棄せず None を返す（呼び出し側で再試行する）。
+        """
+        return self._get(key, buffer_seconds, clear_on_failure=False)
+
+    def refresh_rejected(self, key, access_token):
+        """Snowflake に拒否された access_token を期限前でも更新する（接続し直す前に呼ぶ）
+
+        他のリクエスト・プロセスが既に更新していればそのトークンを返す。更新できなければ None。
+        """
+        token_data = self.load(key)
+        if token_data and token_data.get('access_token') != access_token:
+            return token_data
+        token_data = self._get(key, float('inf'), clear_on_failure=False)
+        if token_data and token_data.get('access_token') != access_token:
+            return token_data
+        return None
+
+    def provider(self, key, token_data, refresh_rejected=None):
+        """接続プールに渡すトークンプロバイダ（sf_pool.resolve_token）
+
+        provide() は現在のアクセストークンを、provide(refresh=True) は Snowflake に拒否された
+        トークンを更新して新しいアクセストークン（更新できなければ None）を返す。
+        refresh_rejected(key, access_token) で更新の方法を差し替えられる（ASGI 版の非同期HTTPクライアント）。
+        """
+        refresh_rejected = refresh_rejected or self.refresh_rejected
+        current = [token_data.get('access_token')]
+
+        def provide(refresh=False):
+            if refresh:
+                new_token_data = refresh_rejected(key, current[0])
+                if not new_token_data:
+                    return None
+                current[0] = new_token_data.get('access_token')
+            return current[0]
+        return provide
+
+    def _get(self, key, buffer_seconds, clear_on_failure):
+        token_data = self.load(key)
+        if not token_data:
+            return None
+        if not is_token_expired(token_data, buffer_seconds):
+            return token_data
+        if not token_data.get('refresh_token'):
+            return None
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            # 同じユーザーの他のリクエストが更新中なので、その結果を待つ
+            flight.event.wait(self.refresh_wait_timeout)
+            if flight.result:
+                return flight.result
+            # 更新に失敗しても、まだ期限内のトークンが残っていればそれを使う
+            token_data = self.load(key)
+            return token_data if token_data and not is_token_expired(token_data, 0) else None
+
+        new_token_data = None
+        try:
+            new_token_data = self._refresh(key, token_data, clear_on_failure)
+        finally:
+            with self._lock:
+                flight.result = new_token_data
+                del self._inflight[key]
+            flight.event.set()
+        return new_token_data
+
+    def _refresh(self, key, token_data, clear_on_failure):
+        # 他のワーカープロセスと同じ refresh_token で同時に更新しないよう保存先のロックを取る
+        try:
+            with self.backend.lock(key):
+                current, token_data = self._reload_locked(key, token_data)
+                if not token_data:
+                    return current
+                new_token_data = self.refresh_func(token_data['refresh_token'])
+                if not self._apply_refresh(key, token_data, new_token_data, clear_on_failure):
+                    return None
+        except LockTimeout as e:
+            return self._lock_timeout(key, e)
+        self._notify(token_data, new_token_data)
+        return new_token_data
+
+    def _reload_locked(self, key, token_data):
+        """ロックを取った後に保存済みのトークンを読み直し、(そのまま返すトークン, 更新するトークン) を返す"""
+        current = self.backend.get(key)
+        if current != token_data:
+            # ロック待ちの間に他プロセスが更新（またはログアウト）した
+            if current and not is_token_expired(current, 0):
+                return current, None
+            if not current or not current.get('refresh_token'):
+                return None, None
+            token_data = current
+        return None, token_data
+
+    def _apply_refresh(self, key, token_data, new_token_data, clear_on_failure):
+        """リフレッシュの結果を保存し、リスナーに知らせるかどうかを返す"""
+        if new_token_data:
+            # リフレッシュのレスポンスに refresh_token が含まれない場合は引き継ぐ
+            new_token_data.setdefault('refresh_token', token_data['refresh_token'])
+            # scope が省略されたら要求どおり（元のトークンと同じ）スコープ（RFC 6749 5.1）
+            if token_data.get('scope'):
+                new_token_data.setdefault('scope', token_data['scope'])
+            self._store(key, new_token_data, previous=token_data)
+            return True
+        if clear_on_failure:
+            # リフレッシュに失敗した場合、このユーザーのトークンを削除
+            self.backend.delete(key)
+            return True
+        return False
+
+    def _lock_timeout(self, key, error):
+        # ロックを持つプロセスが応答しない: 他プロセスが更新済みならそれを、なければまだ期限内のトークンを使う
+        print(f"Token refresh lock error: {str(error)}")
+        current = self.backend.get(key)
+        return current if current and not is_token_expired(current, 0) else None
+
+
+class AsyncTokenStore:
+    """TokenStore の asyncio 版の入り口（ASGI アプリ用）
+
+    トークンエンドポイントとの通信は refresh_func(refresh_token)（コルーチン、新しいトークン dict または None）で
+    行い、保存先の読み書き・ロックは run_blocking(func, *args)（BlockingExecutor.run）でスレッドに渡す。
+    同じキーの同時リクエストの更新はイベントループ上で1回にまとめ、待つ側はスレッドを占有しない。
+    他のプロセス・同じプロセスの Flask アプリとは保存先のロックで1回にする。
+    """
+
+    def __init__(self, store, refresh_func, run_blocking):
+        self.store = store
+        self.refresh_func = refresh_func
+        self.run_blocking = run_blocking
+        self._inflight = {}  # key -> 実行中のリフレッシュ（asyncio.Task）
+
+    async def get_valid_token(self, key):
+        """有効なトークンを取得（必要に応じて自動更新）"""
+        token_data = await self._get(key, self.store.buffer_seconds, clear_on_failure=True)
+        if token_data:
+            await self.run_blocking(self.store.touch, key)
+        return token_data
+
+    async def refresh_rejected(self, key, access_token):
+        """TokenStore.refresh_rejected の asyncio 版"""
+        token_data = await self.run_blocking(self.store.load, key)
+        if token_data and token_data.get('access_token') != access_token:
+            return token_data
+        token_data = await self._get(key, float('inf'), clear_on_failure=False)
+        if token_data and token_data.get('access_token') != access_token:
+            return token_data
+        return None
+
+    async def _get(self, key, buffer_seconds, clear_on_failure):
+        token_data = await self.run_blocking(self.store.load, key)
+        if not token_data:
+            return None
+        if not is_token_expired(token_data, buffer_seconds):
+            return token_data
+        if not token_data.get('refresh_token'):
+            return None
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._refresh(key, token_data, clear_on_failure))
+            self._inflight[key] = flight
+            flight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # リクエストが切断されても、同じキーを待つ他のリクエストのために更新は続ける
+        return await asyncio.shield(flight)
+
+    async def _refresh(self, key, token_data, clear_on_failure):
+        store = self.store
+        lock = store.backend.lock(key)
+        try:
+            await self.run_blocking(lock.__enter__)
+        except LockTimeout as e:
+            return await self.run_blocking(store._lock_timeout, key, e)
+        try:
+            current, token_data = await self.run_blocking(store._reload_locked, key, token_data)
+            if not token_data:
+                return current
+            new_token_data = await self.refresh_func(token_data['refresh_token'])
+            if not await self.run_blocking(store._apply_refresh, key, token_data, new_token_data,
+                                           clear_on_failure):
+                return None
+        finally:
+            await self.run_blocking(lock.__exit__, None, None, None)
+        store._notify(token_data, new_token_data)
+        return new_token_data
@@ -0,0 +1,294 @@
+"""ASGI 版のアプリ（uvicorn で起動）
+
+ログイン・コールバック・ダッシュボード・SQL実行・ログアウトを asyncio で処理する。
+Cognito のトークンエンドポイントとの通信（コールバック・リフレッシュ）は非同期HTTPクライアント（httpx）で、
+Snowflake への呼び出しと JWT の検証はスレッド数に上限のある実行用プールで行うので、IdP や Warehouse を
+待っている間もリクエストごとにスレッドを占有しない。それ以外の画面は同じプロセスの Flask アプリ（app.create_app()）が
+処理し、トークンの保存先・接続プール・同時実行数の制御・セッション Cookie を共有する。
+
+    uvicorn asgi_app:create_app --factory --port 5000
+"""
+import asyncio
+import os
+import secrets
+from urllib.parse import urlencode
+
+from app import create_app as create_flask_app
+from common.admission import AdmissionRejected
+from common.asgi import AsyncResultStream, BlockingExecutor, FlaskBridge
+from common.oauth_http import AsyncOAuthHTTPClient
+from common.sql_results import open_result_stream
+from common.token_store import AsyncTokenStore
+from common import metrics
+
+
+def create_app():
+    """ASGI アプリを作成する（設定は Flask アプリと同じ環境変数から読む）"""
+    flask_app = create_flask_app()
+    shared = flask_app.extensions['shared']
+    sf_pool = shared['sf_pool']
+    token_store = shared['token_store']
+    admission = shared['admission']
+    query_cache = shared['query_cache']
+    prewarmer = shared['prewarmer']
+    query_history = shared['query_history']
+    jwt_verifier = shared['jwt_verifier']
+
+    # Snowflake コネクタの呼び出し（実行・結果の取得）と、トークンの保存先・JWT 検証を行うスレッド
+    # 保存先（SQLite / Redis）の読み書きが Snowflake の待ちの後ろに並ばないよう分ける
+    sf_executor = BlockingExecutor('sf-async', int(os.getenv('ASGI_SF_THREADS', '32')))
+    io_executor = BlockingExecutor('io-async', int(os.getenv('ASGI_IO_THREADS', '8')))
+
+    # トークンエンドポイント用の非同期HTTPクライアント（Keep-Alive、タイムアウト、5xx/429のリトライ）
+    oauth_http = AsyncOAuthHTTPClient(
+        connect_timeout=float(os.getenv('OAUTH_CONNECT_TIMEOUT', '5')),
+        read_timeout=float(os.getenv('OAUTH_READ_TIMEOUT', '15')),
+        retries=int(os.getenv('OAUTH_RETRIES', '3')),
+        max_connections=int(os.getenv('ASGI_OAUTH_MAX_CONNECTIONS', '200')),
+    )
+    metrics.init_asgi(flask_app, oauth_http=oauth_http, executors=[sf_executor, io_executor])
+
+    async def refresh_access_token(refresh_token):
+        """リフレッシュトークンを使ってアクセストークンを更新（応答を待つ間はイベントループに戻る）"""
+        token_data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': shared['client_id'],
+            'client_secret': shared['client_secret']
+        }
+
+        try:
+            response = await oauth_http.post(shared['token_endpoint'], data=token_data)
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Token refresh failed: {response.status_code} - {response.text}")
+                return None
+        except Exception as e:
+            print(f"Token refresh error: {str(e)}")
+            return None
+
+    # Flask アプリと同じ保存先・ロックを使い、トークンエンドポイントとの通信だけ非同期HTTPクライアントで行う
+    async_token_store = AsyncTokenStore(token_store, metrics.track_refresh_async(refresh_access_token),
+                                        io_executor.run)
+
+    bridge = FlaskBridge(flask_app, log_requests=os.getenv('REQUEST_LOG', 'true').lower() == 'true')
+
+    async def get_valid_token(page):
+        """有効なトークンを取得（期限切れ間近のリフレッシュは AsyncTokenStore でイベントループ上の1回にまとめる）"""
+        key = page.session.get('token_key')
+        if not key:
+            return None
+        with metrics.phase('token'):
+            token_data = await async_token_store.get_valid_token(key)
+        if token_data:
+            # 他のワーカーで更新されたトークンでも、このログインで開いた接続を使う
+            sf_pool.bind_token(token_data.get('access_token'), key)
+        return token_data
+
+    def snowflake_token(page, token_data):
+        """接続プールに渡すトークン（Snowflake に拒否されたら、実行用スレッドからイベントループで更新する）"""
+        loop = asyncio.get_running_loop()
+
+        def refresh_rejected(key, access_token):
+            return asyncio.run_coroutine_threadsafe(async_token_store.refresh_rejected(key, access_token),
+                                                    loop).result()
+        return token_store.provider(page.session.get('token_key'), token_data, refresh_rejected)
+
+    async def decode_jwt_claims(token):
+        """JWTトークンを検証してクレームを取得（検証失敗時はNone、JWKS の取得があるのでスレッドで行う）"""
+        if not token:
+            return None
+        with metrics.phase('jwt'):
+            return await io_executor.run(jwt_verifier.decode, token)
+
+    @bridge.context_processor
+    def inject_presets(page):
+        """ログイン時に指定した Warehouse をフォームの初期値にする（クエリ履歴が有効ならリンクを出す）"""
+        return {'default_warehouse': page.session.get('warehouse', ''),
+                'history_enabled': query_history is not None}
+
+    @bridge.route('/')
+    async def index(page):
+        token_data = await get_valid_token(page)
+        if token_data:
+            return await page.render('dashboard.html', authenticated=True)
+        return await page.render('login.html')
+
+    @bridge.route('/login', methods=['GET', 'POST'])
+    async def login(page):
+        """Cognito OAuth認証を開始"""
+        if page.request.method == 'GET':
+            return await page.render('login.html')
+
+        form = await page.form()
+        role = form.get('role', '').strip()
+
+        # 最初のクエリの Warehouse（ダッシュボードの初期値、ログイン直後の接続の準備に使う）
+        page.session['warehouse'] = form.get('warehouse', '').strip() or shared['default_warehouse'] or ''
+
+        state = secrets.token_urlsafe(32)
+        page.session['oauth_state'] = state
+
+        scopes = ['openid', 'profile', 'email']
+        if role:
+            scopes.append(f'session/role:{role.lower()}')
+        else:
+            scopes.append('session/role-any')
+
+        auth_params = {
+            'response_type': 'code',
+            'client_id': shared['client_id'],
+            'redirect_uri': shared['redirect_uri'],
+            'scope': ' '.join(scopes),
+            'state': state
+        }
+        return page.redirect(f"{shared['authorization_endpoint']}?" + urlencode(auth_params))
+
+    @bridge.route('/callback')
+    async def callback(page):
+        """OAuth認証のコールバック処理（トークンの取得を待つ間はイベントループに戻る）"""
+        code = page.request.query_params.get('code')
+        state = page.request.query_params.get('state')
+
+        if not code:
+            page.flash('認証に失敗しました', 'error')
+            return page.redirect('index')
+
+        if state != page.session.get('oauth_state'):
+            page.flash('不正なリクエストです', 'error')
+            return page.redirect('index')
+
+        token_data = {
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': shared['client_id'],
+            'client_secret': shared['client_secret'],
+            'redirect_uri': shared['redirect_uri']
+        }
+
+        try:
+            response = await oauth_http.post(shared['token_endpoint'], data=token_data)
+            if response.status_code == 200:
+                token_info = response.json()
+                # 以前のログインのトークンは破棄し、新しいキーで保存する
+                await io_executor.run(token_store.clear, page.session.get('token_key'))
+                page.session['token_key'] = token_store.new_key()
+                await io_executor.run(token_store.save, page.session['token_key'], token_info)
+                if prewarmer:
+                    # 最初のクエリと同じ Warehouse の接続を開いておく（ロールはトークンのスコープで決まる）
+                    prewarmer.submit(token_info.get('access_token'), page.session['token_key'],
+                                     warehouse=page.session.get('warehouse'))
+                page.flash('ログイン成功！', 'success')
+                return page.redirect('dashboard')
+            else:
+                page.flash(f'トークン取得に失敗しました: {response.text}', 'error')
+        except Exception as e:
+            page.flash(f'エラーが発生しました: {str(e)}', 'error')
+
+        return page.redirect('index')
+
+    @bridge.route('/dashboard')
+    async def dashboard(page):
+        """ダッシュボード画面"""
+        token_data = await get_valid_token(page)
+        if not token_data:
+            return page.redirect('index')
+
+        return await page.render('dashboard.html',
+                                 authenticated=True,
+                                 access_claims=await decode_jwt_claims(token_data.get('access_token')),
+                                 id_claims=await decode_jwt_claims(token_data.get('id_token')))
+
+    @bridge.route('/execute_sql', methods=['POST'])
+    async def execute_sql(page):
+        """SQL実行（実行と結果の取得は実行用スレッドで行い、バッチごとに描画して送る）"""
+        token_data = await get_valid_token(page)
+        if not token_data:
+            page.flash('認証が必要です。再ログインしてください。', 'error')
+            return page.redirect('index')
+
+        form = await page.form()
+        sql_query = form.get('sql_query', '').strip()
+        warehouse = form.get('warehouse', '').strip()
+
+        if not sql_query:
+            page.flash('SQLクエリを入力してください', 'error')
+            return page.redirect('dashboard')
+
+        # JWT Claims情報を取得（成功時・エラー時の両方で表示するので1回だけ検証）
+        access_claims = await decode_jwt_claims(token_data.get('access_token'))
+        id_claims = await decode_jwt_claims(token_data.get('id_token'))
+        subject = (access_claims or {}).get('sub', '')
+        # 同時実行数を数え、履歴を記録する利用者（sub クレーム、取れなければログインごとのキー）
+        user = subject or page.session.get('token_key')
+
+        try:
+            # 利用者・Warehouse ごとの実行枠を取る（枠が空くのはイベントループ上で待つ）
+            with metrics.phase('queue'):
+                ticket = await admission.acquire_async(user, warehouse)
+        except AdmissionRejected as e:
+            page.flash(str(e), 'error')
+            return await page.render('dashboard.html', status=429,
+                                     authenticated=True,
+                                     sql_query=sql_query,
+                                     warehouse=warehouse,
+                                     access_claims=access_claims,
+                                     id_claims=id_claims)
+
+        try:
+            access_token = snowflake_token(page, token_data)
+            if query_cache:
+                # キャッシュのキーには利用者（subクレーム）とロールを決めるスコープ（scp / scope）を含める
+                # （検証に失敗して sub がなければキャッシュを使わない）
+                scope = (access_claims or {}).get('scp') or (access_claims or {}).get('scope')
+                results = await sf_executor.run(
+                    lambda: query_cache.open_stream(sf_pool, access_token, sql_query, subject,
+                                                    scope=scope, warehouse=warehouse,
+                                                    batch_size=shared['result_batch_size'],
+                                                    max_rows=shared['max_result_rows']))
+            else:
+                results = await sf_executor.run(
+                    lambda: open_result_stream(sf_pool, access_token, sql_query,
+                                               warehouse=warehouse,
+                                               batch_size=shared['result_batch_size'],
+                                               max_rows=shared['max_result_rows']))
+        except Exception as e:
+            ticket.release()
+            if query_history:
+                query_history.track(sql_query, user, warehouse=warehouse, error=e)
+            page.flash(f'SQL実行エラー: {str(e)}', 'error')
+            return await page.render('dashboard.html',
+                                     authenticated=True,
+                                     sql_query=sql_query,
+                                     warehouse=warehouse,
+                                     access_claims=access_claims,
+                                     id_claims=id_claims)
+
+        if query_history:
+            # 行数・クエリID・段階ごとの時間は結果を送り終えた後に記録する
+            query_history.track(sql_query, user, warehouse=warehouse, stream=results)
+        results = AsyncResultStream(results, sf_executor)
+        headers = {'X-Query-Cache': results.cache_status} if results.cache_status else None
+        return page.stream('dashboard.html', on_close=[results.close, ticket.release], headers=headers,
+                           authenticated=True,
+                           sql_query=sql_query,
+                           warehouse=warehouse,
+                           results=results,
+                           columns=results.columns,
+                           access_claims=access_claims,
+                           id_claims=id_claims)
+
+    @bridge.route('/logout')
+    async def logout(page):
+        """ログアウト（このセッションのトークンだけを破棄）"""
+        await io_executor.run(token_store.clear, page.session.get('token_key'))
+        page.session.clear()
+        page.flash('ログアウトしました', 'info')
+        return page.redirect('index')
+
+    return bridge.asgi_app(
+        wsgi_threads=int(os.getenv('ASGI_WSGI_THREADS', '32')),
+        on_startup=[shared['token_refresher'].start],
+        on_shutdown=flask_app.extensions['on_shutdown'] + [sf_executor.shutdown, io_executor.shutdown,
+                                                           oauth_http.aclose])
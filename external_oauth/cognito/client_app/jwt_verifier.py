@@ -0,0 +1,128 @@
+"""Cognito JWT の署名検証
+
+JWKS は初回に1回だけ取得してキャッシュし、未知の kid が来たときだけ
+（最短間隔を空けて）取り直す。検証済みのクレームはトークン文字列ごとに
+exp まで保持するので、同じトークンの2回目以降の検証はほぼコストがない。
+python-jose（cryptography を含む）と requests は初めてトークンを検証するときに読み込む。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class CognitoJWTVerifier:
+    """Cognito User Pool が発行した ID Token / Access Token を検証する"""
+
+    def __init__(self, region, user_pool_id, client_id, min_jwks_refresh_interval=60,
+                 max_cached_tokens=1024, timeout=5, http=None):
+        self.issuer = f"https://cognito-idp.{region}.amazonaws.com/{user_pool_id}"
+        self.jwks_url = f"{self.issuer}/.well-known/jwks.json"
+        self.client_id = client_id
+        self.min_jwks_refresh_interval = min_jwks_refresh_interval
+        self.max_cached_tokens = max_cached_tokens
+        self.timeout = timeout
+        self.http = http  # get(url, timeout=...) を持つクライアント（共有セッション等、省略時は requests）
+
+        self._keys = {}              # kid -> JWK
+        self._jwks_fetched_at = None
+        self._jwks_lock = threading.Lock()
+
+        self._claims = OrderedDict()  # token -> 検証済みクレーム
+        self._claims_lock = threading.Lock()
+
+    def _fetch_jwks(self):
+        http = self.http
+        if http is None:
+            import requests as http
+        response = http.get(self.jwks_url, timeout=self.timeout)
+        response.raise_for_status()
+        self._keys = {key['kid']: key for key in response.json().get('keys', [])}
+
+    def _get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        with self._jwks_lock:
+            key = self._keys.get(kid)
+            if key is not None:
+                return key
+            # 未知の kid（鍵のローテーション）のときだけ取り直す。取り直しは最短間隔を空ける
+            now = time.monotonic()
+            if (self._jwks_fetched_at is None
+                    or now - self._jwks_fetched_at >= self.min_jwks_refresh_interval):
+                self._jwks_fetched_at = now
+                self._fetch_jwks()
+            return self._keys.get(kid)
+
+    def _verify(self, token):
+        from jose import jwt, JWTError
+        header = jwt.get_unverified_header(token)
+        key = self._get_key(header.get('kid'))
+        if key is None:
+            raise JWTError(f"unknown kid: {header.get('kid')}")
+
+        # aud は ID Token にしかない（Access Token は Lambda で追加）ので、下で個別に確認する
+        claims = jwt.decode(token, key, algorithms=['RS256'], issuer=self.issuer,
+                            options={'verify_aud': False, 'verify_at_hash': False})
+
+        token_use = claims.get('token_use')
+        if token_use == 'id':
+            audience = claims.get('aud')
+        elif token_use == 'access':
+            audience = claims.get('client_id')
+        else:
+            raise JWTError(f"unexpected token_use: {token_use}")
+        if audience != self.client_id:
+            raise JWTError('token was not issued for this client')
+        return claims
+
+    def decode(self, token):
+        """検証済みのクレームを返す（検証に失敗したら None）"""
+        now = time.time()
+        with self._claims_lock:
+            claims = self._claims.get(token)
+            if claims is not None:
+                if claims.get('exp', 0) > now:
+                    self._claims.move_to_end(token)
+                    return claims
+                del self._claims[token]
+
+        import requests
+        from jose import JWTError
+        try:
+            claims = self._verify(token)
+        except (JWTError, requests.RequestException, KeyError, ValueError) as e:
+            print(f"JWT verification error: {e}")
+            return None
+
+        with self._claims_lock:
+            self._claims[token] = claims
+            while len(self._claims) > self.max_cached_tokens:
+                self._claims.popitem(last=False)
+        return claims
+
+
+class UnverifiedJWTDecoder:
+    """USER_POOL_ID 未設定時の開発用デコーダー（署名は検証しない、結果は exp までキャッシュ）"""
+
+    def __init__(self, max_cached_tokens=1024):
+        self.max_cached_tokens = max_cached_tokens
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+
+    def decode(self, token):
+        with self._lock:
+            claims = self._claims.get(token)
+            if claims is not None and claims.get('exp', 0) > time.time():
+                return claims
+        from jose import jwt, JWTError
+        try:
+            claims = jwt.get_unverified_claims(token)
+        except JWTError as e:
+            print(f"JWT decode error: {e}")
+            return None
+        with self._lock:
+            self._claims[token] = claims
+            while len(self._claims) > self.max_cached_tokens:
+                self._claims.popitem(last=False)
+        return claims
@@ -0,0 +1,159 @@
+"""Pre Token Generation Lambda のローカルベンチマーク
+
+- コールドスタート: 新しいプロセスで `python -X importtime` によりモジュールを読み込み、
+  import 時間（pre_token_generation 自身と合計）とプロセス起動から初回呼び出しまでの時間を測る
+- 呼び出しごとのレイテンシ: 同じプロセスで lambda_handler を繰り返し呼び、p50/p99 を表示する
+
+    python bench_handler.py --invocations 20000
+    LOG_LEVEL=DEBUG LOG_SAMPLE_RATE=1 python bench_handler.py   # 全件ログの場合
+    python bench_handler.py --group-rules 5000                   # グループのルールが多い場合
+
+ログは破棄するハンドラーに出す（CloudWatch への送信を除いた組み立てのコストを測る）。
+Lambda のパッケージには含めない（terraform は pre_token_generation.py だけを zip にする）。
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+LAMBDA_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE = 'pre_token_generation'
+
+SAMPLE_EVENT = {
+    'version': '2',
+    'triggerSource': 'TokenGeneration_HostedAuth',
+    'region': 'ap-northeast-1',
+    'userPoolId': 'ap-northeast-1_example',
+    'userName': 'bench_user',
+    'callerContext': {'awsSdkVersion': 'aws-sdk-unknown-unknown', 'clientId': 'bench-client'},
+    'request': {
+        'userAttributes': {'sub': '00000000-0000-0000-0000-000000000000', 'email': 'bench@example.com',
+                           'email_verified': 'true', 'cognito:user_status': 'CONFIRMED'},
+        'groupConfiguration': {'groupsToOverride': ['analysts', 'group_1'], 'iamRolesToOverride': [],
+                               'preferredRole': None},
+        'scopes': ['openid', 'email', 'profile', 'session/role:analyst'],
+    },
+    'response': {'claimsAndScopeOverrideDetails': None},
+}
+
+# 子プロセスで実行する: 起動から初回呼び出しの完了までの時間を出力する
+_COLD_START_SCRIPT = f"""
+import time
+started = time.perf_counter()
+import {MODULE}
+imported = time.perf_counter()
+{MODULE}.lambda_handler({{'version': '2', 'userName': 'cold', 'response': None}}, None)
+print(imported - started, time.perf_counter() - imported)
+"""
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def write_synthetic_rules(count):
+    """グループ -> ロールのルールを count 件持つ claim_rules.json を作り、そのパスを返す"""
+    rules = {
+        'default_roles': ['*'],
+        'groups': dict({'analysts': ['ANALYST']}, **{f'group_{i}': [f'ROLE_{i}', 'PUBLIC'] for i in range(count)}),
+        'group_role_prefix': 'snowflake_role_',
+        'attributes': {'custom:snowflake_role': '$value'},
+    }
+    fd, path = tempfile.mkstemp(prefix='claim_rules-', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(rules, f)
+    return path
+
+
+def measure_cold_start(runs):
+    """新しいプロセスでの import 時間と初回呼び出しの時間（秒）"""
+    results = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', _COLD_START_SCRIPT],
+                                   cwd=LAMBDA_DIR, capture_output=True, text=True, check=True)
+        process_seconds = time.perf_counter() - started
+        import_seconds, first_call_seconds = map(float, completed.stdout.split())
+        # -X importtime の出力: "import time: self [us] | cumulative | imported package"
+        module_us = 0
+        for line in completed.stderr.splitlines():
+            parts = [part.strip() for part in line.split('|')]
+            if len(parts) == 3 and parts[2] == MODULE:
+                module_us = int(parts[1])
+        results.append({
+            'process_ms': process_seconds * 1000,
+            'import_ms': import_seconds * 1000,
+            'module_cumulative_ms': module_us / 1000,
+            'first_call_ms': first_call_seconds * 1000,
+        })
+    return {key: sorted(r[key] for r in results)[len(results) // 2] for key in results[0]}
+
+
+def measure_invocations(invocations):
+    """同じプロセスでの呼び出しごとのレイテンシ（秒）"""
+    sys.path.insert(0, LAMBDA_DIR)
+    module = __import__(MODULE)
+    # Lambda ランタイムのようにルートロガーにハンドラーを付け、出力は破棄する
+    logging.getLogger().addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+
+    events = [copy.deepcopy(SAMPLE_EVENT) for _ in range(min(invocations, 1000))]
+    latencies = []
+    for i in range(invocations):
+        event = events[i % len(events)]
+        event['response'] = {'claimsAndScopeOverrideDetails': None}
+        started = time.perf_counter()
+        module.lambda_handler(event, None)
+        latencies.append(time.perf_counter() - started)
+    return {
+        'invocations': invocations,
+        'mean_us': sum(latencies) / len(latencies) * 1e6,
+        'p50_us': _percentile(latencies, 0.50) * 1e6,
+        'p99_us': _percentile(latencies, 0.99) * 1e6,
+        'max_us': max(latencies) * 1e6,
+        'log_level': getattr(module, 'LOG_LEVEL', logging.getLevelName(logging.getLogger().level)),
+        'log_sample_rate': getattr(module, 'LOG_SAMPLE_RATE', 1.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre Token Generation Lambda のローカルベンチマーク')
+    parser.add_argument('--invocations', type=int, default=10000)
+    parser.add_argument('--cold-starts', type=int, default=5, help='コールドスタートの計測回数（中央値を表示）')
+    parser.add_argument('--group-rules', type=int, default=0,
+                        help='この件数のグループルールを持つ合成の claim_rules.json を使う')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args()
+    if args.group_rules:
+        # 子プロセス（コールドスタート計測）にも引き継ぐ
+        os.environ['CLAIM_RULES_PATH'] = write_synthetic_rules(args.group_rules)
+
+    try:
+        results = {
+            'cold_start': measure_cold_start(args.cold_starts),
+            'invocation': measure_invocations(args.invocations),
+        }
+    finally:
+        if args.group_rules:
+            os.remove(os.environ['CLAIM_RULES_PATH'])
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    cold, warm = results['cold_start'], results['invocation']
+    print(f"cold start (median of {args.cold_starts}): process {cold['process_ms']:.1f} ms, "
+          f"import {cold['import_ms']:.2f} ms ({MODULE} cumulative {cold['module_cumulative_ms']:.2f} ms), "
+          f"first call {cold['first_call_ms']:.3f} ms")
+    if args.group_rules:
+        print(f"claim rules: {args.group_rules} synthetic group rules")
+    print(f"invocation ({warm['invocations']} calls, LOG_LEVEL={warm['log_level']}, "
+          f"LOG_SAMPLE_RATE={warm['log_sample_rate']}): mean {warm['mean_us']:.1f} us, "
+          f"p50 {warm['p50_us']:.1f} us, p99 {warm['p99_us']:.1f} us, max {warm['max_us']:.1f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,179 @@
 import json
 import logging
 import os
+import random
+import re
+from functools import lru_cache
+
+# 環境変数と claim_rules.json はコールドスタート時に1回だけ読む
+SCP_ANY_ROLE = 'session:role-any'
+SCP_ROLE_PREFIX = 'session:role:'
+SCOPE_ROLE_PREFIX = 'session/role:'  # Cognitoのスコープ（スラッシュ区切り）
+AUDIENCE = os.environ.get('COGNITO_CLIENT_ID', 'cognito-client-id')  # 環境変数からaud取得、なければデフォルト
+CLAIM_RULES_PATH = os.environ.get(
+    'CLAIM_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'claim_rules.json'))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# INFO/DEBUG のログを出す呼び出しの割合（0〜1）。エラーは常に出す
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+ANY_ROLE = '*'          # ルールでの「任意のロール」
+VALUE_AS_ROLE = '$value'  # 属性の値をそのままロール名にする
+# クォートなしの Snowflake 識別子だけを許可する（空白を含む値で scp にスコープを足されないように）
+ROLE_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+NO_ROLES = frozenset()
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
+
+
+def _role_name(value):
+    """ロール名を正規化する（識別子として不正なら None）"""
+    value = value.strip()
+    return value.upper() if ROLE_NAME.fullmatch(value) else None
+
+
+class ClaimRules:
+    """claim_rules.json をルックアップ表に変換したもの
+
+    ルール数によらず、1回の呼び出しのコストはユーザーのグループ数・スコープ数と
+    設定した属性の数にだけ比例する。
+    """
+
+    def __init__(self, config):
+        self.default_roles = self._compile_roles(config.get('default_roles', [ANY_ROLE]), 'default_roles')
+        # グループ名 -> ロールの集合
+        self.groups = {name: self._compile_roles(roles, f'groups.{name}')
+                       for name, roles in config.get('groups', {}).items()}
+        # このプレフィックスで始まるグループは残りの部分をロール名にする（例: snowflake_role_analyst）
+        self.group_role_prefix = config.get('group_role_prefix') or None
+        # 属性名 -> 値 -> ロールの集合（VALUE_AS_ROLE の場合は値をそのままロールにする）
+        self.attributes = {}
+        for name, mapping in config.get('attributes', {}).items():
+            if mapping == VALUE_AS_ROLE:
+                self.attributes[name] = VALUE_AS_ROLE
+            else:
+                self.attributes[name] = {value: self._compile_roles(roles, f'attributes.{name}.{value}')
+                                         for value, roles in mapping.items()}
+
+    @staticmethod
+    def _compile_roles(roles, where):
+        compiled = set()
+        for role in roles:
+            if role == ANY_ROLE:
+                compiled.add(ANY_ROLE)
+                continue
+            name = _role_name(role)
+            if name is None:
+                raise ValueError(f"Invalid role name in claim rules ({where}): {role!r}")
+            compiled.add(name)
+        return frozenset(compiled)
+
+    def allowed_roles(self, groups, attributes):
+        """ユーザーに許可するロール（どのルールにも当たらなければ default_roles）"""
+        roles = set()
+        for group in groups:
+            roles |= self.groups.get(group, NO_ROLES)
+            if self.group_role_prefix and group.startswith(self.group_role_prefix):
+                name = _role_name(group[len(self.group_role_prefix):])
+                if name:
+                    roles.add(name)
+        for name, mapping in self.attributes.items():
+            value = attributes.get(name)
+            if not value:
+                continue
+            if mapping == VALUE_AS_ROLE:
+                roles.update(role for role in map(_role_name, value.split(',')) if role)
+            else:
+                roles |= mapping.get(value, NO_ROLES)
+        return roles or self.default_roles
+
+    def scp(self, groups, attributes, scopes):
+        """Snowflake に渡す scp クレーム（スペース区切り）
+
+        要求スコープ session/role:<role> で許可されたロールが指定されていればそのロールだけ、
+        指定がなければ許可されたロール全部（任意のロールが許可されていれば session:role-any）。
+        """
+        allowed = self.allowed_roles(groups, attributes)
+        any_allowed = ANY_ROLE in allowed
+        requested = {_role_name(scope[len(SCOPE_ROLE_PREFIX):])
+                     for scope in scopes if scope.startswith(SCOPE_ROLE_PREFIX)}
+        requested.discard(None)
+        granted = requested if any_allowed else requested & allowed
+        if granted:
+            return ' '.join(SCP_ROLE_PREFIX + role for role in sorted(granted))
+        if any_allowed:
+            return SCP_ANY_ROLE
+        return ' '.join(SCP_ROLE_PREFIX + role for role in sorted(allowed))
+
+
+def load_rules(path=CLAIM_RULES_PATH):
+    """ルールを読み込む（ファイルがなければ従来どおり全員に session:role-any）"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logger.warning("Claim rules not found, using session:role-any for all users: %s", path)
+        config = {}
+    return ClaimRules(config)
+
+
+RULES = load_rules()
+
+
+@lru_cache(maxsize=4096)
+def _claims_override(scp):
+    """v2.0対応: ID TokenとAccess Token両方に追加するクレーム（scp ごとに1回だけ作る）
+
+    呼び出し間で共有するので変更しないこと（ランタイムは返り値をJSONにするだけ）
+    """
+    return {
+        'idTokenGeneration': {
+            'claimsToAddOrOverride': {'scp': scp},
+            'claimsToSuppress': []
+        },
+        'accessTokenGeneration': {
+            'claimsToAddOrOverride': {'scp': scp, 'aud': AUDIENCE},  # audienceクレーム付き
+            'claimsToSuppress': [],
+            'scopesToAdd': [],
+            'scopesToSuppress': []
+        }
+    }
+
+
+def _sampled():
+    return LOG_SAMPLE_RATE >= 1 or (LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE)
+
 
 def lambda_handler(event, context):
     """
     Pre Token Generation Lambda Trigger v2.0
     Access TokenとID Token両方にSnowflake用のscpクレームを追加
     """
-    
-    logger.info(f"Received event: {json.dumps(event, indent=2)}")
-    
+    # ログはレベルが有効かつサンプリングに当たった呼び出しだけ組み立てる
+    log_this = logger.isEnabledFor(logging.INFO) and _sampled()
+    if log_this and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", json.dumps(event, separators=(',', ':')))
+
     try:
-        # カスタムクレーム
-        custom_claims = {
-            'scp': 'session:role-any'
-        }
-        
-        # Access Token専用クレーム（audienceを追加）
-        access_token_claims = {
-            'scp': 'session:role-any',
-            'aud': os.environ.get('COGNITO_CLIENT_ID', 'cognito-client-id')  # 環境変数からaud取得、なければデフォルト
-        }
-        logger.info(f"Adding scp claim: {custom_claims['scp']}")
-        
         # 既存のresponseがない場合は初期化
-        if 'response' not in event or event['response'] is None:
+        if event.get('response') is None:
             event['response'] = {}
-        
-        # v2.0対応: ID TokenとAccess Token両方にクレーム追加
-        event['response']['claimsAndScopeOverrideDetails'] = {
-            'idTokenGeneration': {
-                'claimsToAddOrOverride': custom_claims,
-                'claimsToSuppress': []
-            },
-            'accessTokenGeneration': {
-                'claimsToAddOrOverride': access_token_claims,  # audienceクレーム付き
-                'claimsToSuppress': [],
-                'scopesToAdd': [],
-                'scopesToSuppress': []
-            }
-        }
-        
-        logger.info(f"Final response: {json.dumps(event['response'], indent=2)}")
-        
+
+        trigger_request = event.get('request') or {}
+        groups = (trigger_request.get('groupConfiguration') or {}).get('groupsToOverride') or ()
+        scp = RULES.scp(groups, trigger_request.get('userAttributes') or {},
+                        trigger_request.get('scopes') or ())
+        event['response']['claimsAndScopeOverrideDetails'] = _claims_override(scp)
+
+        if log_this:
+            logger.info("Added claims: user=%s trigger=%s scp=%s",
+                        event.get('userName'), event.get('triggerSource'), scp)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Final response: %s", json.dumps(event['response'], separators=(',', ':')))
+
     except Exception as e:
         logger.error(f"Error processing token: {str(e)}")
         if 'response' not in event:
             event['response'] = {}
-        
+
     return event
@@ -0,0 +1,56 @@
+"""サンプルのトリガーイベントで Pre Token Generation Lambda を実行する
+
+events/*.json（{"description", "expected_scp", "event"}）を lambda_handler に渡し、
+Access Token / ID Token に付く scp を期待値と比べる。違いがあれば終了コード 1。
+"rules" があるイベントは、claim_rules.json の代わりにそのルールで実行する。
+
+    python run_events.py                      # events/ 以下すべて
+    python run_events.py events/analyst_group.json --rules my_rules.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+LAMBDA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='サンプルイベントで Pre Token Generation Lambda を実行する')
+    parser.add_argument('files', nargs='*', help='イベントファイル（省略時は events/*.json）')
+    parser.add_argument('--rules', help='claim_rules.json のパス（CLAIM_RULES_PATH）')
+    parser.add_argument('--show', action='store_true', help='応答全体を表示する')
+    args = parser.parse_args()
+
+    # ルールはモジュール読み込み時に読まれるので、import より前に設定する
+    if args.rules:
+        os.environ['CLAIM_RULES_PATH'] = os.path.abspath(args.rules)
+    sys.path.insert(0, LAMBDA_DIR)
+    import pre_token_generation
+
+    files = args.files or sorted(glob.glob(os.path.join(LAMBDA_DIR, 'events', '*.json')))
+    default_rules = pre_token_generation.RULES
+    failures = 0
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            case = json.load(f)
+        pre_token_generation.RULES = (pre_token_generation.ClaimRules(case['rules']) if 'rules' in case
+                                      else default_rules)
+        result = pre_token_generation.lambda_handler(case['event'], None)
+        details = (result.get('response') or {}).get('claimsAndScopeOverrideDetails') or {}
+        access_scp = details.get('accessTokenGeneration', {}).get('claimsToAddOrOverride', {}).get('scp')
+        id_scp = details.get('idTokenGeneration', {}).get('claimsToAddOrOverride', {}).get('scp')
+        expected = case.get('expected_scp')
+        ok = expected is None or (access_scp == expected and id_scp == expected)
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {os.path.basename(path)}: scp={access_scp!r}"
+              + ('' if ok else f" (expected {expected!r}, id token {id_scp!r})"))
+        if args.show:
+            print(json.dumps(result['response'], indent=2, ensure_ascii=False))
+    print(f"{len(files) - failures}/{len(files)} passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -98,7 +98,8 @@ resource "aws_cognito_user_pool_client" "snowflake_oauth" {
 
   # 読み取り・書き込み属性
   read_attributes  = ["email", "custom:snowflake_role"]
-  write_attributes = ["email", "custom:snowflake_role"]
+  # custom:snowflake_role はロールの決定に使えるので、ユーザー自身には書き込ませない（管理者が AdminUpdateUserAttributes で設定）
+  write_attributes = ["email"]
 }
 
 # Resource Server (カスタムスコープ用)
@@ -165,7 +166,8 @@ resource "aws_cognito_user_pool_client" "snowflake_oauth_with_custom_scopes" {
 
   prevent_user_existence_errors = "ENABLED"
   read_attributes               = ["email", "custom:snowflake_role"]
-  write_attributes              = ["email", "custom:snowflake_role"]
+  # custom:snowflake_role はユーザー自身には書き込ませない（管理者だけが設定する）
+  write_attributes              = ["email"]
 
   depends_on = [aws_cognito_resource_server.snowflake_oauth]
 }
@@ -1,8 +1,17 @@
-# Lambda関数のZIPファイル作成
+# Lambda関数のZIPファイル作成（クレームのルールも同梱する）
 data "archive_file" "pre_token_lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/../lambda/pre_token_generation.py"
   output_path = "${path.module}/pre_token_generation.zip"
+
+  source {
+    content  = file("${path.module}/../lambda/pre_token_generation.py")
+    filename = "pre_token_generation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda/claim_rules.json")
+    filename = "claim_rules.json"
+  }
 }
 
 # Lambda実行ロール
@@ -41,6 +50,8 @@ resource "aws_lambda_function" "pre_token_generation" {
   environment {
     variables = {
       COGNITO_CLIENT_ID = var.cognito_client_id
+      LOG_LEVEL         = var.lambda_log_level
+      LOG_SAMPLE_RATE   = tostring(var.lambda_log_sample_rate)
     }
   }
 
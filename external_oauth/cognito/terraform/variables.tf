@@ -31,3 +31,16 @@ variable "cognito_client_id" {
   description = "Cognito App Client ID for Lambda environment variable"
   type        = string
 }
+
+
+variable "lambda_log_level" {
+  description = "Log level of the Pre Token Generation Lambda (DEBUG logs full events)"
+  type        = string
+  default     = "INFO"
+}
+
+variable "lambda_log_sample_rate" {
+  description = "Fraction of Lambda invocations that write INFO/DEBUG logs (errors are always logged)"
+  type        = number
+  default     = 0.01
+}
@@ -1,261 +1,676 @@
 import os
-import json
+import sys
 import secrets
-import requests
-import time
 from urllib.parse import urlencode
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
 from dotenv import load_dotenv
-import snowflake.connector
-from authlib.common.security import generate_token
-from authlib.oauth2.rfc7636 import create_s256_code_challenge
-
-load_dotenv()
-
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(16))
-
-SNOWFLAKE_CLIENT_ID = os.getenv('SNOWFLAKE_CLIENT_ID')
-SNOWFLAKE_CLIENT_SECRET = os.getenv('SNOWFLAKE_CLIENT_SECRET')
-SNOWFLAKE_ACCOUNT_IDENTIFIER = os.getenv('SNOWFLAKE_ACCOUNT_IDENTIFIER')
-SNOWFLAKE_WAREHOUSE = os.getenv('SNOWFLAKE_WAREHOUSE')
-
-TOKEN_FILE = 'tokens.json'
-
-def save_token(token_data):
-    """トークンをローカルファイルに保存（期限情報付き）"""
-    # 現在時刻を追加（トークン取得時刻として記録）
-    token_data['obtained_at'] = int(time.time())
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump(token_data, f, indent=2)
-
-def load_token():
-    """ローカルファイルからトークンを読み込み"""
-    try:
-        with open(TOKEN_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return None
-
-def is_token_expired(token_data, buffer_seconds=300):
-    """トークンが期限切れかチェック（デフォルト5分前にTrue）"""
-    if not token_data or 'expires_in' not in token_data or 'obtained_at' not in token_data:
-        return True
-    
-    expires_in = token_data.get('expires_in', 3600)  # デフォルト1時間
-    obtained_at = token_data.get('obtained_at', 0)
-    current_time = int(time.time())
-    
-    # 期限切れの5分前（buffer_seconds）にTrueを返す
-    return (current_time - obtained_at) >= (expires_in - buffer_seconds)
-
-def refresh_access_token(refresh_token):
-    """リフレッシュトークンを使ってアクセストークンを更新"""
-    token_data = {
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token,
-        'client_id': SNOWFLAKE_CLIENT_ID,
-        'client_secret': SNOWFLAKE_CLIENT_SECRET
-    }
+
+# リポジトリ直下の共通モジュール（common/）を読み込めるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.sf_pool import SnowflakeConnectionPool
+from common.sql_results import open_result_stream, stream_template
+from common.sql_export import ExportError, export_response
+from common.sql_batch import BatchError, BatchExecutor
+from common.async_queries import AsyncQueryLimitExceeded, AsyncQueryRegistry
+from common.admission import AdmissionController, AdmissionRejected
+from common.query_cache import QueryResultCache
+from common.prewarm import SessionPrewarmer
+from common.query_history import QueryHistory
+from common.token_store import TokenStore
+from common.token_backends import open_backend
+from common.token_refresher import TokenRefresher
+from common.serving import run
+from common.oauth_http import OAuthHTTPClient
+from common import metrics
+
+def create_app():
+    """アプリを作成する
+
+    設定はここで環境変数（.env）から読む。Snowflake コネクタ・pyarrow・JWT ライブラリは
+    初めて使うときに読み込むので、ワーカーの起動やログイン画面だけのリクエストでは読み込まない。
+    """
+    load_dotenv()
     
-    token_url = f"https://{SNOWFLAKE_ACCOUNT_IDENTIFIER}.snowflakecomputing.com/oauth/token-request"
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(16))
+
+    SNOWFLAKE_CLIENT_ID = os.getenv('SNOWFLAKE_CLIENT_ID')
+    SNOWFLAKE_CLIENT_SECRET = os.getenv('SNOWFLAKE_CLIENT_SECRET')
+    SNOWFLAKE_ACCOUNT_IDENTIFIER = os.getenv('SNOWFLAKE_ACCOUNT_IDENTIFIER')
+    SNOWFLAKE_WAREHOUSE = os.getenv('SNOWFLAKE_WAREHOUSE')
+
+    # SnowflakeのOAuthエンドポイント（ベンチマーク等でローカルのサーバーに向ける場合は上書きする）
+    SNOWFLAKE_OAUTH_BASE_URL = os.getenv('SNOWFLAKE_OAUTH_BASE_URL',
+                                         f"https://{SNOWFLAKE_ACCOUNT_IDENTIFIER}.snowflakecomputing.com")
+    TOKEN_ENDPOINT = f"{SNOWFLAKE_OAUTH_BASE_URL}/oauth/token-request"
+    AUTHORIZATION_ENDPOINT = f"{SNOWFLAKE_OAUTH_BASE_URL}/oauth/authorize"
+    OAUTH_REDIRECT_URI = os.getenv('OAUTH_REDIRECT_URI', 'http://127.0.0.1:5000/callback')
+
+    # トークンエンドポイント用の共有HTTPクライアント（Keep-Alive、タイムアウト、5xx/429のリトライ）
+    oauth_http = OAuthHTTPClient(
+        connect_timeout=float(os.getenv('OAUTH_CONNECT_TIMEOUT', '5')),
+        read_timeout=float(os.getenv('OAUTH_READ_TIMEOUT', '15')),
+        retries=int(os.getenv('OAUTH_RETRIES', '3')),
+    )
+
+    # トークンの保存先（memory:// / sqlite:///path/tokens.db / redis://host:6379/0）
+    # 複数ワーカーで起動する場合は sqlite か redis を指定する
+    TOKEN_STORE_URL = os.getenv('TOKEN_STORE_URL', 'memory://')
+    # refresh_token の有効期間（レスポンスに refresh_token_expires_in がない場合に使う）
+    TOKEN_REFRESH_TTL = int(os.getenv('TOKEN_REFRESH_TTL', '86400'))
+    # バックグラウンド更新の対象にする、最後に使われてからの秒数
+    TOKEN_REFRESH_ACTIVE_WINDOW = int(os.getenv('TOKEN_REFRESH_ACTIVE_WINDOW', '3600'))
+
+    # クエリのタイムアウト（秒、0 でアカウント・ユーザーの設定のまま）
+    # 同期実行はセッションパラメータで、非同期実行（長時間クエリ向け）は文ごとに別の値を指定する
+    SQL_STATEMENT_TIMEOUT = int(os.getenv('SQL_STATEMENT_TIMEOUT', '300'))
+    ASYNC_STATEMENT_TIMEOUT = int(os.getenv('ASYNC_STATEMENT_TIMEOUT', '3600'))
+
+    SF_CONNECT_PARAMS = {
+        # ハートビートでセッションを延長し、アクセストークンの期限後も同じセッションを使い続ける
+        'client_session_keep_alive': os.getenv('SF_SESSION_KEEP_ALIVE', 'true').lower() == 'true',
+    }
+    if SQL_STATEMENT_TIMEOUT:
+        SF_CONNECT_PARAMS['session_parameters'] = {'STATEMENT_TIMEOUT_IN_SECONDS': SQL_STATEMENT_TIMEOUT}
+
+    # Snowflake接続プール（同じトークン・ロール・Warehouseの接続を使い回す）
+    sf_pool = SnowflakeConnectionPool(
+        SNOWFLAKE_ACCOUNT_IDENTIFIER,
+        max_size=int(os.getenv('SF_POOL_MAX_SIZE', '10')),
+        idle_timeout=int(os.getenv('SF_POOL_IDLE_TIMEOUT', '600')),
+        connect_params=SF_CONNECT_PARAMS,
+    )
+
+    # 結果の取得単位と表示する最大行数（0で無制限）
+    RESULT_BATCH_SIZE = int(os.getenv('RESULT_BATCH_SIZE', '1000'))
+    MAX_RESULT_ROWS = int(os.getenv('MAX_RESULT_ROWS', '10000'))
+    # エクスポート時に Arrow バッチがない結果を fetchmany で読む単位
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '10000'))
+
+    # 同時実行数の制御（結果を送り終えるまでワーカーを占有するクエリは、利用者・Warehouse ごとに枠を取る）
+    admission = AdmissionController(
+        max_per_user=int(os.getenv('MAX_QUERIES_PER_USER', '2')),
+        max_per_warehouse=int(os.getenv('MAX_QUERIES_PER_WAREHOUSE', '8')),
+        max_queued=int(os.getenv('QUERY_QUEUE_MAX', '16')),
+        max_queued_per_user=int(os.getenv('QUERY_QUEUE_MAX_PER_USER', '2')),
+        queue_timeout=float(os.getenv('QUERY_QUEUE_TIMEOUT', '10')),
+    )
+
+    # 非同期実行したクエリ（クエリIDで状態確認・結果取得・取り消しを行う、ログインごとの件数に上限）
+    # トークンと同じ保存先に置き、状態確認が別のワーカーに届いても見つかるようにする
+    # Warehouse で実行中の間は同期実行と同じ実行枠を使う（空いていなければ待たずに断る）
+    async_queries = AsyncQueryRegistry(max_jobs_per_owner=int(os.getenv('ASYNC_MAX_JOBS_PER_USER', '20')),
+                                       backend=open_backend(TOKEN_STORE_URL, namespace='async_jobs'),
+                                       admission=admission)
+
+    # 複数文スクリプトのバッチ実行（スレッドプールは全リクエストで共有し、同時実行数は Warehouse ごとに制限）
+    batch_executor = BatchExecutor(
+        max_workers=int(os.getenv('BATCH_MAX_WORKERS', '8')),
+        max_per_warehouse=int(os.getenv('BATCH_MAX_PER_WAREHOUSE', '4')),
+        max_statements=int(os.getenv('BATCH_MAX_STATEMENTS', '50')),
+        max_rows=int(os.getenv('BATCH_MAX_ROWS', '100')),
+    )
+
+    # 参照系クエリの結果キャッシュ（QUERY_CACHE_ENABLED=true で有効、QUERY_CACHE_DIR でディスクにも保存）
+    query_cache = None
+    if os.getenv('QUERY_CACHE_ENABLED', 'false').lower() == 'true':
+        query_cache = QueryResultCache(
+            max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '256')),
+            max_rows_per_entry=MAX_RESULT_ROWS or 10000,
+            ttl=int(os.getenv('QUERY_CACHE_TTL', '300')),
+            disk_dir=os.getenv('QUERY_CACHE_DIR') or None,
+        )
+
+    # ログイン直後にバックグラウンドで接続を開いておく（SF_PREWARM_ON_LOGIN=true）
+    # SF_PREWARM_RESUME_WAREHOUSE=true なら停止中の Warehouse も再開させる（OPERATE 権限が必要）
+    prewarmer = None
+    if os.getenv('SF_PREWARM_ON_LOGIN', 'false').lower() == 'true':
+        prewarmer = SessionPrewarmer(
+            sf_pool,
+            max_workers=int(os.getenv('SF_PREWARM_WORKERS', '4')),
+            resume_warehouse=os.getenv('SF_PREWARM_RESUME_WAREHOUSE', 'false').lower() == 'true',
+        )
+
+    # 実行したクエリの履歴（QUERY_HISTORY_DB に SQLite のファイルを指定すると有効、/history とレポートで参照）
+    query_history = None
+    if os.getenv('QUERY_HISTORY_DB'):
+        query_history = QueryHistory(
+            os.getenv('QUERY_HISTORY_DB'),
+            batch_size=int(os.getenv('QUERY_HISTORY_BATCH_SIZE', '200')),
+            flush_interval=float(os.getenv('QUERY_HISTORY_FLUSH_INTERVAL', '1')),
+            retention_days=int(os.getenv('QUERY_HISTORY_RETENTION_DAYS', '30')),
+        )
+
+    def refresh_access_token(refresh_token):
+        """リフレッシュトークンを使ってアクセストークンを更新"""
+        token_data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': SNOWFLAKE_CLIENT_ID,
+            'client_secret': SNOWFLAKE_CLIENT_SECRET
+        }
     
-    try:
-        response = requests.post(token_url, data=token_data)
-        if response.status_code == 200:
-            new_token_data = response.json()
-            save_token(new_token_data)
-            return new_token_data
-        else:
-            print(f"Token refresh failed: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        print(f"Token refresh error: {str(e)}")
-        return None
-
-def get_valid_token():
-    """有効なトークンを取得（必要に応じて自動更新）"""
-    token_data = load_token()
-    if not token_data:
-        return None
-    
-    # トークンが期限切れ間近かチェック
-    if is_token_expired(token_data):
-        refresh_token = token_data.get('refresh_token')
-        if refresh_token:
-            # トークンを更新
-            new_token_data = refresh_access_token(refresh_token)
-            if new_token_data:
-                return new_token_data
+        try:
+            response = oauth_http.post(TOKEN_ENDPOINT, data=token_data)
+            if response.status_code == 200:
+                return response.json()
             else:
-                # リフレッシュに失敗した場合、古いトークンファイルを削除
-                if os.path.exists(TOKEN_FILE):
-                    os.remove(TOKEN_FILE)
+                print(f"Token refresh failed: {response.status_code} - {response.text}")
                 return None
-        else:
+        except Exception as e:
+            print(f"Token refresh error: {str(e)}")
             return None
-    
-    return token_data
 
-@app.route('/')
-def index():
-    token_data = get_valid_token()
-    if token_data:
-        return render_template('dashboard.html', authenticated=True)
-    return render_template('login.html')
+    # トークンはログインごとのキー（Flask セッションに保存）で保存先に置き、ユーザー間で共有しない
+    # 保存先のロックはリフレッシュ（トークンエンドポイントへの全リトライ）が終わるまで保持し、
+    # 待つ側も同じ時間で諦めて保存済みのトークンを読み直す（持っているプロセスが止まっても待ち続けない）
+    token_backend = open_backend(TOKEN_STORE_URL, lock_timeout=int(oauth_http.max_duration()) + 10,
+                                 lock_wait_timeout=oauth_http.max_duration())
+    token_store = TokenStore(token_backend, metrics.track_refresh(refresh_access_token),
+                             refresh_wait_timeout=oauth_http.max_duration(), refresh_token_ttl=TOKEN_REFRESH_TTL)
+    # 更新時は同じログインの接続（Snowflake セッション）を使い続け、ログアウト・更新失敗時は接続を破棄
+    token_store.add_listener(lambda old, new: sf_pool.rotate_token(old.get('access_token'), new.get('access_token'))
+                             if new else sf_pool.evict_token(old.get('access_token')))
+    # 期限前にバックグラウンドで更新し、リクエスト処理中のリフレッシュ待ちをなくす
+    token_refresher = TokenRefresher(token_store, active_window=TOKEN_REFRESH_ACTIVE_WINDOW)
+
+    # 段階ごとの処理時間・リフレッシュ回数・接続プールの状態を /metrics で公開し、リクエストごとにJSONログを出す
+    metrics.init_app(app, pool=sf_pool, refresher=token_refresher, oauth_http=oauth_http,
+                     query_cache=query_cache, admission=admission, prewarmer=prewarmer,
+                     query_history=query_history,
+                     log_requests=os.getenv('REQUEST_LOG', 'true').lower() == 'true')
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    """Snowflake OAuth認証を開始（PKCE対応）"""
-    # GETリクエストの場合はログインフォームを表示
-    if request.method == 'GET':
+    def current_token_key():
+        """このブラウザセッションのトークンのキー（未ログインなら None）"""
+        return session.get('token_key')
+
+    def get_valid_token():
+        """有効なトークンを取得（必要に応じて自動更新、同時リクエストの更新は1回にまとめる）"""
+        with metrics.phase('token'):
+            token_data = token_store.get_valid_token(current_token_key())
+        if token_data:
+            # 他のワーカーで更新されたトークンでも、このログインで開いた接続を使う
+            sf_pool.bind_token(token_data.get('access_token'), current_token_key())
+        return token_data
+
+    def snowflake_token(token_data):
+        """接続プールに渡すトークン（Snowflake に拒否されたら更新したトークンで接続し直す）"""
+        return token_store.provider(current_token_key(), token_data)
+
+    @app.before_request
+    def start_token_refresher():
+        """リクエストを処理するプロセスでのみ更新スレッドを起動（リローダーの親プロセスでは起動しない）"""
+        token_refresher.start()
+
+    def current_user(token_data):
+        """同時実行数を数える利用者（トークンレスポンスの username、なければログインごとのキー）"""
+        return token_data.get('username') or current_token_key()
+
+    def admit_query(token_data, warehouse):
+        """利用者・Warehouse ごとの実行枠を取る（待った時間は queue として記録）"""
+        with metrics.phase('queue'):
+            return admission.acquire(current_user(token_data), warehouse)
+
+    @app.context_processor
+    def inject_presets():
+        """ログイン時に指定した Warehouse をフォームの初期値にする（クエリ履歴が有効ならリンクを出す）"""
+        return {'default_warehouse': session.get('warehouse', ''),
+                'history_enabled': query_history is not None}
+
+    @app.route('/')
+    def index():
+        token_data = get_valid_token()
+        if token_data:
+            return render_template('dashboard.html', authenticated=True)
         return render_template('login.html')
+
+    @app.route('/login', methods=['GET', 'POST'])
+    def login():
+        """Snowflake OAuth認証を開始（PKCE対応）"""
+        # GETリクエストの場合はログインフォームを表示
+        if request.method == 'GET':
+            return render_template('login.html')
     
-    # POSTリクエストの場合はOAuth認証を開始
-    role = request.form.get('role', '').strip()
+        # POSTリクエストの場合はOAuth認証を開始
+        role = request.form.get('role', '').strip()
     
-    state = secrets.token_urlsafe(32)
-    code_verifier = generate_token(128)
-    code_challenge = create_s256_code_challenge(code_verifier)
+        # authlib は PKCE の値を作るときだけ読み込む
+        from authlib.common.security import generate_token
+        from authlib.oauth2.rfc7636 import create_s256_code_challenge
     
-    session['oauth_state'] = state
-    session['code_verifier'] = code_verifier
+        # 最初のクエリの Warehouse（ダッシュボードの初期値、ログイン直後の接続の準備に使う）
+        session['warehouse'] = request.form.get('warehouse', '').strip() or SNOWFLAKE_WAREHOUSE or ''
     
-    auth_params = {
-        'response_type': 'code',
-        'client_id': SNOWFLAKE_CLIENT_ID,
-        'redirect_uri': 'http://127.0.0.1:5000/callback',
-        'scope': f'refresh_token{f" session:role:{role}" if role else ""}',
-        'state': state,
-        'code_challenge': code_challenge,
-        'code_challenge_method': 'S256'
-    }
+        state = secrets.token_urlsafe(32)
+        code_verifier = generate_token(128)
+        code_challenge = create_s256_code_challenge(code_verifier)
+    
+        session['oauth_state'] = state
+        session['code_verifier'] = code_verifier
+        # トークンレスポンスに scope がなければ要求したスコープ（ロール）をトークンに記録する
+        session['oauth_scope'] = f'refresh_token{f" session:role:{role}" if role else ""}'
+    
+        auth_params = {
+            'response_type': 'code',
+            'client_id': SNOWFLAKE_CLIENT_ID,
+            'redirect_uri': OAUTH_REDIRECT_URI,
+            'scope': session['oauth_scope'],
+            'state': state,
+            'code_challenge': code_challenge,
+            'code_challenge_method': 'S256'
+        }
     
-    auth_url = f"https://{SNOWFLAKE_ACCOUNT_IDENTIFIER}.snowflakecomputing.com/oauth/authorize?" + urlencode(auth_params)
-    return redirect(auth_url)
+        auth_url = f"{AUTHORIZATION_ENDPOINT}?" + urlencode(auth_params)
+        return redirect(auth_url)
 
-@app.route('/callback')
-def callback():
-    """OAuth認証のコールバック処理"""
-    code = request.args.get('code')
-    state = request.args.get('state')
+    @app.route('/callback')
+    def callback():
+        """OAuth認証のコールバック処理"""
+        code = request.args.get('code')
+        state = request.args.get('state')
     
-    if not code:
-        flash('認証に失敗しました', 'error')
-        return redirect(url_for('index'))
+        if not code:
+            flash('認証に失敗しました', 'error')
+            return redirect(url_for('index'))
     
-    if state != session.get('oauth_state'):
-        flash('不正なリクエストです', 'error')
-        return redirect(url_for('index'))
+        if state != session.get('oauth_state'):
+            flash('不正なリクエストです', 'error')
+            return redirect(url_for('index'))
     
-    code_verifier = session.get('code_verifier')
-    if not code_verifier:
-        flash('セッションが無効です', 'error')
-        return redirect(url_for('index'))
+        code_verifier = session.get('code_verifier')
+        if not code_verifier:
+            flash('セッションが無効です', 'error')
+            return redirect(url_for('index'))
     
-    token_data = {
-        'grant_type': 'authorization_code',
-        'code': code,
-        'client_id': SNOWFLAKE_CLIENT_ID,
-        'client_secret': SNOWFLAKE_CLIENT_SECRET,
-        'redirect_uri': 'http://127.0.0.1:5000/callback',
-        'code_verifier': code_verifier
-    }
+        token_data = {
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': SNOWFLAKE_CLIENT_ID,
+            'client_secret': SNOWFLAKE_CLIENT_SECRET,
+            'redirect_uri': OAUTH_REDIRECT_URI,
+            'code_verifier': code_verifier
+        }
     
-    token_url = f"https://{SNOWFLAKE_ACCOUNT_IDENTIFIER}.snowflakecomputing.com/oauth/token-request"
+        try:
+            response = oauth_http.post(TOKEN_ENDPOINT, data=token_data)
+            if response.status_code == 200:
+                token_info = response.json()
+                token_info.setdefault('scope', session.get('oauth_scope', ''))
+                # 以前のログインのトークンは破棄し、新しいキーで保存する
+                token_store.clear(current_token_key())
+                session['token_key'] = token_store.new_key()
+                token_store.save(current_token_key(), token_info)
+                if prewarmer:
+                    # 最初のクエリと同じ Warehouse の接続を開いておく（ロールはトークンのスコープで決まる）
+                    prewarmer.submit(token_info.get('access_token'), current_token_key(),
+                                     warehouse=session.get('warehouse'))
+                flash('ログイン成功！', 'success')
+                return redirect(url_for('dashboard'))
+            else:
+                flash(f'トークン取得に失敗しました: {response.text}', 'error')
+        except Exception as e:
+            flash(f'エラーが発生しました: {str(e)}', 'error')
     
-    try:
-        response = requests.post(token_url, data=token_data)
-        if response.status_code == 200:
-            token_info = response.json()
-            save_token(token_info)
-            flash('ログイン成功！', 'success')
-            return redirect(url_for('dashboard'))
-        else:
-            flash(f'トークン取得に失敗しました: {response.text}', 'error')
-    except Exception as e:
-        flash(f'エラーが発生しました: {str(e)}', 'error')
-    
-    return redirect(url_for('index'))
-
-@app.route('/dashboard')
-def dashboard():
-    """ダッシュボード画面"""
-    token_data = get_valid_token()
-    if not token_data:
         return redirect(url_for('index'))
+
+    @app.route('/dashboard')
+    def dashboard():
+        """ダッシュボード画面"""
+        token_data = get_valid_token()
+        if not token_data:
+            return redirect(url_for('index'))
     
-    return render_template('dashboard.html', authenticated=True)
+        return render_template('dashboard.html', authenticated=True)
 
-@app.route('/execute_sql', methods=['POST'])
-def execute_sql():
-    """SQL実行"""
-    token_data = get_valid_token()
-    if not token_data:
-        flash('認証が必要です。再ログインしてください。', 'error')
-        return redirect(url_for('index'))
+    @app.route('/execute_sql', methods=['POST'])
+    def execute_sql():
+        """SQL実行"""
+        token_data = get_valid_token()
+        if not token_data:
+            flash('認証が必要です。再ログインしてください。', 'error')
+            return redirect(url_for('index'))
     
-    sql_query = request.form.get('sql_query', '').strip()
-    warehouse = request.form.get('warehouse', '').strip()
-    role = request.form.get('role', '').strip()
+        sql_query = request.form.get('sql_query', '').strip()
+        warehouse = request.form.get('warehouse', '').strip()
+        role = request.form.get('role', '').strip()
     
-    if not sql_query:
-        flash('SQLクエリを入力してください', 'error')
-        return redirect(url_for('dashboard'))
+        if not sql_query:
+            flash('SQLクエリを入力してください', 'error')
+            return redirect(url_for('dashboard'))
     
-    try:
-        access_token = token_data.get('access_token')
-        
-        conn_params = {
-            'account': SNOWFLAKE_ACCOUNT_IDENTIFIER,
-            'token': access_token,
-            'authenticator': 'oauth'
-        }
-        
-        # Roleの設定（指定された場合のみ）
-        if role:
-            conn_params['role'] = role
-        
-        conn = snowflake.connector.connect(**conn_params)
-        cursor = conn.cursor()
-        
-        # Warehouseの設定（指定された場合のみ）
-        if warehouse:
-            cursor.execute(f"USE WAREHOUSE {warehouse}")
-        
-        # メインクエリを実行
-        cursor.execute(sql_query)
-        
-        results = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
+        try:
+            # 利用者・Warehouse ごとの実行枠を取る（結果を送り終えたら返す）
+            ticket = admit_query(token_data, warehouse)
+        except AdmissionRejected as e:
+            flash(str(e), 'error')
+            return render_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=sql_query,
+                                 warehouse=warehouse,
+                                 role=role), 429
+    
+        try:
+            access_token = snowflake_token(token_data)
         
-        cursor.close()
-        conn.close()
+            # プールの接続でメインクエリを実行（Role/Warehouseは接続パラメータとして設定）
+            # 結果は fetchmany でバッチ取得しながら描画するので、全行をメモリに載せない
+            if query_cache:
+                # キャッシュのキーには利用者（トークンレスポンスの username）とロールを決めるスコープを含める
+                results = query_cache.open_stream(sf_pool, access_token, sql_query,
+                                                  token_data.get('username', ''),
+                                                  scope=token_data.get('scope'),
+                                                  role=role, warehouse=warehouse,
+                                                  batch_size=RESULT_BATCH_SIZE,
+                                                  max_rows=MAX_RESULT_ROWS)
+            else:
+                results = open_result_stream(sf_pool, access_token, sql_query,
+                                             role=role, warehouse=warehouse,
+                                             batch_size=RESULT_BATCH_SIZE,
+                                             max_rows=MAX_RESULT_ROWS)
         
+            response = stream_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=sql_query,
+                                 warehouse=warehouse,
+                                 role=role,
+                                 results=results, 
+                                 columns=results.columns)
+            if query_history:
+                # 行数・クエリID・段階ごとの時間は結果を送り終えた後に記録する
+                query_history.track(sql_query, current_user(token_data), role=role, warehouse=warehouse,
+                                    stream=results)
+            if results.cache_status:
+                response.headers['X-Query-Cache'] = results.cache_status
+            response.call_on_close(ticket.release)
+            return response
+    
+        except Exception as e:
+            ticket.release()
+            if query_history:
+                query_history.track(sql_query, current_user(token_data), role=role, warehouse=warehouse, error=e)
+            flash(f'SQL実行エラー: {str(e)}', 'error')
+            return render_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=sql_query,
+                                 warehouse=warehouse,
+                                 role=role)
+
+    @app.route('/execute_batch', methods=['POST'])
+    def execute_batch():
+        """複数文のSQLをバッチ実行（独立した文は並列、依存する文は1つの接続で順に実行）"""
+        token_data = get_valid_token()
+        if not token_data:
+            flash('認証が必要です。再ログインしてください。', 'error')
+            return redirect(url_for('index'))
+    
+        sql_query = request.form.get('sql_query', '').strip()
+        warehouse = request.form.get('warehouse', '').strip()
+        role = request.form.get('role', '').strip()
+        batch_mode = request.form.get('batch_mode', 'parallel')
+    
+        if not sql_query:
+            flash('SQLクエリを入力してください', 'error')
+            return redirect(url_for('dashboard'))
+    
+        batch = None
+        try:
+            # 文ごとのエラーは結果に入るので、ここで捕まえるのはバッチ全体の失敗だけ
+            with admit_query(token_data, warehouse):
+                batch = batch_executor.run(sf_pool, snowflake_token(token_data), sql_query,
+                                           mode=batch_mode, role=role, warehouse=warehouse)
+        except (BatchError, AdmissionRejected) as e:
+            flash(str(e), 'error')
+        except Exception as e:
+            flash(f'SQL実行エラー: {str(e)}', 'error')
+        if batch and query_history:
+            # 文ごとに記録する（処理時間は文ごとの待ち時間と実行時間、実行しなかった文は記録しない）
+            for statement in batch.statements:
+                if statement.status in ('success', 'error'):
+                    query_history.track(statement.sql, current_user(token_data), role=role, warehouse=warehouse,
+                                        stream=statement,
+                                        duration=statement.queued_seconds + statement.elapsed_seconds,
+                                        phases={'queue': statement.queued_seconds,
+                                                'execute': statement.elapsed_seconds})
+    
         return render_template('dashboard.html', 
-                             authenticated=True, 
-                             sql_query=sql_query,
-                             warehouse=warehouse,
-                             role=role,
-                             results=results, 
-                             columns=columns)
-    
-    except Exception as e:
-        flash(f'SQL実行エラー: {str(e)}', 'error')
-        return render_template('dashboard.html', 
-                             authenticated=True, 
-                             sql_query=sql_query,
-                             warehouse=warehouse,
-                             role=role)
-
-@app.route('/logout')
-def logout():
-    """ログアウト"""
-    if os.path.exists(TOKEN_FILE):
-        os.remove(TOKEN_FILE)
-    session.clear()
-    flash('ログアウトしました', 'info')
-    return redirect(url_for('index'))
+                               authenticated=True, 
+                               sql_query=sql_query,
+                               warehouse=warehouse,
+                               role=role,
+                               batch_mode=batch_mode,
+                               batch=batch)
+
+    @app.route('/execute_sql_async', methods=['POST'])
+    def execute_sql_async():
+        """SQLを非同期で投入し、完了を待たずにクエリIDを返す"""
+        token_data = get_valid_token()
+        if not token_data:
+            return jsonify({'error': '認証が必要です。再ログインしてください。'}), 401
+    
+        sql_query = request.form.get('sql_query', '').strip()
+        warehouse = request.form.get('warehouse', '').strip()
+        role = request.form.get('role', '').strip()
+    
+        if not sql_query:
+            return jsonify({'error': 'SQLクエリを入力してください'}), 400
+    
+        try:
+            job = async_queries.submit(sf_pool, snowflake_token(token_data), sql_query,
+                                       role=role, warehouse=warehouse, owner=current_token_key(),
+                                       timeout=ASYNC_STATEMENT_TIMEOUT, user=current_user(token_data))
+        except (AsyncQueryLimitExceeded, AdmissionRejected) as e:
+            return jsonify({'error': str(e)}), 429
+        except Exception as e:
+            if query_history:
+                query_history.track(sql_query, current_user(token_data), role=role, warehouse=warehouse, error=e)
+            return jsonify({'error': f'SQL実行エラー: {str(e)}'}), 400
+    
+        return jsonify({
+            **job.to_dict(),
+            'status_url': url_for('query_status', query_id=job.query_id),
+            'results_url': url_for('query_results', query_id=job.query_id),
+            'cancel_url': url_for('cancel_query', query_id=job.query_id),
+        }), 202
+
+    @app.route('/query_status/<query_id>')
+    def query_status(query_id):
+        """非同期クエリの状態（ブラウザからポーリングする）"""
+        token_data = get_valid_token()
+        if not token_data:
+            return jsonify({'error': '認証が必要です。再ログインしてください。'}), 401
+    
+        job = async_queries.get(query_id, owner=current_token_key())
+        if not job:
+            return jsonify({'error': '不明なクエリIDです'}), 404
+    
+        was_done = job.done
+        try:
+            async_queries.refresh_status(sf_pool, snowflake_token(token_data), job)
+        except Exception as e:
+            return jsonify({'error': f'状態の取得に失敗しました: {str(e)}'}), 502
+        if query_history and job.done and not was_done:
+            # 非同期実行のクエリは完了を確認したときに1回だけ記録する（処理時間は投入から完了まで）
+            elapsed = job.finished_at - job.submitted_at
+            query_history.track(job.sql, current_user(token_data), role=job.role, warehouse=job.warehouse,
+                                stream=job, duration=elapsed, phases={'execute': elapsed})
+        return jsonify(job.to_dict())
+
+    @app.route('/cancel_query/<query_id>', methods=['POST'])
+    def cancel_query(query_id):
+        """非同期クエリの取り消し（SYSTEM$CANCEL_QUERY、自分が投入したクエリだけ）"""
+        token_data = get_valid_token()
+        if not token_data:
+            return jsonify({'error': '認証が必要です。再ログインしてください。'}), 401
+    
+        job = async_queries.get(query_id, owner=current_token_key())
+        if not job:
+            return jsonify({'error': '不明なクエリIDです'}), 404
+    
+        try:
+            async_queries.cancel(sf_pool, snowflake_token(token_data), job)
+        except Exception as e:
+            return jsonify({'error': f'取り消しに失敗しました: {str(e)}'}), 502
+        return jsonify(job.to_dict())
+
+    @app.route('/query_results/<query_id>')
+    def query_results(query_id):
+        """非同期クエリの結果表示"""
+        token_data = get_valid_token()
+        if not token_data:
+            flash('認証が必要です。再ログインしてください。', 'error')
+            return redirect(url_for('index'))
+    
+        job = async_queries.get(query_id, owner=current_token_key())
+        if not job:
+            flash('不明なクエリIDです', 'error')
+            return redirect(url_for('dashboard'))
+    
+        try:
+            ticket = admit_query(token_data, job.warehouse)
+        except AdmissionRejected as e:
+            flash(str(e), 'error')
+            return render_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=job.sql,
+                                 warehouse=job.warehouse,
+                                 role=job.role), 429
+    
+        try:
+            # 実行済みクエリの結果を get_results_from_sfqid で取得（再実行はしない）
+            results = open_result_stream(sf_pool, snowflake_token(token_data), job.sql,
+                                         role=job.role, warehouse=job.warehouse,
+                                         batch_size=RESULT_BATCH_SIZE,
+                                         max_rows=MAX_RESULT_ROWS,
+                                         query_id=job.query_id)
+            response = stream_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=job.sql,
+                                 warehouse=job.warehouse,
+                                 role=job.role,
+                                 results=results, 
+                                 columns=results.columns)
+            response.call_on_close(ticket.release)
+            return response
+        except Exception as e:
+            ticket.release()
+            flash(f'SQL実行エラー: {str(e)}', 'error')
+            return render_template('dashboard.html', 
+                                 authenticated=True, 
+                                 sql_query=job.sql,
+                                 warehouse=job.warehouse,
+                                 role=job.role)
+
+    @app.route('/export_sql', methods=['POST'])
+    def export_sql():
+        """SQL実行結果のダウンロード（CSV / NDJSON / Arrow / Parquet）"""
+        token_data = get_valid_token()
+        if not token_data:
+            flash('認証が必要です。再ログインしてください。', 'error')
+            return redirect(url_for('index'))
+    
+        sql_query = request.form.get('sql_query', '').strip()
+        warehouse = request.form.get('warehouse', '').strip()
+        role = request.form.get('role', '').strip()
+        export_format = request.form.get('export_format', 'csv')
+    
+        if not sql_query:
+            flash('SQLクエリを入力してください', 'error')
+            return redirect(url_for('dashboard'))
+    
+        ticket = None
+        try:
+            ticket = admit_query(token_data, warehouse)
+            # 結果は行数の上限なしで、Arrowバッチ単位でそのままレスポンスに書き出す
+            response = export_response(sf_pool, snowflake_token(token_data), sql_query, export_format,
+                                       role=role, warehouse=warehouse,
+                                       batch_size=EXPORT_BATCH_SIZE)
+            if query_history:
+                # 行数・送信したバイト数はダウンロードを送り終えた後に記録する
+                query_history.track(sql_query, current_user(token_data), role=role, warehouse=warehouse,
+                                    stream=response.export_result)
+            response.call_on_close(ticket.release)
+            return response
+        except (ExportError, AdmissionRejected) as e:
+            flash(str(e), 'error')
+        except Exception as e:
+            if query_history:
+                query_history.track(sql_query, current_user(token_data), role=role, warehouse=warehouse, error=e)
+            flash(f'SQL実行エラー: {str(e)}', 'error')
+        if ticket:
+            ticket.release()
+        return redirect(url_for('dashboard'))
+
+    @app.route('/history')
+    def history():
+        """クエリ履歴（このユーザーの最近のクエリと、遅いクエリ・実行回数の多いクエリ）"""
+        token_data = get_valid_token()
+        if not token_data:
+            return redirect(url_for('index'))
+        if not query_history:
+            flash('クエリ履歴は無効です（QUERY_HISTORY_DB で有効にします）', 'info')
+            return redirect(url_for('dashboard'))
+
+        days = request.args.get('days', 7, type=float)
+        user = current_user(token_data)
+        return render_template('history.html',
+                               authenticated=True,
+                               days=days,
+                               recent=query_history.recent(user),
+                               slowest=query_history.ranking('slowest', days=days, user=user, limit=10),
+                               frequent=query_history.ranking('frequent', days=days, user=user, limit=10))
+
+    @app.route('/token_status')
+    def token_status():
+        """トークン更新スレッドの状態（監視用、ログイン中のユーザーのみ・トークン本体は返さない）"""
+        token_data = token_store.load(current_token_key())
+        if not token_data:
+            return jsonify({'error': '認証が必要です。再ログインしてください。'}), 401
+        expires_at = None
+        if 'obtained_at' in token_data:
+            expires_at = token_data['obtained_at'] + token_data.get('expires_in', 3600)
+        return jsonify({
+            'expires_at': expires_at,
+            'refresher': token_refresher.state(),
+            'token_endpoint': oauth_http.stats(),
+        })
+
+    @app.route('/logout')
+    def logout():
+        """ログアウト（このセッションのトークンだけを破棄）"""
+        token_store.clear(current_token_key())
+        session.clear()
+        flash('ログアウトしました', 'info')
+        return redirect(url_for('index'))
+    
+    # ASGI 版（asgi_app.py）と共有する設定と部品
+    app.extensions['shared'] = {
+        'client_id': SNOWFLAKE_CLIENT_ID,
+        'client_secret': SNOWFLAKE_CLIENT_SECRET,
+        'token_endpoint': TOKEN_ENDPOINT,
+        'authorization_endpoint': AUTHORIZATION_ENDPOINT,
+        'redirect_uri': OAUTH_REDIRECT_URI,
+        'default_warehouse': SNOWFLAKE_WAREHOUSE,
+        'result_batch_size': RESULT_BATCH_SIZE,
+        'max_result_rows': MAX_RESULT_ROWS,
+        'sf_pool': sf_pool,
+        'token_store': token_store,
+        'token_refresher': token_refresher,
+        'admission': admission,
+        'query_cache': query_cache,
+        'prewarmer': prewarmer,
+        'query_history': query_history,
+    }
+
+    # ワーカー終了時に呼ぶ後始末（serving.run に渡す）
+    app.extensions['on_shutdown'] = [token_refresher.stop, batch_executor.close, sf_pool.close_all,
+                                     oauth_http.close]
+    if prewarmer:
+        app.extensions['on_shutdown'].insert(0, prewarmer.close)
+    if query_history:
+        app.extensions['on_shutdown'].append(query_history.close)
+    return app
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # --production（または APP_SERVER=gunicorn）で gunicorn のマルチワーカー構成で起動
+    app = create_app()
+    run(app, on_shutdown=app.extensions['on_shutdown'])
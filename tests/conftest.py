@@ -0,0 +1,13 @@
+"""共通モジュールと Cognito の Lambda のテスト
+
+Snowflake への接続は bench/fake_snowflake の合成コネクタで代用する（本物の snowflake-connector-python は不要）。
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, 'external_oauth', 'cognito', 'lambda')
+
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench', 'fake_snowflake'), LAMBDA_DIR]
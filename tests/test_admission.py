@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from common.admission import AdmissionController, AdmissionRejected
+from common.async_queries import AsyncQueryRegistry
+from common.sf_pool import SnowflakeConnectionPool
+
+
+def test_per_user_limit_waits_then_rejects():
+    admission = AdmissionController(max_per_user=2, queue_timeout=0.1)
+    tickets = [admission.acquire('alice', 'WH') for _ in range(2)]
+    started = time.perf_counter()
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('alice', 'WH')
+    assert time.perf_counter() - started >= 0.1
+    # 他の利用者は別に数える
+    admission.acquire('bob', 'WH').release()
+    tickets[0].release()
+    admission.acquire('alice', 'WH').release()
+    assert admission.stats()['rejected_total'] == 1
+
+
+def test_per_warehouse_limit():
+    admission = AdmissionController(max_per_user=0, max_per_warehouse=1, queue_timeout=0)
+    ticket = admission.acquire('alice', 'wh')
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('bob', 'WH')
+    admission.acquire('bob', 'OTHER').release()
+    ticket.release()
+    assert admission.stats()['running'] == 0
+
+
+def test_waiter_is_admitted_when_slot_frees():
+    admission = AdmissionController(max_per_user=1, queue_timeout=5)
+    ticket = admission.acquire('alice')
+    threading.Timer(0.1, ticket.release).start()
+    with admission.acquire('alice'):
+        assert admission.stats()['running'] == 1
+    assert admission.stats()['queued_total'] == 1
+
+
+def test_queue_limit_rejects_without_waiting():
+    admission = AdmissionController(max_per_user=1, max_queued_per_user=1, queue_timeout=1)
+    ticket = admission.acquire('alice')
+    waiter = threading.Thread(target=lambda: admission.acquire('alice').release())
+    waiter.start()
+    while not admission.stats()['queued']:
+        time.sleep(0.01)
+    started = time.perf_counter()
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('alice')
+    assert time.perf_counter() - started < 0.5
+    ticket.release()
+    waiter.join(5)
+
+
+def test_release_is_idempotent():
+    admission = AdmissionController(max_per_user=1, queue_timeout=0)
+    ticket = admission.acquire('alice')
+    ticket.release()
+    ticket.release()
+    assert admission.stats()['running'] == 0
+
+
+@pytest.fixture
+def slow_queries(monkeypatch):
+    # 合成コネクタの非同期クエリを 0.3 秒で完了させる
+    monkeypatch.setenv('FAKE_SF_EXECUTE_MS', '300')
+    return SnowflakeConnectionPool('account')
+
+
+def test_async_queries_use_admission_slots(slow_queries):
+    admission = AdmissionController(max_per_user=2, queue_timeout=5)
+    registry = AsyncQueryRegistry(admission=admission)
+    jobs = [registry.submit(slow_queries, 'token', f'select {i}', warehouse='WH', owner='k', user='alice')
+            for i in range(2)]
+    with pytest.raises(AdmissionRejected):
+        registry.submit(slow_queries, 'token', 'select 3', warehouse='WH', owner='k', user='alice')
+    assert admission.stats()['running'] == 2
+
+    # 取り消しと完了の確認で枠を返す
+    registry.cancel(slow_queries, 'token', jobs[0])
+    assert admission.stats()['running'] == 1
+    time.sleep(0.35)
+    registry.refresh_status(slow_queries, 'token', jobs[1])
+    assert jobs[1].status == 'SUCCESS'
+    assert admission.stats()['running'] == 0
+
+
+def test_unpolled_finished_queries_free_their_slots(slow_queries):
+    admission = AdmissionController(max_per_user=1, queue_timeout=0)
+    registry = AsyncQueryRegistry(admission=admission)
+    registry.submit(slow_queries, 'token', 'select 1', owner='k', user='alice')
+    time.sleep(0.35)
+    # 状態を確認しないまま終わったクエリは、次の投入時に問い合わせて枠を返す
+    registry.submit(slow_queries, 'token', 'select 2', owner='k', user='alice')
+    assert admission.stats()['running'] == 1
+
+
+def test_async_slot_is_released_after_statement_timeout(slow_queries):
+    admission = AdmissionController(max_per_user=1, queue_timeout=0)
+    registry = AsyncQueryRegistry(admission=admission)
+    registry.submit(slow_queries, 'token', 'select 1', owner='k', user='alice', timeout=0.05)
+    time.sleep(0.1)
+    registry.submit(slow_queries, 'token', 'select 2', owner='k', user='alice')
+    assert admission.stats()['running'] == 1
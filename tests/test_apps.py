@@ -0,0 +1,113 @@
+"""2つの Flask アプリ（python_web_app と Cognito の client_app）のエンドポイント"""
+import importlib.util
+import os
+import re
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+pytest.importorskip('flask')
+pytest.importorskip('dotenv')
+
+APP_DIRS = {
+    'python_web_app': os.path.join(ROOT, 'python_web_app'),
+    'cognito': os.path.join(ROOT, 'external_oauth', 'cognito', 'client_app'),
+}
+
+
+@pytest.fixture(params=sorted(APP_DIRS))
+def app_module(request, monkeypatch):
+    """app.py を読み込む（設定は create_app() で環境変数から読むので、テストごとに setenv してから呼ぶ）"""
+    app_dir = APP_DIRS[request.param]
+    monkeypatch.syspath_prepend(app_dir)
+    monkeypatch.setenv('REQUEST_LOG', 'false')
+    # どちらも app.py なので、別の名前で読み込む
+    spec = importlib.util.spec_from_file_location(f'app_{request.param}', os.path.join(app_dir, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Flask はテンプレートの場所をモジュールのファイルから探す
+    monkeypatch.setitem(sys.modules, spec.name, module)
+    spec.loader.exec_module(module)
+    yield module
+    sys.modules.pop('jwt_verifier', None)
+
+
+def _login(app, client):
+    token_store = app.extensions['shared']['token_store']
+    key = token_store.new_key()
+    token_store.save(key, {'access_token': 'access-' + key, 'refresh_token': 'refresh', 'expires_in': 3600})
+    with client.session_transaction() as session:
+        session['token_key'] = key
+
+
+def test_token_status_requires_login(app_module):
+    app = app_module.create_app()
+    client = app.test_client()
+    assert client.get('/token_status').status_code == 401
+    _login(app, client)
+    body = client.get('/token_status').get_json()
+    assert 'last_error' not in body['refresher']
+    assert body['expires_at'] > time.time()
+
+
+
+def test_metrics_are_not_duplicated_across_apps(app_module):
+    first = app_module.create_app()
+    second = app_module.create_app()
+    text = second.test_client().get('/metrics').get_data(as_text=True)
+    types = re.findall(r'^# TYPE (\S+)', text, re.M)
+    assert types and len(types) == len(set(types))
+    assert first.extensions['metrics']['observers'] is not second.extensions['metrics']['observers']
+
+def test_async_queries_count_against_admission(app_module, monkeypatch):
+    monkeypatch.setenv('FAKE_SF_EXECUTE_MS', '300')
+    monkeypatch.setenv('MAX_QUERIES_PER_USER', '2')
+    app = app_module.create_app()
+    client = app.test_client()
+    _login(app, client)
+    responses = [client.post('/execute_sql_async', data={'sql_query': f'select {i}', 'warehouse': 'WH'})
+                 for i in range(3)]
+    assert [response.status_code for response in responses] == [202, 202, 429]
+    assert app.extensions['shared']['admission'].stats()['running'] == 2
+
+    assert client.post(responses[0].get_json()['cancel_url']).status_code == 200
+    assert client.post('/execute_sql_async', data={'sql_query': 'select 3', 'warehouse': 'WH'}).status_code == 202
+
+
+def test_query_history_records_batch_export_and_async(app_module, monkeypatch, tmp_path):
+    db = str(tmp_path / 'history.db')
+    monkeypatch.setenv('QUERY_HISTORY_DB', db)
+    monkeypatch.setenv('FAKE_SF_EXECUTE_MS', '50')
+    app = app_module.create_app()
+    client = app.test_client()
+    _login(app, client)
+
+    response = client.post('/execute_sql', data={'sql_query': 'select 1 limit 3', 'warehouse': 'WH'})
+    html_bytes = len(response.get_data())
+    response.close()
+    client.post('/execute_batch', data={'sql_query': 'select 2 limit 2; select fail', 'warehouse': 'WH'})
+    response = client.post('/export_sql', data={'sql_query': 'select 3 limit 4', 'warehouse': 'WH',
+                                                'export_format': 'csv'})
+    export_bytes = len(response.get_data())
+    response.close()
+    status_url = client.post('/execute_sql_async', data={'sql_query': 'select 4', 'warehouse': 'WH'}
+                             ).get_json()['status_url']
+    for _ in range(50):
+        if client.get(status_url).get_json()['status'] == 'SUCCESS':
+            break
+        time.sleep(0.02)
+    client.get(status_url)  # 完了後の問い合わせでは記録し直さない
+
+    history = app.extensions['shared']['query_history']
+    history.close()
+    rows = {row['sql_text'].lower(): row for row in history._query('SELECT * FROM query_history', ())}
+    assert sorted(rows) == ['select 1 limit 3', 'select 2 limit 2', 'select 3 limit 4', 'select 4', 'select fail']
+    # 送信したバイト数はそのクエリの結果を返したレスポンスの本文（結果表の一部を含むページ・ファイル）
+    assert 0 < rows['select 1 limit 3']['response_bytes'] <= html_bytes
+    assert (rows['select 3 limit 4']['rows'], rows['select 3 limit 4']['response_bytes']) == (4, export_bytes)
+    assert rows['select 3 limit 4']['endpoint'] == 'export_sql'
+    assert (rows['select 2 limit 2']['rows'], rows['select 2 limit 2']['response_bytes']) == (2, None)
+    assert rows['select fail']['status'] == 'error'
+    assert rows['select 4']['endpoint'] == 'query_status' and rows['select 4']['query_id']
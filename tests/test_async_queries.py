@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from common.async_queries import AsyncQueryLimitExceeded, AsyncQueryRegistry
+from common.sf_pool import SnowflakeConnectionPool
+
+
+@pytest.fixture
+def slow_queries(monkeypatch):
+    # 合成コネクタの非同期クエリを 0.3 秒で完了させる
+    monkeypatch.setenv('FAKE_SF_EXECUTE_MS', '300')
+    return SnowflakeConnectionPool('account')
+
+
+def test_per_owner_job_limit(slow_queries):
+    registry = AsyncQueryRegistry(max_jobs_per_owner=2)
+    for i in range(2):
+        registry.submit(slow_queries, 'token', f'select {i}', owner='k')
+    with pytest.raises(AsyncQueryLimitExceeded):
+        registry.submit(slow_queries, 'token', 'select 3', owner='k')
+    # 他の利用者のジョブは押し出さない
+    other = registry.submit(slow_queries, 'token', 'select 4', owner='other')
+    time.sleep(0.35)
+    # 完了したジョブは古い順に捨てて新しいクエリを受け付ける
+    registry.submit(slow_queries, 'token', 'select 5', owner='k')
+    assert registry.get(other.query_id, owner='other') is other
+
+
+def test_jobs_are_visible_only_to_their_owner(slow_queries):
+    registry = AsyncQueryRegistry()
+    job = registry.submit(slow_queries, 'token', 'select 1', owner='k')
+    assert registry.get(job.query_id, owner='k') is job
+    assert registry.get(job.query_id, owner='other') is None
+    assert registry.get('not-a-query-id', owner='k') is None
+
+
+def test_cancelled_query_reports_error(slow_queries):
+    registry = AsyncQueryRegistry()
+    job = registry.submit(slow_queries, 'token', 'select 1', owner='k')
+    registry.cancel(slow_queries, 'token', job)
+    registry.refresh_status(slow_queries, 'token', job)
+    assert job.done and job.status != 'SUCCESS'
+    assert job.error
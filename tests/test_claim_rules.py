@@ -0,0 +1,69 @@
+import copy
+import glob
+import json
+import os
+import re
+
+import pytest
+
+import pre_token_generation
+from conftest import LAMBDA_DIR, ROOT
+from pre_token_generation import ClaimRules
+
+EVENT_FILES = sorted(glob.glob(os.path.join(LAMBDA_DIR, 'events', '*.json')))
+
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _scp(result):
+    details = result['response']['claimsAndScopeOverrideDetails']
+    access = details['accessTokenGeneration']['claimsToAddOrOverride']['scp']
+    assert details['idTokenGeneration']['claimsToAddOrOverride']['scp'] == access
+    return access
+
+
+@pytest.mark.parametrize('path', EVENT_FILES, ids=os.path.basename)
+def test_sample_events(path, monkeypatch):
+    case = _load(path)
+    if 'rules' in case:
+        monkeypatch.setattr(pre_token_generation, 'RULES', ClaimRules(case['rules']))
+    result = pre_token_generation.lambda_handler(copy.deepcopy(case['event']), None)
+    assert _scp(result) == case['expected_scp']
+
+
+@pytest.mark.parametrize('value', ['ACCOUNTADMIN', 'SECURITYADMIN,SYSADMIN', 'analyst,ACCOUNTADMIN'])
+def test_shipped_rules_ignore_user_writable_attribute(value):
+    # 利用者が自分で書き換えられる属性から、グループで許可されていないロールを得られない
+    case = _load(os.path.join(LAMBDA_DIR, 'events', 'analyst_attribute_escalation.json'))
+    event = copy.deepcopy(case['event'])
+    event['request']['userAttributes']['custom:snowflake_role'] = value
+    event['request']['scopes'] = ['openid'] + [f'session/role:{role}' for role in value.split(',')]
+    rules = pre_token_generation.load_rules(os.path.join(LAMBDA_DIR, 'claim_rules.json'))
+    assert rules.allowed_roles(['analysts'], event['request']['userAttributes']) == {'ANALYST'}
+    assert rules.scp(['analysts'], event['request']['userAttributes'], event['request']['scopes']) \
+        == 'session:role:ANALYST'
+
+
+def test_requested_role_outside_groups_is_not_granted():
+    rules = ClaimRules({'groups': {'analysts': ['ANALYST']}})
+    assert rules.scp(['analysts'], {}, ['session/role:ACCOUNTADMIN']) == 'session:role:ANALYST'
+    assert rules.scp(['analysts'], {}, ['session/role:analyst']) == 'session:role:ANALYST'
+
+
+def test_attribute_value_cannot_inject_scopes():
+    rules = ClaimRules({'default_roles': [], 'attributes': {'custom:snowflake_role': '$value'}})
+    assert rules.allowed_roles([], {'custom:snowflake_role': 'PUBLIC session:role-any'}) == set()
+    with pytest.raises(ValueError):
+        ClaimRules({'groups': {'g': ['PUBLIC session:role-any']}})
+
+
+def test_app_clients_cannot_write_role_attribute():
+    # custom:snowflake_role を書き込めるのは管理者（AdminUpdateUserAttributes）だけ
+    with open(os.path.join(ROOT, 'external_oauth', 'cognito', 'terraform', 'cognito.tf'), encoding='utf-8') as f:
+        terraform = f.read()
+    write_attributes = re.findall(r'^\s*write_attributes\s*=\s*\[(.*)\]', terraform, re.M)
+    assert write_attributes
+    assert all('custom:snowflake_role' not in attributes for attributes in write_attributes)
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip('flask')
+
+from flask import Flask  # noqa: E402
+
+from common import metrics  # noqa: E402
+
+
+class _Stats:
+    def stats(self):
+        return {'running': 1, 'admitted_total': 2}
+
+
+def _app(observed):
+    app = Flask(__name__)
+    metrics.init_app(app, admission=_Stats(), log_requests=False)
+    app.extensions['metrics']['observers'].append(lambda *args: observed.append(args[0]))
+
+    @app.route('/ping')
+    def ping():
+        return 'ok'
+    return app
+
+
+def test_collectors_and_observers_are_per_app():
+    first_observed, second_observed = [], []
+    first, second = _app(first_observed), _app(second_observed)
+    text = second.test_client().get('/metrics').get_data(as_text=True)
+    assert text.count('# TYPE app_admission_running gauge') == 1
+    assert text.count('# TYPE app_request_duration_seconds histogram') == 1
+
+    first.test_client().get('/ping')
+    assert first_observed == ['ping']
+    assert second_observed == ['metrics']
@@ -0,0 +1,93 @@
+import datetime
+import decimal
+import os
+import stat
+
+import pytest
+
+from common.query_cache import QueryResultCache, is_cacheable
+from common.sf_pool import SnowflakeConnectionPool
+
+
+def test_key_separates_users_and_scopes():
+    key = QueryResultCache.make_key('select 1', 'ANALYST', 'WH', 'alice', 'session:role:ANALYST')
+    assert key != QueryResultCache.make_key('select 1', 'ANALYST', 'WH', 'bob', 'session:role:ANALYST')
+    assert key != QueryResultCache.make_key('select 1', 'ANALYST', 'WH', 'alice', 'session:role:SALES')
+    assert key != QueryResultCache.make_key('select 1', 'ANALYST', 'WH', 'alice')
+    assert key != QueryResultCache.make_key('select 1', 'ANALYST', 'OTHER_WH', 'alice', 'session:role:ANALYST')
+
+
+def test_key_ignores_formatting_and_scope_order():
+    key = QueryResultCache.make_key('SELECT 1', 'analyst', 'wh', 'alice', 'refresh_token session:role:ANALYST')
+    assert key == QueryResultCache.make_key('  select   1 ', 'ANALYST', 'WH', 'alice',
+                                            ['session:role:ANALYST', 'refresh_token'])
+
+
+def test_results_are_not_shared_between_users():
+    cache = QueryResultCache()
+    cache.put(QueryResultCache.make_key('select 1', None, 'WH', 'alice'), ['A'], [(1,)])
+    assert cache.get(QueryResultCache.make_key('select 1', None, 'WH', 'alice')) is not None
+    assert cache.get(QueryResultCache.make_key('select 1', None, 'WH', 'bob')) is None
+
+
+def _read(cache, subject, scope=None):
+    stream = cache.open_stream(SnowflakeConnectionPool('account'), 'token', 'select 1 limit 3', subject,
+                               warehouse='WH', scope=scope)
+    try:
+        list(stream)
+    finally:
+        stream.close()
+    return stream.cache_status
+
+
+def test_stream_hits_only_for_the_same_user_and_scope():
+    cache = QueryResultCache()
+    assert _read(cache, 'alice', 'session:role:ANALYST') == 'MISS'
+    assert _read(cache, 'alice', 'session:role:ANALYST') == 'HIT'
+    assert _read(cache, 'alice', 'session:role:SALES') == 'MISS'
+    assert _read(cache, 'bob', 'session:role:ANALYST') == 'MISS'
+
+
+def test_unknown_user_bypasses_cache():
+    cache = QueryResultCache()
+    assert _read(cache, None) is None
+    assert _read(cache, '') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_tier_round_trips_values_without_pickle(tmp_path):
+    disk_dir = str(tmp_path / 'cache')
+    rows = [(1, 1.5, 'a', None, True, decimal.Decimal('1.20'), datetime.date(2024, 1, 2),
+             datetime.datetime(2024, 1, 2, 3, 4, 5, 6), datetime.time(1, 2), b'\x00\xff')]
+    QueryResultCache(disk_dir=disk_dir).put('k', ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J'], rows)
+    assert os.listdir(disk_dir) == ['k.json']
+    assert stat.S_IMODE(os.stat(disk_dir).st_mode) == 0o700
+    entry = QueryResultCache(disk_dir=disk_dir).get('k')
+    assert entry.rows == rows
+    assert entry.columns == ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
+
+
+def test_disk_tier_keeps_arrow_tables(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    disk_dir = str(tmp_path / 'cache')
+    table = pa.table({'ID': [1, 2], 'NAME': ['a', None]})
+    QueryResultCache(disk_dir=disk_dir).put('k', ['ID', 'NAME'], table)
+    assert os.listdir(disk_dir) == ['k.arrow']
+    entry = QueryResultCache(disk_dir=disk_dir).get('k')
+    assert entry.rows.equals(table)
+    assert entry.columns == ['ID', 'NAME']
+
+
+def test_disk_tier_refuses_shared_directory(tmp_path):
+    disk_dir = tmp_path / 'shared'
+    disk_dir.mkdir()
+    disk_dir.chmod(0o777)
+    with pytest.raises(ValueError):
+        QueryResultCache(disk_dir=str(disk_dir))
+
+
+def test_read_only_check_matches_pool():
+    # 並列バッチ実行と同じ判定（括弧で始まる SELECT も参照系）
+    assert is_cacheable('(select 1) union (select 2)')
+    assert not is_cacheable('insert into t select 1')
+    assert not is_cacheable('select 1; drop table t')
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+import snowflake.connector
+from snowflake.connector.errors import ProgrammingError
+
+from common.sf_pool import SnowflakeConnectionPool
+from common.sql_results import open_result_stream
+from common.token_backends import MemoryTokenBackend
+from common.token_store import TokenStore
+
+
+@pytest.fixture
+def connected_tokens(monkeypatch):
+    # Snowflake は無効・期限切れの OAuth トークンでのログインを 390303 で拒否する
+    tokens = []
+    connect = snowflake.connector.connect
+
+    def fake_connect(**params):
+        tokens.append(params['token'])
+        if params['token'] == 'old':
+            raise ProgrammingError('Invalid OAuth access token.', errno=390303)
+        return connect(**params)
+
+    monkeypatch.setattr(snowflake.connector, 'connect', fake_connect)
+    return tokens
+
+
+def _store(refresh_calls):
+    def refresh(refresh_token):
+        refresh_calls.append(refresh_token)
+        return {'access_token': 'new', 'expires_in': 3600}
+    store = TokenStore(MemoryTokenBackend(), refresh)
+    # 期限内でも Snowflake に拒否されたトークン
+    store.save('k', {'access_token': 'old', 'refresh_token': 'r', 'expires_in': 3600,
+                     'obtained_at': int(time.time())})
+    return store
+
+
+def _select_one(conn):
+    return conn.cursor().execute('select 1 limit 1').fetchall()
+
+
+def test_run_retries_rejected_token_with_refreshed_token(connected_tokens):
+    refresh_calls = []
+    store = _store(refresh_calls)
+    pool = SnowflakeConnectionPool('account')
+    provider = store.provider('k', store.load('k'))
+    assert len(pool.run(provider, _select_one)) == 1
+    assert connected_tokens == ['old', 'new']
+    assert refresh_calls == ['r']
+    assert store.load('k')['access_token'] == 'new'
+    assert pool.stats()['reconnects_total'] == 1
+    # 次の実行は更新後のトークンの接続を使い、更新し直さない
+    pool.run(provider, _select_one)
+    assert connected_tokens == ['old', 'new']
+    assert refresh_calls == ['r']
+
+
+def test_result_stream_retries_rejected_token_with_refreshed_token(connected_tokens):
+    refresh_calls = []
+    store = _store(refresh_calls)
+    stream = open_result_stream(SnowflakeConnectionPool('account'), store.provider('k', store.load('k')),
+                                'select 1 limit 2')
+    try:
+        assert len(list(stream)) == 2
+    finally:
+        stream.close()
+    assert connected_tokens == ['old', 'new']
+    assert refresh_calls == ['r']
+
+
+def test_rejected_token_without_provider_is_not_retried(connected_tokens):
+    with pytest.raises(ProgrammingError) as excinfo:
+        SnowflakeConnectionPool('account').run('old', _select_one)
+    assert excinfo.value.errno == 390303
+    assert connected_tokens == ['old']
+
+
+def test_refresh_failure_raises_original_error(connected_tokens):
+    store = TokenStore(MemoryTokenBackend(), lambda refresh_token: None)
+    store.save('k', {'access_token': 'old', 'refresh_token': 'r', 'expires_in': 3600,
+                     'obtained_at': int(time.time())})
+    with pytest.raises(ProgrammingError):
+        SnowflakeConnectionPool('account').run(store.provider('k', store.load('k')), _select_one)
+    assert connected_tokens == ['old']
+    # 拒否後の更新の失敗ではトークンを消さない（ログアウトは通常のリクエストの更新に任せる）
+    assert store.load('k') is not None
@@ -0,0 +1,61 @@
+import time
+
+from common.token_backends import SQLiteTokenBackend
+from common.token_refresher import TokenRefresher
+from common.token_store import TokenStore
+
+
+def _expiring_token(refresh_token):
+    return {'access_token': 'old-' + refresh_token, 'refresh_token': refresh_token,
+            'expires_in': 60, 'obtained_at': int(time.time())}
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_refreshes_only_recently_used_tokens(tmp_path):
+    calls = []
+
+    def refresh(refresh_token):
+        calls.append(refresh_token)
+        return {'access_token': 'new-' + refresh_token, 'expires_in': 3600}
+
+    backend = SQLiteTokenBackend(str(tmp_path / 'tokens.db'))
+    store = TokenStore(backend, refresh)
+    store.save('active', _expiring_token('r-active'))
+    store.save('idle', _expiring_token('r-idle'))
+    backend.touch('idle', time.time() - 7200)
+
+    refresher = TokenRefresher(store, active_window=3600, idle_interval=0.1)
+    refresher.start()
+    try:
+        assert _wait_for(lambda: refresher.state()['refresh_count'] == 1)
+        time.sleep(0.3)
+    finally:
+        refresher.stop()
+    assert calls == ['r-active']
+    assert refresher.state()['tracked_tokens'] == 1
+    # 使われていないログインのトークンは次のリクエストで更新する
+    assert store.load('idle')['access_token'] == 'old-r-idle'
+
+
+def test_only_one_process_refreshes(tmp_path):
+    path = str(tmp_path / 'tokens.db')
+    # 同じファイルを別々に開いた保存先（別のワーカーに相当）
+    refreshers = [TokenRefresher(TokenStore(SQLiteTokenBackend(path), lambda refresh_token: None),
+                                 idle_interval=0.1) for _ in range(2)]
+    for refresher in refreshers:
+        refresher.start()
+    try:
+        assert _wait_for(lambda: all(refresher.state()['running'] for refresher in refreshers))
+        time.sleep(0.3)
+        assert sorted(refresher.state()['leader'] for refresher in refreshers) == [False, True]
+    finally:
+        for refresher in refreshers:
+            refresher.stop()
@@ -0,0 +1,185 @@
+import asyncio
+import contextlib
+import hashlib
+import threading
+import time
+
+import pytest
+
+from common.token_backends import MemoryTokenBackend, SQLiteTokenBackend
+from common.token_store import AsyncTokenStore, LockTimeout, TokenStore
+
+
+def _expiring_token(refresh_token):
+    # 期限切れ間近（buffer_seconds の内側）のトークン
+    return {'access_token': 'old-' + refresh_token, 'refresh_token': refresh_token,
+            'expires_in': 60, 'obtained_at': int(time.time())}
+
+
+def _slow_refresh(calls, delay):
+    def refresh(refresh_token):
+        calls.append(refresh_token)
+        time.sleep(delay)
+        return {'access_token': 'new-' + refresh_token, 'expires_in': 3600}
+    return refresh
+
+
+def _run_concurrently(*funcs):
+    results = [None] * len(funcs)
+
+    def run(i):
+        results[i] = funcs[i]()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def _keys_in_different_stripes():
+    # SQLiteTokenBackend.lock はキーのハッシュでロックファイルを分けるので、別のファイルになる2つのキー
+    def stripe(key):
+        return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) % SQLiteTokenBackend.LOCK_STRIPES
+    keys = ['a', 'b']
+    while stripe(keys[0]) == stripe(keys[1]):
+        keys[1] += 'x'
+    return keys
+
+
+def test_concurrent_requests_refresh_once(tmp_path):
+    calls = []
+    store = TokenStore(SQLiteTokenBackend(str(tmp_path / 'tokens.db')), _slow_refresh(calls, 0.3))
+    store.save('k', _expiring_token('r1'))
+    results = _run_concurrently(*[lambda: store.get_valid_token('k')] * 5)
+    assert calls == ['r1']
+    assert {result['access_token'] for result in results} == {'new-r1'}
+    assert store.load('k')['refresh_token'] == 'r1'
+
+
+def test_refresh_of_one_key_does_not_block_another(tmp_path):
+    calls = []
+    store = TokenStore(SQLiteTokenBackend(str(tmp_path / 'tokens.db')), _slow_refresh(calls, 0.5))
+    keys = _keys_in_different_stripes()
+    for key in keys:
+        store.save(key, _expiring_token('r-' + key))
+    started = time.perf_counter()
+    results = _run_concurrently(*[lambda key=key: store.get_valid_token(key) for key in keys])
+    assert time.perf_counter() - started < 0.9
+    assert sorted(calls) == sorted('r-' + key for key in keys)
+    assert all(results)
+
+
+def test_sqlite_lock_is_per_key(tmp_path):
+    backend = SQLiteTokenBackend(str(tmp_path / 'tokens.db'))
+    keys = _keys_in_different_stripes()
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with backend.lock(keys[0]):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait(5)
+    try:
+        # 別のキーのロックは待たずに取れる
+        started = time.perf_counter()
+        with backend.lock(keys[1]):
+            pass
+        assert time.perf_counter() - started < 0.2
+        # 同じキーのロックは解放されるまで待つ
+        threading.Timer(0.3, release.set).start()
+        started = time.perf_counter()
+        with backend.lock(keys[0]):
+            pass
+        assert time.perf_counter() - started >= 0.25
+    finally:
+        release.set()
+        thread.join(5)
+
+
+def test_failed_refresh_clears_only_that_key():
+    store = TokenStore(MemoryTokenBackend(), lambda refresh_token: None)
+    store.save('a', _expiring_token('ra'))
+    store.save('b', {'access_token': 'b', 'expires_in': 3600, 'obtained_at': int(time.time())})
+    assert store.get_valid_token('a') is None
+    assert store.load('a') is None
+    assert store.get_valid_token('b')['access_token'] == 'b'
+
+
+class _StuckLockBackend(MemoryTokenBackend):
+    """ロックを持つ他のプロセスが応答しない保存先"""
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        raise LockTimeout('stuck')
+        yield
+
+
+def test_lock_timeout_falls_back_to_stored_token():
+    calls = []
+    store = TokenStore(_StuckLockBackend(), _slow_refresh(calls, 0))
+    # まだ期限内なら、更新できなくても保存済みのトークンを使う
+    store.save('k', _expiring_token('r'))
+    assert store.get_valid_token('k')['access_token'] == 'old-r'
+    # 期限切れなら None（トークンは消さず、次のリクエストで再試行する）
+    store.save('expired', {**_expiring_token('r'), 'expires_in': 0})
+    assert store.get_valid_token('expired') is None
+    assert store.load('expired') is not None
+    assert calls == []
+
+
+def test_refresh_keeps_scope():
+    # 結果キャッシュのキーにスコープを使うので、省略されたリフレッシュのレスポンスでも引き継ぐ
+    store = TokenStore(MemoryTokenBackend(), lambda refresh_token: {'access_token': 'new', 'expires_in': 3600})
+    store.save('k', {**_expiring_token('r'), 'scope': 'session:role:ANALYST refresh_token'})
+    assert store.get_valid_token('k')['scope'] == 'session:role:ANALYST refresh_token'
+
+
+def _run_async(store, refresh, *keys):
+    async def main():
+        loop = asyncio.get_running_loop()
+        async_store = AsyncTokenStore(store, refresh,
+                                      lambda func, *args: loop.run_in_executor(None, func, *args))
+        return await asyncio.gather(*[async_store.get_valid_token(key) for key in keys])
+    return asyncio.run(main())
+
+
+def test_async_concurrent_requests_refresh_once(tmp_path):
+    # ASGI 版はトークンエンドポイントをコルーチンで呼び、待つ側はイベントループ上で待つ
+    calls = []
+
+    async def refresh(refresh_token):
+        calls.append(refresh_token)
+        await asyncio.sleep(0.3)
+        return {'access_token': 'new-' + refresh_token, 'expires_in': 3600}
+
+    store = TokenStore(SQLiteTokenBackend(str(tmp_path / 'tokens.db')),
+                       lambda refresh_token: pytest.fail('同期版のリフレッシュを使った'))
+    store.save('k', _expiring_token('r1'))
+    results = _run_async(store, refresh, *['k'] * 5)
+    assert calls == ['r1']
+    assert {result['access_token'] for result in results} == {'new-r1'}
+    assert store.load('k')['access_token'] == 'new-r1'
+
+
+def test_async_refresh_waits_for_sync_refresh_of_same_key():
+    # 同じプロセスのスレッド（Flask アプリ・バックグラウンド更新）の更新とは保存先のロックで1回にする
+    calls = []
+    store = TokenStore(MemoryTokenBackend(), _slow_refresh(calls, 0.3))
+    store.save('k', _expiring_token('r1'))
+    thread = threading.Thread(target=store.get_valid_token, args=('k',))
+    thread.start()
+    time.sleep(0.1)
+
+    async def refresh(refresh_token):
+        calls.append('async')
+        return {'access_token': 'async', 'expires_in': 3600}
+
+    assert _run_async(store, refresh, 'k')[0]['access_token'] == 'new-r1'
+    thread.join(5)
+    assert calls == ['r1']